@@ -1,16 +1,210 @@
+import asyncio
 import httpx
+import importlib.util
+import ssl
+import threading
+from functools import lru_cache
 from typing import Dict, List, Optional
 import json
+import logging
+import os
+import time
+
+from django.conf import settings
+
+from ehsandar.log import log_payload
+from ehsandar.metrics import record_outbound
+from .resilience import backoff, get_circuit_breaker, get_retry_budget
+
+logger = logging.getLogger(__name__)
+
+
+BASE_URL = "https://open-api.divar.ir"
+
+
+@lru_cache(maxsize=None)
+def ssl_context() -> ssl.SSLContext:
+    """
+    TLS context shared by every client, loading the CA bundle is the slowest
+    part of creating one
+    """
+    return httpx.create_ssl_context()
+
+
+class KenarError(Exception):
+    """Sending to the Kenar API failed, the httpx error is the __cause__"""
+
+
+class KenarUnavailable(KenarError):
+    """The circuit breaker is open, the message was not sent"""
+
+
+def is_retryable(error: Exception) -> bool:
+    """Retry transport errors, 429 and 5xx, give up on other API errors"""
+    if isinstance(error, KenarError) and error.__cause__ is not None:
+        error = error.__cause__
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return True
+
+
+@lru_cache(maxsize=None)
+def http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+def client_options(max_connections: int, max_keepalive_connections: int) -> Dict:
+    """
+    httpx client arguments from settings: separate connect and read
+    deadlines, pool limits and HTTP/2 when KENAR_HTTP2 is on and h2 is installed
+    """
+    return {
+        "timeout": httpx.Timeout(
+            getattr(settings, "KENAR_READ_TIMEOUT", 10.0),
+            connect=getattr(settings, "KENAR_CONNECT_TIMEOUT", 2.0),
+        ),
+        "limits": httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=60.0,
+        ),
+        "http2": getattr(settings, "KENAR_HTTP2", True) and http2_available(),
+        "verify": ssl_context(),
+    }
+
+
+_http_client: Optional[httpx.Client] = None
+_http_client_pid = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client() -> httpx.Client:
+    """
+    Process-wide pooled httpx.Client shared by every ChatbotClient. A forked
+    worker gets its own instead of the parent's connections.
+    """
+    global _http_client, _http_client_pid
+    pid = os.getpid()
+    if _http_client is None or _http_client_pid != pid:
+        with _http_client_lock:
+            if _http_client is None or _http_client_pid != pid:
+                _http_client = httpx.Client(
+                    **client_options(
+                        getattr(settings, "KENAR_POOL_SIZE", 100),
+                        getattr(settings, "KENAR_POOL_KEEPALIVE", 20),
+                    )
+                )
+                _http_client_pid = pid
+    return _http_client
+
+
+def outcome(error: Optional[Exception]) -> str:
+    """Metrics label for a Kenar call: "ok", the HTTP status or the error name"""
+    if error is None:
+        return "ok"
+    if isinstance(error, httpx.HTTPStatusError):
+        return str(error.response.status_code)
+    return type(error).__name__
+
+
+def build_message_payload(
+    message: str, buttons_data: List[Dict], message_type: str = "TEXT"
+) -> Dict:
+    return {
+        "type": message_type,
+        "text_message": message,
+        "buttons": {"rows": buttons_data},
+    }
+
+
+def _record_attempt(error: Optional[Exception], duration: float):
+    record_outbound(outcome(error), duration)
+    # Client errors mean Kenar is up and answering
+    if error is None or not is_retryable(error):
+        get_circuit_breaker().record_success()
+    else:
+        get_circuit_breaker().record_failure()
 
 
 class ChatbotClient:
-    def __init__(self, api_key: str):
-        self.base_url = "https://open-api.divar.ir"
+    """
+    Kenar messages client. Sends through the process-wide connection pool
+    (get_http_client) and retries transport errors, 429 and 5xx up to
+    max_attempts times with jittered backoff, as long as the process-wide
+    retry budget allows. While the circuit breaker is open calls fail fast
+    with KenarUnavailable, other failures raise KenarError.
+    """
+
+    base_delay = 0.1
+    max_delay = 1.0
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = BASE_URL,
+        client: Optional[httpx.Client] = None,
+        max_attempts: Optional[int] = None,
+    ):
+        self.base_url = base_url
         self.headers = {
             "Content-Type": "application/json",
             "X-API-Key": api_key,
         }
-        self.client = httpx.Client(timeout=30.0)
+        self.client = client or get_http_client()
+        self.max_attempts = max_attempts or getattr(settings, "KENAR_MAX_ATTEMPTS", 3)
+
+    def message_url(self, conversation_id: str) -> str:
+        return f"{self.base_url}/experimental/open-platform/chat/bot/conversations/{conversation_id}/messages"
+
+    def _should_retry(self, error: Exception, attempt: int) -> bool:
+        return (
+            attempt + 1 < self.max_attempts
+            and is_retryable(error)
+            and get_retry_budget().withdraw()
+        )
+
+    def _start_attempt(self) -> float:
+        """Fail fast while the circuit is open, returns the attempt's start time"""
+        if not get_circuit_breaker().allow():
+            raise KenarUnavailable("Kenar circuit is open, message not sent")
+        return time.perf_counter()
+
+    def _failed_attempt(self, error: BaseException, start: float, attempt: int) -> float:
+        """
+        Record an attempt that raised error, returns the backoff before the
+        next one or raises when there is none
+        """
+        if not isinstance(error, Exception):
+            # Cancelled, says nothing about Kenar
+            get_circuit_breaker().release()
+            raise error
+        _record_attempt(error, time.perf_counter() - start)
+        if not isinstance(error, httpx.HTTPError):
+            # Anything but an httpx error is a failure too, and not retried
+            raise error
+        if not self._should_retry(error, attempt):
+            raise KenarError(f"Failed to send message: {error}") from error
+        return backoff(attempt, self.base_delay, self.max_delay)
+
+    def _post(self, conversation_id: str, **kwargs) -> httpx.Response:
+        """POST to the messages endpoint with retries, recording each attempt in metrics"""
+        get_retry_budget().deposit()
+        attempt = 0
+        while True:
+            start = self._start_attempt()
+            try:
+                response = self.client.post(
+                    self.message_url(conversation_id), headers=self.headers, **kwargs
+                )
+                response.raise_for_status()
+            except BaseException as e:
+                delay = self._failed_attempt(e, start, attempt)
+            else:
+                _record_attempt(None, time.perf_counter() - start)
+                return response
+            time.sleep(delay)
+            attempt += 1
 
     def create_button(self, caption: str, icon_name: str, action_data: Dict) -> Dict:
         """Create a button structure"""
@@ -35,28 +229,144 @@ class ChatbotClient:
             buttons_data: List of dictionaries containing button data
                         [{"caption": "Button Text", "icon_name": "icon", "data": {...}}] message_type: Type of message (default: "TEXT")
         """
-        # Create buttons
-
         # Construct the payload
-        payload = {
-            "type": message_type,
-            "text_message": message,
-            "buttons": {"rows": buttons_data},
-        }
+        payload = build_message_payload(message, buttons_data, message_type)
 
-        print(payload)
-        try:
-            response = self.client.post(
-                f"{self.base_url}/experimental/open-platform/chat/bot/conversations/{conversation_id}/messages",  # Adjust endpoint as needed
-                headers=self.headers,
-                json=payload,
+        log_payload(
+            logger,
+            logging.DEBUG,
+            "sending message",
+            payload,
+            conversation_id=conversation_id,
+        )
+        response = self._post(conversation_id, json=payload)
+        # Only decode the response body when it would be logged
+        if logger.isEnabledFor(logging.DEBUG):
+            log_payload(
+                logger,
+                logging.DEBUG,
+                "message sent",
+                response.json(),
+                conversation_id=conversation_id,
             )
-            print(response.json())
-            response.raise_for_status()
-            return response
-        except httpx.HTTPError as e:
-            raise Exception(f"Failed to send message: {str(e)}")
+        return response
+
+    def send_raw_message(self, conversation_id: str, content: bytes) -> httpx.Response:
+        """
+        Send an already serialized message payload as-is, e.g. one from the
+        xo render cache, skipping the dict to JSON encoding
+        """
+        return self._post(conversation_id, content=content)
 
     def close(self):
-        """Close the HTTP client"""
-        self.client.close()
+        """Nothing to release, the connection pool is shared by the process"""
+
+
+class AsyncChatbotClient(ChatbotClient):
+    """
+    Async variant of ChatbotClient backed by one long-lived pooled
+    httpx.AsyncClient, meant to be shared by every request of a worker
+    (see get_async_client) so connections and TLS sessions are reused.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: str = BASE_URL,
+        max_connections: int = 200,
+        max_keepalive_connections: int = 50,
+        max_attempts: Optional[int] = None,
+    ):
+        super().__init__(
+            api_key,
+            base_url,
+            client=httpx.AsyncClient(
+                **client_options(max_connections, max_keepalive_connections)
+            ),
+            max_attempts=max_attempts,
+        )
+
+    async def _post(self, conversation_id: str, **kwargs) -> httpx.Response:
+        get_retry_budget().deposit()
+        attempt = 0
+        while True:
+            start = self._start_attempt()
+            try:
+                response = await self.client.post(
+                    self.message_url(conversation_id), headers=self.headers, **kwargs
+                )
+                response.raise_for_status()
+            except BaseException as e:
+                delay = self._failed_attempt(e, start, attempt)
+            else:
+                _record_attempt(None, time.perf_counter() - start)
+                return response
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def send_message_with_buttons(
+        self,
+        conversation_id: str,
+        message: str,
+        buttons_data: List[Dict[str, str]],
+        message_type: str = "TEXT",
+    ) -> httpx.Response:
+        """Send a message with buttons, see ChatbotClient.send_message_with_buttons"""
+        payload = build_message_payload(message, buttons_data, message_type)
+        return await self._post(conversation_id, json=payload)
+
+    async def send_raw_message(
+        self, conversation_id: str, content: bytes
+    ) -> httpx.Response:
+        """Send an already serialized message payload as-is"""
+        return await self._post(conversation_id, content=content)
+
+    async def aclose(self):
+        """Close the pooled HTTP client"""
+        await self.client.aclose()
+
+    def close(self):
+        raise RuntimeError("AsyncChatbotClient must be closed with aclose()")
+
+
+_async_client: Optional[AsyncChatbotClient] = None
+_async_client_loop = None
+# Closes of replaced clients in progress, referenced until they finish
+_closing = set()
+
+
+async def _aclose_quietly(client: AsyncChatbotClient):
+    try:
+        await client.aclose()
+    except RuntimeError:
+        # Its loop is closed, the sockets are closed but the transports
+        # can't report it to that loop
+        pass
+
+
+def _close_stale(client: AsyncChatbotClient, client_loop, loop):
+    """Close a client replaced because the event loop changed"""
+    if client_loop.is_running():
+        asyncio.run_coroutine_threadsafe(client.aclose(), client_loop)
+        return
+    task = loop.create_task(_aclose_quietly(client))
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+
+
+def get_async_client() -> AsyncChatbotClient:
+    """
+    Return the process-wide AsyncChatbotClient. The pool is bound to the
+    running event loop, so a new one is created if the loop changes.
+    """
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        if _async_client is not None:
+            _close_stale(_async_client, _async_client_loop, loop)
+        _async_client = AsyncChatbotClient(
+            api_key=os.environ.get("KENAR_API_KEY"),
+            base_url=getattr(settings, "KENAR_BASE_URL", BASE_URL),
+        )
+        _async_client_loop = loop
+    return _async_client
@@ -0,0 +1,213 @@
+"""
+Idempotent webhook handling.
+
+Kenar retries webhooks it did not see answered, so both webhook views key
+each event (the message id, or game_id+position+version for button
+callbacks) and remember the response they sent. A retried event is answered
+from that response without touching Game or ChatbotClient. Responses are
+kept in a bounded in-memory TTL store per process, or in the
+ProcessedWebhook table when KENAR_DEDUP_BACKEND is "database" so that
+every worker sees them. Expired rows are deleted by DedupStore.purge,
+which the game sweeper calls (see xo.sweeper).
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import IntegrityError
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils import timezone
+
+from ehsandar.dbwriter import write
+from .models import ProcessedWebhook
+
+# (status, content, content_type)
+CachedResponse = Tuple[int, bytes, str]
+
+
+def message_key(data) -> str:
+    return f"message:{data['new_chatbot_message']['id']}"
+
+
+def move_key(extra_data) -> Optional[str]:
+    """Key for a button callback, None for buttons rendered without a version"""
+    version = extra_data.get("version")
+    if version is None:
+        return None
+    return f"move:{extra_data.get('game_id')}:{extra_data.get('position')}:{version}"
+
+
+def snapshot(response: HttpResponse) -> CachedResponse:
+    return response.status_code, response.content, response.get("Content-Type", "")
+
+
+def to_response(cached: CachedResponse) -> HttpResponse:
+    status, content, content_type = cached
+    return HttpResponse(content, status=status, content_type=content_type)
+
+
+class DedupStore:
+    """Base store, also used as-is when deduplication is disabled"""
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        return None
+
+    def set(self, key: str, cached: CachedResponse):
+        pass
+
+    def lookup(self, key: Optional[str]) -> Optional[HttpResponse]:
+        """Return the stored response for a duplicate event"""
+        if key is None:
+            return None
+        cached = self.get(key)
+        return to_response(cached) if cached is not None else None
+
+    def remember(self, key: Optional[str], response: HttpResponse):
+        """Store a successful response so retries get the same answer"""
+        if key is None or not 200 <= response.status_code < 300:
+            return
+        self.set(key, snapshot(response))
+
+    def purge(self) -> int:
+        """Delete expired entries the store doesn't drop by itself, returns how many"""
+        return 0
+
+    async def alookup(self, key: Optional[str]) -> Optional[HttpResponse]:
+        return await sync_to_async(self.lookup)(key)
+
+    async def aremember(self, key: Optional[str], response: HttpResponse):
+        await sync_to_async(self.remember)(key, response)
+
+
+class MemoryDedupStore(DedupStore):
+    """Bounded LRU of responses that expire after ttl seconds"""
+
+    def __init__(self, max_entries: int = 50000, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, CachedResponse]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            if item[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            return item[1]
+
+    def set(self, key: str, cached: CachedResponse):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = (now + self.ttl, cached)
+            self._entries.move_to_end(key)
+            # Entries are in insertion order, so the oldest expire first
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if len(self._entries) <= self.max_entries and oldest[0] > now:
+                    break
+                self._entries.popitem(last=False)
+
+    async def alookup(self, key: Optional[str]) -> Optional[HttpResponse]:
+        return self.lookup(key)
+
+    async def aremember(self, key: Optional[str], response: HttpResponse):
+        self.remember(key, response)
+
+
+class DatabaseDedupStore(DedupStore):
+    """Responses shared by all workers through the ProcessedWebhook table"""
+
+    def __init__(self, ttl: float = 3600.0):
+        self.ttl = ttl
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        since = timezone.now() - timedelta(seconds=self.ttl)
+        row = (
+            ProcessedWebhook.objects.filter(key=key, created_at__gte=since)
+            .values_list("status", "content", "content_type")
+            .first()
+        )
+        if row is None:
+            return None
+        status, content, content_type = row
+        return status, bytes(content), content_type
+
+    def set(self, key: str, cached: CachedResponse):
+        status, content, content_type = cached
+        try:
+            write(
+                ProcessedWebhook.objects.update_or_create,
+                key=key,
+                defaults={
+                    "status": status,
+                    "content": content,
+                    "content_type": content_type,
+                    "created_at": timezone.now(),
+                },
+            )
+        except IntegrityError:
+            # Another worker stored the same event first
+            pass
+
+    def _purge_batch(self, since, batch_size):
+        expired = ProcessedWebhook.objects.filter(created_at__lt=since)
+        ids = list(expired.values_list("pk", flat=True)[:batch_size])
+        deleted, _ = ProcessedWebhook.objects.filter(pk__in=ids).delete()
+        return deleted
+
+    def purge(self, batch_size: int = 1000) -> int:
+        """Delete expired rows batch_size at a time, returns the number deleted"""
+        since = timezone.now() - timedelta(seconds=self.ttl)
+        total = 0
+        while True:
+            deleted = write(self._purge_batch, since, batch_size)
+            total += deleted
+            if deleted < batch_size:
+                return total
+
+
+_store: Optional[DedupStore] = None
+_store_lock = threading.Lock()
+
+
+def get_dedup_store() -> DedupStore:
+    """
+    Return the process-wide dedup store for settings.KENAR_DEDUP_BACKEND,
+    "memory", "database", or None to disable deduplication
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            backend = getattr(settings, "KENAR_DEDUP_BACKEND", "memory")
+            ttl = getattr(settings, "KENAR_DEDUP_TTL", 3600.0)
+            if backend is None:
+                _store = DedupStore()
+            elif backend == "database":
+                _store = DatabaseDedupStore(ttl=ttl)
+            elif backend == "memory":
+                _store = MemoryDedupStore(
+                    max_entries=getattr(settings, "KENAR_DEDUP_SIZE", 50000), ttl=ttl
+                )
+            else:
+                raise ValueError(f"Unknown dedup backend: {backend}")
+        return _store
+
+
+@receiver(setting_changed)
+def _reset_store(setting, **kwargs):
+    global _store
+    if setting.startswith("KENAR_DEDUP_"):
+        _store = None
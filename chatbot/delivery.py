@@ -0,0 +1,210 @@
+"""
+Background delivery of outbound Kenar messages.
+
+Webhook views hand their reply to a DeliveryQueue and return right away.
+A small pool of worker threads sends the messages with retries and
+exponential backoff, drawing on the same retry budget as ChatbotClient.
+Messages are coalesced per conversation: if several board states for the
+same conversation are waiting, only the latest one is sent, and a
+conversation is never sent to by two workers at once so replies can't
+arrive out of order.
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from django.conf import settings
+
+from .client import BASE_URL, ChatbotClient, is_retryable
+from .resilience import backoff, get_retry_budget
+
+logger = logging.getLogger(__name__)
+
+
+class OutboundMessage:
+    __slots__ = ("conversation_id", "content")
+
+    def __init__(self, conversation_id: str, content: bytes):
+        self.conversation_id = conversation_id
+        self.content = content
+
+
+class DeliveryQueue:
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        base_url: str = BASE_URL,
+        workers: int = 4,
+        max_attempts: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        client_factory: Optional[Callable[[], ChatbotClient]] = None,
+    ):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # One attempt per send, the queue does its own (slower) retries
+        self.client_factory = client_factory or (
+            lambda: ChatbotClient(api_key=api_key, base_url=base_url, max_attempts=1)
+        )
+
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._pending: Dict[str, OutboundMessage] = {}
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+
+        # Counters
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.coalesced = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name=f"kenar-delivery-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, conversation_id: str, content: bytes):
+        """Queue a serialized message, replacing any unsent one for the same conversation"""
+        outbound = OutboundMessage(conversation_id, content)
+        with self._lock:
+            if conversation_id in self._pending:
+                self.coalesced += 1
+                self._pending[conversation_id] = outbound
+                return
+            self._pending[conversation_id] = outbound
+            # A worker busy with this conversation re-queues it when done
+            if conversation_id not in self._in_flight:
+                self._queue.put(conversation_id)
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """Wait until nothing is pending or in flight"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def stop(self, timeout: Optional[float] = 5.0):
+        """Drain pending messages for up to timeout, then stop the workers"""
+        self.join(timeout)
+        self._stopping = True
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def backoff(self, attempt: int) -> float:
+        """Exponential backoff with full jitter for the given retry attempt"""
+        return backoff(attempt, self.base_delay, self.max_delay)
+
+    def _run(self):
+        client = self.client_factory()
+        try:
+            while True:
+                conversation_id = self._queue.get()
+                if conversation_id is None:
+                    return
+                with self._lock:
+                    outbound = self._pending.pop(conversation_id, None)
+                    if outbound is None:
+                        continue
+                    self._in_flight.add(conversation_id)
+                try:
+                    self._deliver(client, outbound)
+                finally:
+                    with self._lock:
+                        self._in_flight.discard(conversation_id)
+                        if conversation_id in self._pending:
+                            self._queue.put(conversation_id)
+                        self._idle.notify_all()
+        finally:
+            client.close()
+
+    def _deliver(self, client: ChatbotClient, outbound: OutboundMessage):
+        for attempt in range(self.max_attempts):
+            try:
+                client.send_raw_message(outbound.conversation_id, outbound.content)
+                with self._lock:
+                    self.sent += 1
+                return
+            except Exception as e:
+                if (
+                    not is_retryable(e)
+                    or attempt + 1 == self.max_attempts
+                    or not get_retry_budget().withdraw()
+                ):
+                    logger.warning(
+                        "message delivery failed",
+                        extra={
+                            "conversation_id": outbound.conversation_id,
+                            "attempts": attempt + 1,
+                            "error": str(e),
+                        },
+                    )
+                    with self._lock:
+                        self.failed += 1
+                    return
+            time.sleep(self.backoff(attempt))
+            # A newer board state supersedes this one, let it go instead
+            with self._lock:
+                if outbound.conversation_id in self._pending or self._stopping:
+                    self.coalesced += 1
+                    return
+                self.retried += 1
+
+
+_delivery_queue: Optional[DeliveryQueue] = None
+_delivery_lock = threading.Lock()
+
+
+def get_delivery_queue() -> DeliveryQueue:
+    """Return the process-wide DeliveryQueue, starting it on first use"""
+    global _delivery_queue
+    with _delivery_lock:
+        if _delivery_queue is None:
+            _delivery_queue = DeliveryQueue(
+                api_key=os.environ.get("KENAR_API_KEY"),
+                base_url=getattr(settings, "KENAR_BASE_URL", BASE_URL),
+                workers=getattr(settings, "KENAR_DELIVERY_WORKERS", 4),
+                max_attempts=getattr(settings, "KENAR_DELIVERY_MAX_ATTEMPTS", 5),
+            )
+            _delivery_queue.start()
+            atexit.register(_delivery_queue.stop)
+        return _delivery_queue
+
+
+def send_message(conversation_id: str, content: bytes):
+    """
+    Send a serialized reply from a webhook view, either through the
+    background queue (KENAR_BACKGROUND_DELIVERY) or inline with a
+    short-lived client.
+    """
+    if getattr(settings, "KENAR_BACKGROUND_DELIVERY", False):
+        get_delivery_queue().submit(conversation_id, content)
+        return
+
+    client = ChatbotClient(
+        api_key=os.environ.get("KENAR_API_KEY"),
+        base_url=getattr(settings, "KENAR_BASE_URL", BASE_URL),
+    )
+    try:
+        client.send_raw_message(conversation_id, content)
+    finally:
+        client.close()
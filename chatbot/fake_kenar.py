@@ -0,0 +1,111 @@
+"""
+Local stand-in for the Kenar open API messages endpoint, used by the tests
+and the loadtest command. It records every message it receives and can add
+latency and fail a fraction of requests.
+"""
+
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+MESSAGES_PATH = re.compile(
+    r"^/experimental/open-platform/chat/bot/conversations/(?P<conversation_id>[^/]+)/messages$"
+)
+
+
+class FakeKenarServer:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        statuses=(),
+        host: str = "127.0.0.1",
+        port: int = 0,
+        seed: Optional[int] = None,
+    ):
+        """
+        Args:
+            latency: Seconds to wait before answering each request
+            error_rate: Fraction of requests answered with a 500
+            statuses: Statuses to answer the first requests with, in order
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.statuses = list(statuses)
+        self.received = []
+        self._messages: Dict[str, List[dict]] = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Condition()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                if server.latency:
+                    time.sleep(server.latency)
+                status = server.record(self.path, json.loads(body))
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_port}"
+
+    def record(self, path: str, payload: dict) -> int:
+        with self._lock:
+            if self.statuses:
+                status = self.statuses.pop(0)
+            elif self._random.random() < self.error_rate:
+                status = 500
+            else:
+                status = 200
+            self.received.append((path, status, payload))
+            match = MESSAGES_PATH.match(path)
+            if status == 200 and match:
+                conversation_id = match.group("conversation_id")
+                self._messages.setdefault(conversation_id, []).append(payload)
+            self._lock.notify_all()
+        return status
+
+    def messages(self, conversation_id: str) -> List[dict]:
+        """Messages delivered to a conversation, oldest first"""
+        with self._lock:
+            return list(self._messages.get(conversation_id, ()))
+
+    def wait_for(self, conversation_id: str, count: int, timeout: float = 5.0) -> Optional[dict]:
+        """Wait until a conversation has received count messages, return the latest"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while len(self._messages.get(conversation_id, ())) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._lock.wait(remaining)
+            messages = self._messages.get(conversation_id)
+            return messages[-1] if messages else None
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
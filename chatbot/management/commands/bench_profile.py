@@ -0,0 +1,93 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# Runs in a fresh interpreter per sample so startup is measured cold
+CHILD = r"""
+import json, resource, sys, time
+start = time.perf_counter()
+import django
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+setup = time.perf_counter() - start
+
+from ehsandar.warmup import warm
+start = time.perf_counter()
+warm(freeze=False)
+warmup = time.perf_counter() - start
+
+from django.test import Client
+from django.test.utils import setup_test_environment
+setup_test_environment()
+client = Client(REMOTE_ADDR="127.0.0.1")
+start = time.perf_counter()
+client.get("/metrics")
+first = time.perf_counter() - start
+
+samples = []
+for _ in range(REQUESTS):
+    start = time.perf_counter()
+    client.get("/metrics")
+    samples.append(time.perf_counter() - start)
+samples.sort()
+
+print(json.dumps({
+    "setup": setup,
+    "warmup": warmup,
+    "first_request": first,
+    "request_p50": samples[len(samples) // 2],
+    "request_mean": sum(samples) / len(samples),
+    "modules": len(sys.modules),
+    "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+}))
+"""
+
+PROFILES = ("ehsandar.settings", "ehsandar.settings_webhook")
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare cold start and per-request overhead of the full settings with "
+        "the lean webhook profile, each run in fresh interpreters"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--runs", type=int, default=5, help="Fresh processes per profile")
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--profiles", nargs="+", default=PROFILES)
+
+    def run_child(self, profile, requests):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=profile)
+        code = CHILD.replace("REQUESTS", str(requests))
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            env=env,
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'profile':<28}{'setup ms':>10}{'warm ms':>9}{'first ms':>10}"
+            f"{'req p50 us':>12}{'req mean us':>13}{'modules':>9}{'rss MB':>8}"
+        )
+        for profile in options["profiles"]:
+            runs = [self.run_child(profile, options["requests"]) for _ in range(options["runs"])]
+
+            def median(key):
+                return statistics.median(run[key] for run in runs)
+
+            self.stdout.write(
+                f"{profile:<28}{median('setup') * 1000:>10.1f}{median('warmup') * 1000:>9.1f}"
+                f"{median('first_request') * 1000:>10.2f}{median('request_p50') * 1e6:>12.1f}"
+                f"{median('request_mean') * 1e6:>13.1f}{median('modules'):>9.0f}"
+                f"{median('max_rss_kb') / 1024:>8.1f}"
+            )
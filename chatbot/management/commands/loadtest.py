@@ -0,0 +1,284 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import Client, override_settings
+from django.test.utils import (
+    setup_databases,
+    setup_test_environment,
+    teardown_databases,
+    teardown_test_environment,
+)
+
+from chatbot.fake_kenar import FakeKenarServer
+from ehsandar.metrics import count_queries, percentile
+from xo.shards import shards
+
+def summarize(samples):
+    latencies = sorted(sample["latency"] for sample in samples)
+    queries = [sample["queries"] for sample in samples]
+    errors = sum(1 for sample in samples if sample["status"] >= 500)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "queries_mean": sum(queries) / len(queries),
+        "queries_max": max(queries),
+    }
+
+
+def enabled_cells(payload):
+    """(data, position) of the buttons still playable in a board message"""
+    cells = []
+    for row in payload["buttons"]["rows"]:
+        for button in row["buttons"]:
+            data = button["action"]["get_dynamic_action"]["data"]
+            if data["disabled"] == "False":
+                cells.append(data)
+    return cells
+
+
+class LoadTest:
+    def __init__(self, fake, options):
+        self.fake = fake
+        self.options = options
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def request(self, scenario, path, data):
+        client = Client()
+        with count_queries() as queries:
+            start = time.perf_counter()
+            response = client.post(path, data=data, content_type="application/json")
+            latency = time.perf_counter() - start
+        with self.lock:
+            self.samples.append(
+                {
+                    "scenario": scenario,
+                    "path": path,
+                    "status": response.status_code,
+                    "latency": latency,
+                    "queries": queries[0],
+                }
+            )
+        return response
+
+    def message(self, scenario, conversation_id, text):
+        return self.request(
+            scenario,
+            "/chatbot/webhook/",
+            {
+                "new_chatbot_message": {
+                    "id": uuid.uuid4().hex,
+                    "type": "TEXT",
+                    "text": text,
+                    "conversation": {"id": conversation_id},
+                }
+            },
+        )
+
+    def tap(self, scenario, data):
+        return self.request(scenario, "/xo/webhook/", {"extra_data": data})
+
+    def play_game(self, rng, conversation_id):
+        """Tap random free cells until the game ends or a reply goes missing"""
+        while True:
+            count = max(1, len(self.fake.messages(conversation_id)))
+            payload = self.fake.wait_for(conversation_id, count)
+            if payload is None or payload["text_message"].startswith("Game Over"):
+                return
+            cells = enabled_cells(payload)
+            if not cells:
+                return
+            data = rng.choice(cells)
+
+            if rng.random() < self.options["double_tap_rate"]:
+                # Two taps of the same button racing each other
+                second = threading.Thread(target=self.tap, args=("double_tap", data))
+                second.start()
+                self.tap("double_tap", data)
+                second.join()
+            else:
+                self.tap("move", data)
+
+            if self.fake.wait_for(conversation_id, count + 1) is None:
+                return
+
+    def conversation(self, index):
+        rng = random.Random(self.options["seed"] * 100003 + index)
+        conversation_id = f"loadtest-{index}-{uuid.uuid4().hex[:8]}"
+        try:
+            self.message("new_conversation", conversation_id, "hi")
+            self.play_game(rng, conversation_id)
+            if rng.random() < self.options["restart_rate"]:
+                self.message("restart", conversation_id, "/restart")
+                self.play_game(rng, conversation_id)
+        finally:
+            connections.close_all()
+
+    def run(self):
+        with ThreadPoolExecutor(self.options["concurrency"]) as pool:
+            list(pool.map(self.conversation, range(self.options["conversations"])))
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive the webhooks with simulated conversations against a local Kenar "
+        "stand-in and report throughput, latency percentiles and DB queries"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--conversations", type=int, default=50)
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument(
+            "--latency", type=float, default=0.02, help="Kenar API latency in seconds"
+        )
+        parser.add_argument(
+            "--error-rate", type=float, default=0.0, help="Fraction of Kenar calls that fail"
+        )
+        parser.add_argument("--double-tap-rate", type=float, default=0.1)
+        parser.add_argument("--restart-rate", type=float, default=0.2)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--label", default="", help="Name stored with the results")
+        parser.add_argument("--output", default="loadtest-results")
+        parser.add_argument("--compare", help="Earlier results file to compare with")
+
+    def handle(self, *args, **options):
+        os.environ.setdefault("KENAR_API_KEY", "loadtest")
+        with tempfile.TemporaryDirectory() as directory:
+            names = self.use_files(directory)
+            try:
+                load, elapsed = self.run_load(options)
+            finally:
+                for alias, name in names.items():
+                    connections[alias].settings_dict["TEST"]["NAME"] = name
+
+        results = self.build_results(load.samples, elapsed, options)
+        self.report(results)
+        path = self.save(results, options["output"])
+        self.stdout.write(f"results saved to {path}")
+        if options["compare"]:
+            self.compare(json.loads(Path(options["compare"]).read_text()), results)
+
+    def use_files(self, directory):
+        """
+        Point the test databases at files in directory, the in-memory test
+        database ignores the journal and busy timeout settings. Returns the
+        names they had
+        """
+        names = {}
+        for alias in {"default", *shards()}:
+            settings_dict = connections[alias].settings_dict
+            if settings_dict["ENGINE"] == "django.db.backends.sqlite3":
+                names[alias] = settings_dict["TEST"].get("NAME")
+                settings_dict["TEST"]["NAME"] = str(Path(directory) / f"{alias}.sqlite3")
+        return names
+
+    def run_load(self, options):
+        setup_test_environment()
+        connections.close_all()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        fake = FakeKenarServer(
+            latency=options["latency"],
+            error_rate=options["error_rate"],
+            seed=options["seed"],
+        ).start()
+        try:
+            # Simulated users tap much faster than people, don't throttle them
+            with override_settings(KENAR_BASE_URL=fake.url, KENAR_THROTTLE_BACKEND=None):
+                load = LoadTest(fake, options)
+                start = time.perf_counter()
+                load.run()
+                elapsed = time.perf_counter() - start
+        finally:
+            fake.stop()
+            connections.close_all()
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+        return load, elapsed
+
+    def build_results(self, samples, elapsed, options):
+        groups = {}
+        for sample in samples:
+            groups.setdefault(sample["path"], []).append(sample)
+            groups.setdefault(sample["scenario"], []).append(sample)
+        return {
+            "label": options["label"],
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "options": {
+                key: options[key]
+                for key in (
+                    "conversations",
+                    "concurrency",
+                    "latency",
+                    "error_rate",
+                    "double_tap_rate",
+                    "restart_rate",
+                    "seed",
+                )
+            },
+            "settings": {
+                key: getattr(settings, key, None)
+                for key in dir(settings)
+                if key.startswith(("XO_", "KENAR_")) and key != "KENAR_BASE_URL"
+            },
+            "elapsed_s": elapsed,
+            "throughput_rps": len(samples) / elapsed if elapsed else 0.0,
+            "total": summarize(samples),
+            "groups": {name: summarize(group) for name, group in sorted(groups.items())},
+        }
+
+    def report(self, results):
+        self.stdout.write(
+            f"{results['total']['requests']} requests in {results['elapsed_s']:.2f}s, "
+            f"{results['throughput_rps']:.1f} req/s"
+        )
+        header = (
+            f"{'group':<20}{'reqs':>6}{'errs':>6}"
+            f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}"
+        )
+        self.stdout.write(header)
+        rows = [("total", results["total"]), *results["groups"].items()]
+        for name, stats in rows:
+            self.stdout.write(
+                f"{name:<20}{stats['requests']:>6}{stats['errors']:>6}"
+                f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}"
+                f"{stats['queries_mean']:>9.2f}"
+            )
+
+    def save(self, results, output):
+        directory = Path(output)
+        directory.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        name = f"loadtest-{stamp}{'-' + results['label'] if results['label'] else ''}.json"
+        path = directory / name
+        path.write_text(json.dumps(results, indent=2, default=str))
+        return path
+
+    def compare(self, before, after):
+        self.stdout.write(f"compared with {before.get('label') or before['timestamp']}:")
+        self.stdout.write(
+            f"  throughput {before['throughput_rps']:.1f} -> {after['throughput_rps']:.1f} req/s"
+        )
+        for name, stats in after["groups"].items():
+            old = before["groups"].get(name)
+            if old is None:
+                continue
+            self.stdout.write(
+                f"  {name:<18} p50 {old['p50_ms']:.1f} -> {stats['p50_ms']:.1f}ms"
+                f"  p99 {old['p99_ms']:.1f} -> {stats['p99_ms']:.1f}ms"
+                f"  queries {old['queries_mean']:.2f} -> {stats['queries_mean']:.2f}"
+            )
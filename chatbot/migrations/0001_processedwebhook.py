@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedWebhook',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=200, unique=True)),
+                ('status', models.PositiveSmallIntegerField()),
+                ('content', models.BinaryField()),
+                ('content_type', models.CharField(max_length=100)),
+                ('created_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -1,3 +1,14 @@
 from django.db import models
 
-# Create your models here.
+
+class ProcessedWebhook(models.Model):
+    """Response sent for a webhook event, used by chatbot.dedup"""
+
+    key = models.CharField(max_length=200, unique=True)
+    status = models.PositiveSmallIntegerField()
+    content = models.BinaryField()
+    content_type = models.CharField(max_length=100)
+    created_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.key} - {self.status}"
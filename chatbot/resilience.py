@@ -0,0 +1,186 @@
+"""
+Failure handling shared by every Kenar client in the process.
+
+RetryBudget caps retries at a fraction of recent requests (plus a small
+floor per second), so when Kenar struggles we add at most that much extra
+load instead of multiplying it by the attempt count. CircuitBreaker opens
+after a run of consecutive failures and fails calls fast for a while, then
+lets a single trial call through to see whether Kenar is back. Both are
+process-wide and their state is exported as metrics:
+
+    kenar_circuit_state        0 closed, 1 half open, 2 open
+    kenar_retries_total        {result="allowed"|"denied"}
+    kenar_rejected_total       calls failed fast by the open circuit
+"""
+
+import logging
+import random
+import threading
+import time
+from typing import Optional
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from ehsandar.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def backoff(attempt: int, base_delay: float, max_delay: float) -> float:
+    """Exponential backoff with full jitter for the given retry attempt"""
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+class RetryBudget:
+    def __init__(
+        self, ratio: float = 0.2, min_per_second: float = 1.0, capacity: float = 20.0
+    ):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.min_per_second)
+
+    def deposit(self):
+        """Count a first attempt, each one earns ratio of a retry"""
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """Take a retry from the budget, False if it's used up"""
+        with self._lock:
+            self._refill(time.monotonic())
+            allowed = self._tokens >= 1.0
+            if allowed:
+                self._tokens -= 1.0
+        registry.counter(
+            "kenar_retries_total",
+            "Kenar retries allowed or denied by the retry budget",
+            result="allowed" if allowed else "denied",
+        ).inc()
+        return allowed
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+        self._gauge = registry.gauge(
+            "kenar_circuit_state", "Kenar circuit breaker, 0 closed, 1 half open, 2 open"
+        )
+        self._gauge.set(STATE_VALUES[CLOSED])
+
+    def _cooled_down(self) -> bool:
+        return time.monotonic() - self._opened_at >= self.reset_timeout
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == OPEN and self._cooled_down():
+                return HALF_OPEN
+            return self._state
+
+    def _set_state(self, state):
+        if state != self._state:
+            logger.warning("kenar circuit %s", state, extra={"failures": self.failures})
+            self._state = state
+            self._gauge.set(STATE_VALUES[state])
+
+    def allow(self) -> bool:
+        """Whether a call may go out now. Half open lets one trial call through"""
+        with self._lock:
+            if self._state == OPEN and self._cooled_down():
+                self._set_state(HALF_OPEN)
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+        registry.counter(
+            "kenar_rejected_total", "Kenar calls failed fast by the open circuit"
+        ).inc()
+        return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_running = False
+            self._set_state(CLOSED)
+
+    def release(self):
+        """Give up a call without a verdict, e.g. cancelled, freeing the half open trial"""
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self._state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+
+_budget: Optional[RetryBudget] = None
+_breaker: Optional[CircuitBreaker] = None
+_lock = threading.Lock()
+
+
+def get_retry_budget() -> RetryBudget:
+    global _budget
+    if _budget is None:
+        with _lock:
+            if _budget is None:
+                _budget = RetryBudget(
+                    ratio=getattr(settings, "KENAR_RETRY_BUDGET", 0.2),
+                    min_per_second=getattr(settings, "KENAR_RETRY_MIN_PER_SECOND", 1.0),
+                )
+    return _budget
+
+
+def get_circuit_breaker() -> CircuitBreaker:
+    global _breaker
+    if _breaker is None:
+        with _lock:
+            if _breaker is None:
+                _breaker = CircuitBreaker(
+                    failure_threshold=getattr(settings, "KENAR_BREAKER_THRESHOLD", 5),
+                    reset_timeout=getattr(settings, "KENAR_BREAKER_RESET", 10.0),
+                )
+    return _breaker
+
+
+def reset():
+    """Forget the budget and breaker state, they are rebuilt from settings"""
+    global _budget, _breaker
+    with _lock:
+        _budget = _breaker = None
+    registry.gauge("kenar_circuit_state").set(STATE_VALUES[CLOSED])
+
+
+@receiver(setting_changed)
+def _reset_on_setting_changed(setting, **kwargs):
+    if setting.startswith(("KENAR_RETRY_", "KENAR_BREAKER_")):
+        reset()
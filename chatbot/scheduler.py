@@ -0,0 +1,262 @@
+"""
+Per-conversation ordering of webhook events.
+
+Both webhook views hand the part of an event that loads, plays, saves and
+renders to Scheduler.run (or arun in the async views), keyed by its
+conversation, and send the board once it returns, so no mailbox waits on
+Kenar. Events with the same key run one at a time in arrival order, from
+a FIFO mailbox per key, so a /restart racing a button tap or several taps
+don't play against the same row at once. An event queued while another
+one with the same fold key is still pending (a tap on the same board
+version of the same game) is folded into it: it doesn't run, and gets the
+earlier event's result (or exception) when that one is done, so a burst
+of taps makes one state transition and one outbound message, sent by the
+event that ran.
+
+A mailbox only exists while it has events, it is dropped as soon as it
+runs empty, so memory follows the requests in flight rather than the
+number of conversations. Button callbacks only carry the game ref, so
+views learn which conversation a game belongs to (learn) and key taps by
+that conversation once known, by the game until then. An alias learned
+while events are queued under the game takes effect once they have run.
+This orders events within one process; across workers the versioned saves
+still catch conflicting turns.
+
+    conversation_events_total  {outcome="ran"|"queued"|"folded"}
+    conversation_mailboxes     mailboxes with events pending
+"""
+
+import asyncio
+import copy
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Optional
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from ehsandar.metrics import registry
+
+RAN, QUEUED, FOLDED = "ran", "queued", "folded"
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _Event:
+    __slots__ = (
+        "fold_key", "loop", "turn", "done", "result", "error", "followers", "shared", "promoted"
+    )
+
+    def __init__(self, fold_key, loop=None):
+        self.fold_key = fold_key
+        self.loop = loop
+        if loop is None:
+            self.turn, self.done = threading.Event(), threading.Event()
+        else:
+            self.turn, self.done = loop.create_future(), loop.create_future()
+        self.result = self.error = None
+        self.followers = []
+        # shared: result and error are the leader's, promoted: run in its place
+        self.shared = self.promoted = False
+
+    def wake(self, waiter):
+        """Set the turn or done waiter, from any thread"""
+        if self.loop is None:
+            waiter.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, waiter)
+
+    def outcome(self):
+        if self.error is None:
+            return self.result
+        if not self.shared:
+            raise self.error
+        # Each follower raises its own copy, the leader's traceback stays
+        # with the leader's thread
+        raise copy.copy(self.error) from self.error
+
+
+class Scheduler:
+    def __init__(self, max_aliases: int = 100000):
+        self.max_aliases = max_aliases
+        self._mailboxes: Dict[str, deque] = {}
+        # game key -> conversation key, most recently learned last
+        self._aliases: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._gauge = registry.gauge(
+            "conversation_mailboxes", "Conversations with webhook events pending"
+        )
+
+    def __len__(self):
+        return len(self._mailboxes)
+
+    def learn(self, alias: str, key: str):
+        """Schedule events for alias (e.g. a game key) under key from now on"""
+        with self._lock:
+            self._aliases[alias] = key
+            self._aliases.move_to_end(alias)
+            while len(self._aliases) > self.max_aliases:
+                self._aliases.popitem(last=False)
+
+    def resolve(self, key: str) -> str:
+        """
+        Key events for key run under: its learned alias, unless events are
+        still queued under key itself, which run first
+        """
+        if key in self._mailboxes:
+            return key
+        return self._aliases.get(key, key)
+
+    def _record(self, outcome):
+        registry.counter(
+            "conversation_events_total",
+            "Webhook events by how the conversation scheduler handled them",
+            outcome=outcome,
+        ).inc()
+
+    def _enter(self, key, fold_key, loop):
+        """Queue an event, returns (resolved key, event, folded)"""
+        event = _Event(fold_key, loop)
+        with self._lock:
+            key = self.resolve(key)
+            mailbox = self._mailboxes.get(key)
+            if mailbox is None:
+                mailbox = self._mailboxes[key] = deque()
+                self._gauge.set(len(self._mailboxes))
+            if fold_key is not None:
+                for pending in mailbox:
+                    if pending.fold_key == fold_key:
+                        pending.followers.append(event)
+                        self._record(FOLDED)
+                        return key, event, True
+            mailbox.append(event)
+            first = len(mailbox) == 1
+        self._record(RAN if first else QUEUED)
+        if first:
+            event.wake(event.turn)
+        return key, event, False
+
+    def _leave(self, key, event, cancelled=False):
+        """Take event out of the mailbox and wake whoever runs next"""
+        with self._lock:
+            mailbox = self._mailboxes[key]
+            index = mailbox.index(event)
+            followers = event.followers
+            if cancelled and followers:
+                # Hand the cancelled event's place to an event folded into it
+                successor = followers[0]
+                successor.followers, successor.promoted = followers[1:], True
+                mailbox[index] = successor
+                successor.wake(successor.done)
+                if index == 0:
+                    successor.wake(successor.turn)
+                followers = []
+            else:
+                del mailbox[index]
+                if not mailbox:
+                    del self._mailboxes[key]
+                    self._gauge.set(len(self._mailboxes))
+                elif index == 0:
+                    mailbox[0].wake(mailbox[0].turn)
+        for follower in followers:
+            follower.result, follower.error = event.result, event.error
+            follower.shared = True
+            follower.wake(follower.done)
+
+    def _unfollow(self, key, event):
+        """Drop a cancelled follower from the event it was folded into"""
+        with self._lock:
+            for pending in self._mailboxes.get(key, ()):
+                if event in pending.followers:
+                    pending.followers.remove(event)
+
+    def run(self, key: str, fn: Callable, fold_key=None):
+        """Run fn() after the events queued before it for key, return its result"""
+        key, event, folded = self._enter(key, fold_key, None)
+        if folded:
+            event.done.wait()
+            if not event.promoted:
+                return event.outcome()
+        cancelled = False
+        try:
+            event.turn.wait()
+            event.result = fn()
+        except Exception as e:
+            event.error = e
+        except BaseException:
+            cancelled = True
+            raise
+        finally:
+            self._leave(key, event, cancelled)
+        return event.outcome()
+
+    async def arun(self, key: str, fn: Callable, fold_key=None):
+        """
+        run for a coroutine function fn, waiting without blocking the loop.
+        A task cancelled while queued or running (e.g. the client went
+        away) gives up its place, to an event folded into it if any
+        """
+        key, event, folded = self._enter(key, fold_key, asyncio.get_running_loop())
+        if folded:
+            try:
+                await event.done
+            except asyncio.CancelledError:
+                self._unfollow(key, event)
+                raise
+            if not event.promoted:
+                return event.outcome()
+        cancelled = False
+        try:
+            await event.turn
+            event.result = await fn()
+        except Exception as e:
+            event.error = e
+        except BaseException:
+            cancelled = True
+            raise
+        finally:
+            self._leave(key, event, cancelled)
+        return event.outcome()
+
+
+_scheduler: Optional[Scheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> Optional[Scheduler]:
+    """Process-wide scheduler, None when KENAR_SCHEDULER is off"""
+    global _scheduler
+    if not getattr(settings, "KENAR_SCHEDULER", True):
+        return None
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = Scheduler(getattr(settings, "KENAR_SCHEDULER_ALIASES", 100000))
+    return _scheduler
+
+
+def schedule(key: str, fn: Callable, fold_key=None):
+    scheduler = get_scheduler()
+    return fn() if scheduler is None else scheduler.run(key, fn, fold_key)
+
+
+async def aschedule(key: str, fn: Callable, fold_key=None):
+    scheduler = get_scheduler()
+    return await fn() if scheduler is None else await scheduler.arun(key, fn, fold_key)
+
+
+def learn(alias: str, key: str):
+    scheduler = get_scheduler()
+    if scheduler is not None:
+        scheduler.learn(alias, key)
+
+
+@receiver(setting_changed)
+def _reset_scheduler(setting, **kwargs):
+    global _scheduler
+    if setting.startswith("KENAR_SCHEDULER"):
+        _scheduler = None
@@ -1,3 +1,844 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import logging
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.http import JsonResponse
+from django.test import (
+    AsyncRequestFactory,
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.utils import timezone
+
+from xo.models import Game
+from xo.views import (
+    CONFLICT_MESSAGE,
+    TAKEN_MESSAGE,
+    THROTTLED_MESSAGE,
+    AsyncReturnUrlView,
+    ReturnUrlView,
+)
+from ehsandar.dbwriter import get_writer, write
+from ehsandar import settings_webhook
+from ehsandar.warmup import warm
+from ehsandar.log import BackgroundHandler, JsonFormatter, log_payload
+from ehsandar.metrics import count_queries, registry
+from ehsandar.profiling import samples_to_stats
+from . import resilience, throttle
+from .client import (
+    AsyncChatbotClient,
+    ChatbotClient,
+    KenarError,
+    KenarUnavailable,
+    get_async_client,
+)
+from .dedup import MemoryDedupStore, snapshot
+from .delivery import DeliveryQueue
+from .fake_kenar import FakeKenarServer
+from .models import ProcessedWebhook
+from .scheduler import Scheduler
+from .views import AsyncMessageWebhookView
+
+
+def message_event(conversation_id, text, message_id="m1"):
+    return {
+        "new_chatbot_message": {
+            "id": message_id,
+            "type": "TEXT",
+            "text": text,
+            "conversation": {"id": conversation_id},
+        }
+    }
+
+
+class DeliveryQueueTests(TestCase):
+    def make_queue(self, server, **kwargs):
+        delivery = DeliveryQueue(api_key="key", base_url=server.url, base_delay=0.01, **kwargs)
+        delivery.start()
+        self.addCleanup(delivery.stop)
+        return delivery
+
+    def test_retries_server_errors(self):
+        with FakeKenarServer(statuses=[500, 503]) as server:
+            delivery = self.make_queue(server)
+            delivery.submit("c1", b'{"text_message":"hello"}')
+            self.assertTrue(delivery.join(5))
+        self.assertEqual([status for _, status, _ in server.received], [500, 503, 200])
+        self.assertEqual((delivery.sent, delivery.retried, delivery.failed), (1, 2, 0))
+
+    def test_does_not_retry_client_errors(self):
+        with FakeKenarServer(statuses=[400]) as server:
+            delivery = self.make_queue(server)
+            delivery.submit("c1", b'{"text_message":"hello"}')
+            self.assertTrue(delivery.join(5))
+        self.assertEqual(len(server.received), 1)
+        self.assertEqual(delivery.failed, 1)
+
+    def test_coalesces_burst_per_conversation(self):
+        with FakeKenarServer(latency=0.2) as server:
+            delivery = self.make_queue(server, workers=4)
+            for i in range(5):
+                delivery.submit("c1", json.dumps({"text_message": f"state {i}"}).encode())
+            delivery.submit("c2", b'{"text_message":"other"}')
+            self.assertTrue(delivery.join(5))
+
+        texts = [
+            payload["text_message"] for path, _, payload in server.received if "/c1/" in path
+        ]
+        self.assertEqual(texts[-1], "state 4")
+        self.assertLessEqual(len(texts), 2)
+        self.assertEqual(len(server.received), len(texts) + 1)
+
+
+class AsyncChatbotClientTests(TestCase):
+    async def test_send_message_posts_payload(self):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(200, json={})
+
+        client = AsyncChatbotClient(api_key="key", base_url="http://kenar.test")
+        client.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        await client.send_message_with_buttons("c1", "hi", [])
+        await client.aclose()
+
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(
+            str(requests[0].url),
+            "http://kenar.test/experimental/open-platform/chat/bot/conversations/c1/messages",
+        )
+        self.assertEqual(requests[0].headers["X-API-Key"], "key")
+        self.assertEqual(json.loads(requests[0].content)["text_message"], "hi")
+
+    def test_client_of_a_finished_loop_is_closed(self):
+        async def get_client():
+            client = get_async_client()
+            await asyncio.sleep(0)
+            return client
+
+        first = asyncio.run(get_client())
+        second = asyncio.run(get_client())
+        self.assertIsNot(first, second)
+        self.assertTrue(first.client.is_closed)
+        self.assertFalse(second.client.is_closed)
+
+
+class AsyncWebhookTests(TestCase):
+    def setUp(self):
+        # Start every test with an empty dedup store, throttle and state cache
+        fresh = override_settings(
+            KENAR_DEDUP_BACKEND="memory",
+            KENAR_THROTTLE_BACKEND="memory",
+            XO_STATE_CACHE_SIZE=1000,
+        )
+        fresh.enable()
+        self.addCleanup(fresh.disable)
+
+        self.factory = AsyncRequestFactory()
+        self.client_mock = mock.AsyncMock()
+        patcher = mock.patch("chatbot.views.get_async_client", return_value=self.client_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("xo.views.get_async_client", return_value=self.client_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def post(self, view, data):
+        request = self.factory.post(
+            "/webhook/", data=json.dumps(data), content_type="application/json"
+        )
+        return await view.as_view()(request)
+
+    async def test_message_webhook_creates_game(self):
+        response = await self.post(AsyncMessageWebhookView, message_event("c1", "hi"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(await Game.objects.filter(conversation_id="c1").aexists())
+        self.client_mock.send_raw_message.assert_awaited_once()
+
+    async def test_restart_with_board_size(self):
+        await self.post(AsyncMessageWebhookView, message_event("c5", "/restart 5"))
+        game = await Game.objects.aget(conversation_id="c5")
+        self.assertEqual((game.size, game.win_length, game.board), (5, 4, "-" * 25))
+        await self.post(AsyncMessageWebhookView, message_event("c5", "/restart 9", "m2"))
+        game = await Game.objects.aget(conversation_id="c5")
+        self.assertEqual((game.size, game.board), (3, "-" * 9))
+
+    async def test_return_url_plays_turn(self):
+        game = await Game.objects.acreate(conversation_id="c2")
+        response = await self.post(
+            AsyncReturnUrlView, {"extra_data": {"game_id": str(game.id), "position": "0"}}
+        )
+        self.assertEqual(response.status_code, 200)
+        await game.arefresh_from_db()
+        self.assertEqual(game.board, "X---O----")
+
+    @override_settings(KENAR_DEDUP_BACKEND=None)
+    async def test_return_url_double_tap_conflicts(self):
+        game = await Game.objects.acreate(conversation_id="c3")
+        data = {"extra_data": {"game_id": str(game.id), "position": "0", "version": "0"}}
+        await self.post(AsyncReturnUrlView, data)
+        response = await self.post(AsyncReturnUrlView, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"out of date", response.content)
+        self.client_mock.send_raw_message.assert_awaited_once()
+
+    async def test_return_url_retry_answered_from_dedup(self):
+        game = await Game.objects.acreate(conversation_id="c4")
+        data = {"extra_data": {"game_id": str(game.id), "position": "0", "version": "0"}}
+        first = await self.post(AsyncReturnUrlView, data)
+        retry = await self.post(AsyncReturnUrlView, data)
+        self.assertEqual(retry.content, first.content)
+        self.client_mock.send_raw_message.assert_awaited_once()
+
+    async def test_return_url_rejects_taken_cell_without_db(self):
+        game = await Game.objects.acreate(conversation_id="c6")
+        await self.post(
+            AsyncReturnUrlView,
+            {"extra_data": {"game_id": str(game.id), "position": "0", "version": "0"}},
+        )
+        data = {"extra_data": {"game_id": str(game.id), "position": "4", "version": "1"}}
+        with mock.patch("xo.views.get_game_store") as store:
+            response = await self.post(AsyncReturnUrlView, data)
+        store.assert_not_called()
+        self.assertEqual(json.loads(response.content)["text_message"], TAKEN_MESSAGE)
+        self.client_mock.send_raw_message.assert_awaited_once()
+
+    async def test_return_url_taken_cell_on_cold_cache(self):
+        game = await Game.objects.acreate(conversation_id="c7", board="X---O----", version=1)
+        response = await self.post(
+            AsyncReturnUrlView,
+            {"extra_data": {"game_id": str(game.id), "position": "4", "version": "1"}},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["text_message"], TAKEN_MESSAGE)
+
+
+class ResilientClientTests(TestCase):
+    def setUp(self):
+        resilience.reset()
+        self.addCleanup(resilience.reset)
+        patcher = mock.patch.object(ChatbotClient, "base_delay", 0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_client(self, statuses, **kwargs):
+        self.calls = 0
+
+        def handler(request):
+            self.calls += 1
+            return httpx.Response(statuses.pop(0) if statuses else 200)
+
+        transport = httpx.Client(transport=httpx.MockTransport(handler))
+        return ChatbotClient("key", "http://kenar.test", client=transport, **kwargs)
+
+    def test_retries_server_errors(self):
+        client = self.make_client([503, 502])
+        self.assertEqual(client.send_raw_message("c1", b"{}").status_code, 200)
+        self.assertEqual(self.calls, 3)
+
+    def test_client_errors_are_not_retried(self):
+        client = self.make_client([400])
+        with self.assertRaises(KenarError):
+            client.send_raw_message("c1", b"{}")
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(resilience.get_circuit_breaker().state, resilience.CLOSED)
+
+    def test_retry_budget(self):
+        budget = resilience.RetryBudget(ratio=0.5, min_per_second=0.0, capacity=1.0)
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+    @override_settings(KENAR_BREAKER_THRESHOLD=2, KENAR_BREAKER_RESET=60.0)
+    def test_circuit_opens_and_fails_fast(self):
+        client = self.make_client([500, 500, 500], max_attempts=1)
+        for _ in range(2):
+            with self.assertRaises(KenarError):
+                client.send_raw_message("c1", b"{}")
+        with self.assertRaises(KenarUnavailable):
+            client.send_raw_message("c1", b"{}")
+        self.assertEqual(self.calls, 2)
+        self.assertIn("kenar_circuit_state 2", registry.render())
+
+    def test_half_open_lets_one_trial_through(self):
+        breaker = resilience.CircuitBreaker(failure_threshold=1, reset_timeout=0.0)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, resilience.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, resilience.CLOSED)
+
+    @override_settings(KENAR_BREAKER_THRESHOLD=1, KENAR_BREAKER_RESET=0.0)
+    def test_unexpected_errors_count_as_failures(self):
+        client = self.make_client([500], max_attempts=1)
+        with self.assertRaises(KenarError):
+            client.send_raw_message("c1", b"{}")
+        # The half open trial fails with something other than an httpx error
+        with mock.patch.object(client.client, "post", side_effect=TypeError("bad")):
+            with self.assertRaises(TypeError):
+                client.send_raw_message("c1", b"{}")
+        self.assertEqual(resilience.get_circuit_breaker().failures, 2)
+        self.assertIn('kenar_requests_total{outcome="TypeError"}', registry.render())
+
+    def test_webhook_fails_fast_when_circuit_open(self):
+        with mock.patch(
+            "chatbot.views.send_message", side_effect=KenarUnavailable("open")
+        ):
+            response = self.client.post(
+                "/chatbot/webhook/",
+                data=message_event("rc1", "hi", "rc-m1"),
+                content_type="application/json",
+            )
+        self.assertEqual(response.status_code, 503)
+
+
+class ThrottleTests(TestCase):
+    def test_bucket_allows_burst_then_rejects(self):
+        bucket = throttle.MemoryThrottle(rate=0.001, burst=2)
+        self.assertEqual([bucket.allow("k") for _ in range(3)], [True, True, False])
+        self.assertTrue(bucket.allow("other"))
+
+    def test_memory_is_bounded_and_idle_buckets_evicted(self):
+        bucket = throttle.MemoryThrottle(rate=0.001, burst=1, max_entries=3)
+        for i in range(10):
+            bucket.allow(f"k{i}")
+        self.assertEqual(len(bucket), 3)
+
+        bucket = throttle.MemoryThrottle(rate=1000.0, burst=1)
+        bucket.allow("a")
+        time.sleep(0.01)
+        bucket.allow("b")
+        self.assertEqual(len(bucket), 1)
+
+    @override_settings(KENAR_THROTTLE_BACKEND="memory")
+    def test_retry_of_tap_in_flight_gets_its_reply(self):
+        started, release = threading.Event(), threading.Event()
+
+        def play_tap(view, game_id, move, version):
+            started.set()
+            release.wait()
+            return snapshot(JsonResponse({"text_message": "played"})), None
+
+        def tap():
+            request = RequestFactory().post(
+                "/xo/webhook/",
+                data={"extra_data": {"game_id": "7", "position": "1", "version": "3"}},
+                content_type="application/json",
+            )
+            return json.loads(ReturnUrlView.as_view()(request).content)
+
+        with mock.patch.object(ReturnUrlView, "play_tap", play_tap):
+            with ThreadPoolExecutor(2) as pool:
+                first = pool.submit(tap)
+                started.wait()
+                retry = pool.submit(tap)
+                time.sleep(0.01)
+                release.set()
+        self.assertEqual(first.result(), {"text_message": "played"})
+        self.assertEqual(retry.result(), {"text_message": "played"})
+
+    @override_settings(KENAR_THROTTLE_BACKEND="cache", KENAR_THROTTLE_BURST=1)
+    def test_cache_backend(self):
+        shared = throttle.get_throttle()
+        self.assertIsInstance(shared, throttle.CacheThrottle)
+        key = f"cache-{time.time()}"
+        self.assertTrue(shared.allow(key))
+        self.assertFalse(shared.allow(key))
+
+    @override_settings(KENAR_THROTTLE_BACKEND="memory", KENAR_THROTTLE_BURST=1)
+    def test_excess_taps_rejected_before_db(self):
+        game = Game.objects.create(conversation_id="th1")
+        with mock.patch("xo.views.send_message"):
+            self.client.post(
+                "/xo/webhook/",
+                data={"extra_data": {"game_id": str(game.id), "position": "0", "version": "0"}},
+                content_type="application/json",
+            )
+            with self.assertNumQueries(0):
+                response = self.client.post(
+                    "/xo/webhook/",
+                    data={"extra_data": {"game_id": str(game.id), "position": "1", "version": "1"}},
+                    content_type="application/json",
+                )
+        self.assertEqual(response.json(), {"text_message": THROTTLED_MESSAGE})
+        self.assertIn(
+            'webhook_throttled_total{reason="rejected",webhook="move"}', registry.render()
+        )
+
+
+class DedupTests(TestCase):
+    def setUp(self):
+        dedup = override_settings(KENAR_DEDUP_BACKEND="memory")
+        dedup.enable()
+        self.addCleanup(dedup.disable)
+
+        patcher = mock.patch("chatbot.views.send_message")
+        self.send_message = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_message(self, message_id, conversation_id="d1"):
+        return self.client.post(
+            "/chatbot/webhook/",
+            data=message_event(conversation_id, "hi", message_id),
+            content_type="application/json",
+        )
+
+    def test_retried_message_is_not_processed_again(self):
+        self.assertEqual(self.post_message("m1").status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.post_message("m1").status_code, 200)
+        self.assertEqual(self.send_message.call_count, 1)
+        self.post_message("m2")
+        self.assertEqual(self.send_message.call_count, 2)
+
+    @override_settings(KENAR_DEDUP_BACKEND="database")
+    def test_database_backend(self):
+        self.post_message("m1")
+        self.post_message("m1")
+        self.assertEqual(self.send_message.call_count, 1)
+        self.assertTrue(ProcessedWebhook.objects.filter(key="message:m1").exists())
+
+    @override_settings(KENAR_DEDUP_BACKEND="database", KENAR_DEDUP_TTL=60)
+    def test_expired_rows_are_purged_by_the_sweeper(self):
+        self.post_message("m1", "d2")
+        self.post_message("m2", "d2")
+        ProcessedWebhook.objects.filter(key="message:m1").update(
+            created_at=timezone.now() - timedelta(seconds=120)
+        )
+        out = io.StringIO()
+        call_command("sweep_games", stdout=out)
+        self.assertIn("purged 1 webhook responses", out.getvalue())
+        self.assertEqual(
+            list(ProcessedWebhook.objects.values_list("key", flat=True)), ["message:m2"]
+        )
+
+    def test_memory_store_is_bounded(self):
+        store = MemoryDedupStore(max_entries=2, ttl=60)
+        for key in "abc":
+            store.set(key, (200, b"", "text/plain"))
+        self.assertEqual(len(store), 2)
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.get("c"), (200, b"", "text/plain"))
+
+
+class SchedulerTests(TestCase):
+    def test_runs_one_event_per_key_in_order(self):
+        scheduler = Scheduler()
+        started, order = threading.Event(), []
+
+        def first():
+            started.set()
+            time.sleep(0.05)
+            order.append("first")
+
+        with ThreadPoolExecutor(3) as pool:
+            pool.submit(scheduler.run, "c", first)
+            started.wait()
+            pool.submit(scheduler.run, "c", lambda: order.append("second"))
+            time.sleep(0.01)
+            pool.submit(scheduler.run, "other", lambda: order.append("other"))
+        self.assertEqual(order, ["other", "first", "second"])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_folds_pending_event_with_same_key(self):
+        scheduler = Scheduler()
+        started, release, calls = threading.Event(), threading.Event(), []
+
+        def tap():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return len(calls)
+
+        with ThreadPoolExecutor(2) as pool:
+            leader = pool.submit(scheduler.run, "c", tap, "move:1")
+            started.wait()
+            follower = pool.submit(scheduler.run, "c", tap, "move:1")
+            time.sleep(0.01)
+            release.set()
+        self.assertEqual((leader.result(), follower.result()), (1, 1))
+        self.assertEqual(len(calls), 1)
+
+    def test_folded_event_gets_the_error(self):
+        scheduler = Scheduler()
+        started, release = threading.Event(), threading.Event()
+
+        def fail():
+            started.set()
+            release.wait()
+            raise ValueError("boom")
+
+        with ThreadPoolExecutor(2) as pool:
+            leader = pool.submit(scheduler.run, "c", fail, "k")
+            started.wait()
+            follower = pool.submit(scheduler.run, "c", fail, "k")
+            time.sleep(0.01)
+            release.set()
+        self.assertRaises(ValueError, leader.result)
+        self.assertRaises(ValueError, follower.result)
+        self.assertIsNot(leader.exception(), follower.exception())
+        self.assertIs(follower.exception().__cause__, leader.exception())
+
+    def test_learned_alias_shares_the_mailbox(self):
+        scheduler = Scheduler(max_aliases=1)
+        scheduler.learn("game:1", "conversation:c")
+        self.assertEqual(scheduler.resolve("game:1"), "conversation:c")
+        scheduler.learn("game:2", "conversation:d")
+        self.assertEqual(scheduler.resolve("game:1"), "game:1")
+
+    def test_alias_learned_mid_event_waits_for_its_mailbox(self):
+        scheduler = Scheduler()
+        started, order = threading.Event(), []
+
+        def first():
+            # A tap with no message before it, learning its conversation
+            scheduler.learn("game:1", "conversation:c")
+            started.set()
+            time.sleep(0.05)
+            order.append("first")
+
+        with ThreadPoolExecutor(2) as pool:
+            pool.submit(scheduler.run, "game:1", first)
+            started.wait()
+            pool.submit(scheduler.run, "game:1", lambda: order.append("second"))
+        self.assertEqual(order, ["first", "second"])
+        self.assertEqual(scheduler.resolve("game:1"), "conversation:c")
+
+    def test_async_events_are_ordered(self):
+        scheduler = Scheduler()
+        order = []
+
+        async def event(name, delay):
+            await asyncio.sleep(delay)
+            order.append(name)
+
+        async def main():
+            await asyncio.gather(
+                scheduler.arun("c", lambda: event("first", 0.02)),
+                scheduler.arun("c", lambda: event("second", 0)),
+            )
+
+        asyncio.run(main())
+        self.assertEqual(order, ["first", "second"])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_cancelled_events_give_up_their_place(self):
+        scheduler = Scheduler()
+        order = []
+
+        async def event(name, delay=0):
+            await asyncio.sleep(delay)
+            order.append(name)
+            return name
+
+        async def main():
+            first = asyncio.ensure_future(scheduler.arun("c", lambda: event("first", 0.02)))
+            await asyncio.sleep(0)
+            # A queued event whose client went away, and a retry folded into it
+            gone = asyncio.ensure_future(scheduler.arun("c", lambda: event("gone"), "k"))
+            retry = asyncio.ensure_future(scheduler.arun("c", lambda: event("retry"), "k"))
+            cancelled = asyncio.ensure_future(scheduler.arun("c", lambda: event("never")))
+            await asyncio.sleep(0)
+            gone.cancel()
+            cancelled.cancel()
+            last = scheduler.arun("c", lambda: event("last"))
+            return await asyncio.wait_for(asyncio.gather(first, retry, last), 1)
+
+        self.assertEqual(asyncio.run(main()), ["first", "retry", "last"])
+        self.assertEqual(order, ["first", "retry", "last"])
+        self.assertEqual(len(scheduler), 0)
+
+
+@override_settings(
+    KENAR_DEDUP_BACKEND="memory", KENAR_THROTTLE_BACKEND="memory", XO_STATE_CACHE_SIZE=1000
+)
+class ScheduledTapTests(TransactionTestCase):
+    def tap(self, game_id, position, version):
+        request = RequestFactory().post(
+            "/xo/webhook/",
+            data={"extra_data": {"game_id": game_id, "position": position, "version": version}},
+            content_type="application/json",
+        )
+        return json.loads(ReturnUrlView.as_view()(request).content)["text_message"]
+
+    def test_board_is_sent_outside_the_mailbox(self):
+        game = Game.objects.create(conversation_id="s1")
+        sending, release = threading.Event(), threading.Event()
+
+        def send_message(conversation_id, content):
+            sending.set()
+            release.wait()
+
+        with mock.patch("xo.views.send_message", side_effect=send_message):
+            with ThreadPoolExecutor(2) as pool:
+                try:
+                    first = pool.submit(self.tap, str(game.id), "0", "0")
+                    sending.wait()
+                    # Answered while the first tap's board is still on its way
+                    stale = pool.submit(self.tap, str(game.id), "1", "0")
+                    self.assertEqual(stale.result(timeout=1), CONFLICT_MESSAGE)
+                    self.assertFalse(first.done())
+                finally:
+                    release.set()
+        self.assertNotIn(first.result(), (CONFLICT_MESSAGE, TAKEN_MESSAGE))
+
+    def test_taps_on_one_board_fold_into_one_turn(self):
+        game = Game.objects.create(conversation_id="s2")
+        started, release = threading.Event(), threading.Event()
+        play_turn = ReturnUrlView.play_turn
+
+        def slow_turn(view, *args):
+            started.set()
+            release.wait()
+            return play_turn(view, *args)
+
+        with mock.patch.object(ReturnUrlView, "play_turn", slow_turn), mock.patch(
+            "xo.views.send_message"
+        ) as send:
+            with ThreadPoolExecutor(3) as pool:
+                first = pool.submit(self.tap, str(game.id), "0", "0")
+                started.wait()
+                others = [pool.submit(self.tap, str(game.id), p, "0") for p in ("1", "2")]
+                time.sleep(0.02)
+                release.set()
+        self.assertEqual({other.result() for other in others}, {first.result()})
+        send.assert_called_once()
+        game.refresh_from_db()
+        self.assertEqual((game.version, game.board[0]), (1, "X"))
+
+
+class MetricsTests(TestCase):
+    def test_webhook_stages_are_exposed(self):
+        with mock.patch("chatbot.views.send_message"):
+            self.client.post(
+                "/chatbot/webhook/",
+                data=message_event("mt1", "hi", "mt-m1"),
+                content_type="application/json",
+            )
+        body = self.client.get("/metrics").content.decode()
+        self.assertIn('xo_stage_seconds_count{stage="parse"}', body)
+        self.assertIn('xo_stage_seconds_count{stage="game_load"}', body)
+        self.assertIn('http_request_queries_count{view="message-webhook"}', body)
+        self.assertIn('http_request_seconds_count{status="200",view="message-webhook"}', body)
+
+    def test_outbound_outcomes_are_counted(self):
+        def handler(request):
+            return httpx.Response(503)
+
+        client = ChatbotClient(api_key="key", base_url="http://kenar.test")
+        client.client = httpx.Client(transport=httpx.MockTransport(handler))
+        with self.assertRaises(Exception):
+            client.send_raw_message("c1", b"{}")
+        self.assertIn('kenar_requests_total{outcome="503"}', registry.render())
+
+    def test_metrics_are_local_only(self):
+        response = self.client.get("/metrics", REMOTE_ADDR="10.0.0.1")
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(METRICS_TOKEN="s3cret")
+    def test_metrics_token(self):
+        for path in ("/metrics", "/xo/stats/"):
+            # Behind a local proxy every request is from 127.0.0.1
+            self.assertEqual(self.client.get(path).status_code, 403)
+            response = self.client.get(path, HTTP_AUTHORIZATION="Bearer s3cret")
+            self.assertEqual(response.status_code, 200)
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def post_message(self, message_id):
+        return self.client.post(
+            "/chatbot/webhook/",
+            data=message_event("p1", "hi", message_id),
+            content_type="application/json",
+        )
+
+    def profiles(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_sampled_requests_are_written_as_pstats(self):
+        with self.settings(PROFILE_SAMPLE_RATE=1.0, PROFILE_DIR=self.directory, PROFILE_KEEP=1):
+            with mock.patch("chatbot.views.send_message"):
+                self.post_message("p-m1")
+                self.post_message("p-m2")
+                self.client.get("/metrics")
+        profiles = self.profiles()
+        self.assertEqual(len(profiles), 1)
+        self.assertRegex(profiles[0], r"-message-webhook-\d+ms-sampled\.prof$")
+        stats = pstats.Stats(os.path.join(self.directory, profiles[0]))
+        self.assertTrue(any(name == "handle_message" for _, _, name in stats.stats))
+
+    def test_slow_requests_are_stack_sampled(self):
+        def slow_send(conversation_id, content):
+            time.sleep(0.05)
+
+        with self.settings(
+            PROFILE_SLOW_AFTER=0.01, PROFILE_INTERVAL=0.001, PROFILE_DIR=self.directory
+        ):
+            with mock.patch("chatbot.views.send_message", side_effect=slow_send):
+                self.post_message("p-m3")
+        [profile] = self.profiles()
+        self.assertTrue(profile.endswith("-slow.prof"))
+        stats = pstats.Stats(os.path.join(self.directory, profile)).stats
+        self.assertTrue(any(name == "slow_send" for _, _, name in stats))
+
+    def test_other_views_are_not_profiled(self):
+        with self.settings(
+            PROFILE_SAMPLE_RATE=1.0, PROFILE_SLOW_AFTER=0.0, PROFILE_DIR=self.directory
+        ):
+            with mock.patch("ehsandar.middleware.RequestProfiler.start") as start, mock.patch(
+                "ehsandar.middleware.StackSampler.begin"
+            ) as begin:
+                self.client.get("/metrics")
+                self.client.get("/no-such-page")
+        start.assert_not_called()
+        begin.assert_not_called()
+        self.assertEqual(self.profiles(), [])
+
+    def test_off_by_default(self):
+        with self.settings(PROFILE_DIR=self.directory):
+            with mock.patch("chatbot.views.send_message"):
+                self.post_message("p-m4")
+        self.assertEqual(self.profiles(), [])
+        self.assertEqual(samples_to_stats(Counter(), 0.01), {})
+
+
+@override_settings(DB_SERIALIZED_WRITES=True, DB_WRITE_BATCH_SIZE=8)
+class SerializedWriterTests(TransactionTestCase):
+    def test_concurrent_writes_are_batched(self):
+        def create(index):
+            return write(Game.objects.create, conversation_id=f"w{index}").pk
+
+        with ThreadPoolExecutor(8) as pool:
+            ids = list(pool.map(create, range(64)))
+        self.assertEqual(len(set(ids)), 64)
+        self.assertEqual(Game.objects.count(), 64)
+        self.assertIn("db_write_batch_size_count", registry.render())
+
+    def test_failed_write_does_not_undo_batch(self):
+        writer = get_writer()
+        first = writer.submit(Game.objects.create, conversation_id="dup")
+        second = writer.submit(Game.objects.create, conversation_id="dup")
+        third = writer.submit(Game.objects.create, conversation_id="other")
+        first.result()
+        with self.assertRaises(IntegrityError):
+            second.result()
+        third.result()
+        self.assertEqual(Game.objects.count(), 2)
+
+    def test_writer_queries_count_for_the_caller(self):
+        with count_queries() as queries:
+            write(Game.objects.create, conversation_id="counted")
+        self.assertGreaterEqual(queries[0], 1)
+        with count_queries() as queries:
+            write(Game.objects.count)
+            with count_queries() as inner:
+                get_writer().submit(Game.objects.count).result()
+        self.assertEqual((queries[0], inner[0]), (2, 1))
+
+
+class WebhookProfileTests(TestCase):
+    def test_warm_up_steps(self):
+        timings = warm(freeze=False)
+        self.assertEqual(
+            set(timings), {"urls", "engine_tables", "geometries", "ssl_context"}
+        )
+
+    @override_settings(MIDDLEWARE=settings_webhook.MIDDLEWARE)
+    def test_webhook_with_lean_middleware(self):
+        self.assertEqual(settings_webhook.INSTALLED_APPS, ["chatbot", "xo"])
+        with mock.patch("chatbot.views.send_message") as send:
+            response = self.client.post(
+                "/chatbot/webhook/",
+                data=message_event("lean1", "hi", "lean-m1"),
+                content_type="application/json",
+            )
+        self.assertEqual(response.status_code, 200)
+        send.assert_called_once()
+
+
+class LoggingTests(TestCase):
+    def make_logger(self):
+        stream = io.StringIO()
+        handler = BackgroundHandler(stream=stream)
+        handler.setFormatter(JsonFormatter())
+        logger = logging.getLogger("chatbot.tests.logging")
+        logger.handlers = [handler]
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+        self.addCleanup(handler.close)
+        return logger, handler, stream
+
+    def test_background_handler_writes_json_lines(self):
+        logger, handler, stream = self.make_logger()
+        logger.info("turn %s", 3, extra={"conversation_id": "c1"})
+        handler.close()
+        record = json.loads(stream.getvalue())
+        self.assertEqual(record["message"], "turn 3")
+        self.assertEqual(record["conversation_id"], "c1")
+
+    @unittest.skipUnless(hasattr(os, "fork"), "needs fork")
+    def test_forked_child_restarts_the_writer(self):
+        with tempfile.TemporaryFile("w+") as stream:
+            handler = BackgroundHandler(stream=stream)
+            handler.setFormatter(JsonFormatter())
+            logger = logging.getLogger("chatbot.tests.fork")
+            logger.handlers = [handler]
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            self.addCleanup(handler.close)
+            # Like logging configured in a preloading master
+            logger.info("parent")
+            handler.queue.join()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    logger.info("child")
+                    handler.close()
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+            handler.close()
+            stream.seek(0)
+            messages = [json.loads(line)["message"] for line in stream]
+        self.assertEqual(sorted(messages), ["child", "parent"])
+
+    @override_settings(LOG_PAYLOAD_SAMPLE_RATE=0.0)
+    def test_payload_sampling_and_level_gating(self):
+        logger, handler, stream = self.make_logger()
+        payload = mock.MagicMock()
+        log_payload(logger, logging.DEBUG, "debug dump", payload)
+        log_payload(logger, logging.INFO, "unsampled", {"a": 1})
+        with override_settings(LOG_PAYLOAD_SAMPLE_RATE=1.0):
+            log_payload(logger, logging.INFO, "sampled", {"a": 1})
+        handler.close()
+
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([record["message"] for record in records], ["unsampled", "sampled"])
+        self.assertNotIn("payload", records[0])
+        self.assertEqual(records[1]["payload"], {"a": 1})
+        self.assertEqual(payload.mock_calls, [])
@@ -0,0 +1,171 @@
+"""
+Per-conversation throttling for the webhooks.
+
+A user hammering the board buttons sends one callback per tap, and each
+one would load the game, save it and call Kenar. Both webhook views check
+a token bucket keyed by the game (button callbacks) or the conversation
+(messages) right after parsing, before any DB or network work. Each key
+gets KENAR_THROTTLE_BURST taps at once, refilled at KENAR_THROTTLE_RATE
+per second. Taps over that are rejected. Taps arriving while an earlier
+one is still being handled are left to chatbot.scheduler, which queues
+them and folds retries into the tap they repeat.
+
+MemoryThrottle keeps buckets in a bounded LRU per process. Buckets idle
+long enough to refill completely are dropped, since a full bucket is the
+same as no bucket. CacheThrottle keeps them in a Django cache (e.g. Redis)
+shared by all workers. Its read-modify-write isn't atomic, so concurrent
+taps on one key may slip through. That's fine for shedding load.
+Rejections are counted in webhook_throttled_total.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from ehsandar.metrics import registry
+
+ALLOWED, REJECTED = "allowed", "rejected"
+
+
+def game_key(game_id) -> str:
+    return f"game:{game_id}"
+
+
+def conversation_key(conversation_id) -> str:
+    return f"conversation:{conversation_id}"
+
+
+def record(webhook: str, reason: str):
+    registry.counter(
+        "webhook_throttled_total",
+        "Webhook requests shed before any DB or network work",
+        webhook=webhook,
+        reason=reason,
+    ).inc()
+
+
+class Throttle:
+    """Token bucket bookkeeping shared by the backends"""
+
+    def __init__(self, rate: float = 2.0, burst: float = 5.0):
+        self.rate = rate
+        self.burst = burst
+
+    def _take(
+        self, bucket: Optional[List[float]], now: float
+    ) -> Tuple[float, float, bool]:
+        """
+        Refill bucket ([tokens, updated]) to now and take a token if there is
+        one. Returns (tokens, now, allowed)
+        """
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        allowed = tokens >= 1.0
+        return (tokens - 1.0 if allowed else tokens), now, allowed
+
+    def allow(self, key: str) -> bool:
+        return True
+
+    @property
+    def idle_time(self) -> float:
+        """Seconds after which an unused bucket is full again"""
+        return self.burst / self.rate if self.rate else float("inf")
+
+    def acquire(self, key: str, webhook: str) -> str:
+        """ALLOWED or REJECTED for a request on key"""
+        if self.allow(key):
+            return ALLOWED
+        record(webhook, REJECTED)
+        return REJECTED
+
+
+class NoThrottle(Throttle):
+    def acquire(self, key: str, webhook: str) -> str:
+        return ALLOWED
+
+
+class MemoryThrottle(Throttle):
+    """Token buckets in a bounded LRU, idle buckets are evicted"""
+
+    def __init__(self, rate: float = 2.0, burst: float = 5.0, max_entries: int = 100000):
+        super().__init__(rate, burst)
+        self.max_entries = max_entries
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, key: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, allowed = self._take(self._buckets.pop(key, None), now)
+            self._buckets[key] = [tokens, updated]
+            # Least recently used first, drop the ones that are full again anyway
+            idle_before = now - self.idle_time
+            while self._buckets:
+                oldest = next(iter(self._buckets.values()))
+                if len(self._buckets) <= self.max_entries and oldest[1] > idle_before:
+                    break
+                self._buckets.popitem(last=False)
+        return allowed
+
+
+class CacheThrottle(Throttle):
+    """Token buckets in a Django cache shared by every worker"""
+
+    def __init__(self, rate: float = 2.0, burst: float = 5.0, alias: str = "default"):
+        super().__init__(rate, burst)
+        self.cache = caches[alias]
+
+    def allow(self, key: str) -> bool:
+        key = f"throttle:{key}"
+        # Wall clock since the bucket is shared between processes
+        tokens, updated, allowed = self._take(self.cache.get(key), time.time())
+        self.cache.set(key, [tokens, updated], timeout=max(1, int(self.idle_time) + 1))
+        return allowed
+
+
+_throttle: Optional[Throttle] = None
+_throttle_lock = threading.Lock()
+
+
+def get_throttle() -> Throttle:
+    """
+    Return the process-wide throttle for settings.KENAR_THROTTLE_BACKEND,
+    "memory", "cache", or None to disable throttling
+    """
+    global _throttle
+    with _throttle_lock:
+        if _throttle is None:
+            backend = getattr(settings, "KENAR_THROTTLE_BACKEND", "memory")
+            rate = getattr(settings, "KENAR_THROTTLE_RATE", 2.0)
+            burst = getattr(settings, "KENAR_THROTTLE_BURST", 5)
+            if backend is None:
+                _throttle = NoThrottle(rate, burst)
+            elif backend == "memory":
+                _throttle = MemoryThrottle(
+                    rate, burst, max_entries=getattr(settings, "KENAR_THROTTLE_SIZE", 100000)
+                )
+            elif backend == "cache":
+                _throttle = CacheThrottle(
+                    rate, burst, alias=getattr(settings, "KENAR_THROTTLE_CACHE", "default")
+                )
+            else:
+                raise ValueError(f"Unknown throttle backend: {backend}")
+        return _throttle
+
+
+@receiver(setting_changed)
+def _reset_throttle(setting, **kwargs):
+    global _throttle
+    if setting.startswith("KENAR_THROTTLE_"):
+        _throttle = None
@@ -1,7 +1,14 @@
+from django.conf import settings
 from django.urls import path
-from .views import MessageWebhookView
+from .views import AsyncMessageWebhookView, MessageWebhookView
+
+# Serve the async view when running under ASGI with KENAR_ASYNC_WEBHOOKS
+webhook_view = (
+    AsyncMessageWebhookView
+    if getattr(settings, "KENAR_ASYNC_WEBHOOKS", False)
+    else MessageWebhookView
+)
 
 urlpatterns = [
-    path('webhook/', MessageWebhookView.as_view(), name='message-webhook'),
+    path('webhook/', webhook_view.as_view(), name='message-webhook'),
 ]
-
@@ -1,11 +1,22 @@
+from django.conf import settings
 from django.http import JsonResponse, HttpResponse
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from xo.models import Game
-from .client import ChatbotClient
+from asgiref.sync import sync_to_async
+from xo.store import get_game_store
+from xo.validation import get_state_cache
+from .client import KenarError, KenarUnavailable, get_async_client
+from .dedup import get_dedup_store, message_key
+from .delivery import send_message
+from .scheduler import aschedule, learn, schedule
+from .throttle import ALLOWED, conversation_key, game_key, get_throttle
+from ehsandar.log import log_payload
+from ehsandar.metrics import timer
 import json
-import os
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 @method_decorator(csrf_exempt, name="dispatch")
@@ -41,6 +52,64 @@ class MessageWebhookView(View):
         except (KeyError, TypeError, ValueError):
             return False
 
+    def load_game(self, conversation_id, text):
+        store = get_game_store()
+
+        # Handle restart command, "/restart 4" starts a 4x4 game
+        words = text.strip().lower().split()
+        if words and words[0] == "/restart":
+            sizes = getattr(settings, "XO_BOARD_SIZES", {3: 3})
+            size = int(words[1]) if len(words) > 1 and words[1].isdigit() else 3
+            if size not in sizes:
+                size = 3
+            return store.restart(conversation_id, size, sizes.get(size, 3))
+
+        # Get or create game normally
+        return store.get_or_create(conversation_id)
+
+    def play_message(self, conversation_id, text):
+        """Load or restart the game and render its board, run in the conversation's turn"""
+        game = self.load_game(conversation_id, text)
+        get_state_cache().remember(game)
+        learn(game_key(game.ref), conversation_key(conversation_id))
+
+        # Get game status message
+        with timer("render"):
+            return game.render_message(game.get_status_message())
+
+    def handle_message(self, data):
+        """Play a message in the conversation's turn, then send the board"""
+        # Answer retried events from the response already sent
+        dedup = get_dedup_store()
+        key = message_key(data)
+        with timer("dedup"):
+            duplicate = dedup.lookup(key)
+        if duplicate is not None:
+            return duplicate
+
+        conversation_id = data["new_chatbot_message"]["conversation"]["id"]
+        text = data["new_chatbot_message"]["text"]
+
+        # One game update at a time per conversation, so a /restart doesn't
+        # race the taps on the game it resets. The send runs after it, and
+        # retries folded into an event still queued send nothing
+        content = None
+
+        def play():
+            nonlocal content
+            content = self.play_message(conversation_id, text)
+
+        schedule(conversation_key(conversation_id), play, fold_key=key)
+        response = HttpResponse(status=200)
+        if content is None:
+            return response
+
+        # Send the cached board payload, inline or through the delivery queue
+        with timer("outbound"):
+            send_message(conversation_id, content)
+        dedup.remember(key, response)
+        return response
+
     def post(self, request, *args, **kwargs):
         # Check Content-Type header
         content_type = request.headers.get("Content-Type", "")
@@ -49,66 +118,92 @@ class MessageWebhookView(View):
 
         try:
             # Parse JSON data from request body
-            data = json.loads(request.body)
+            with timer("parse"):
+                data = json.loads(request.body)
 
             # Validate message structure
             if not self.validate_message_structure(data):
-                print(data)
+                log_payload(logger, logging.INFO, "invalid message structure", data)
                 return JsonResponse({"error": "Invalid message structure"}, status=400)
 
-            # Extract relevant information
+            # Shed message storms before any DB or network work, answered
+            # with 200 so Kenar doesn't retry them
             conversation_id = data["new_chatbot_message"]["conversation"]["id"]
-            text = data["new_chatbot_message"]["text"]
-
-            # Handle restart command
-            if text.strip().lower().startswith("/restart"):
-                # Delete existing game if it exists
-                Game.objects.filter(conversation_id=conversation_id).delete()
-                # Create new game
-                game = Game.objects.create(
-                    conversation_id=conversation_id,
-                )
-            else:
-                # Get or create game normally
-                game, created = Game.objects.get_or_create(
-                    conversation_id=conversation_id,
-                )
-
-            # Initialize chatbot client
-            client = ChatbotClient(
-                api_key=os.environ.get("KENAR_API_KEY"),
-            )
-
-            # Get game status message
-            status_message = (
-                "Your turn! Select a position to play: (you can reset with /restart)"
-            )
-            if game.status == "X_WON":
-                status_message = "Game Over - You Won! 🎉"
-            elif game.status == "O_WON":
-                status_message = "Game Over - Bot Won! 🤖"
-            elif game.status == "DRAW":
-                status_message = "Game Over - It's a Draw! 🤝"
-
-            game_button_grid = game.get_button_grid()
-            print("game button grid created")
-            print(game_button_grid)
-
-            # Get button grid from game and send message
-            try:
-                client.send_message_with_buttons(
-                    conversation_id=conversation_id,
-                    message=status_message,
-                    buttons_data=game_button_grid,
-                )
-            finally:
-                client.close()
-
-            return HttpResponse(status=200)
+            if get_throttle().acquire(conversation_key(conversation_id), "message") != ALLOWED:
+                return HttpResponse(status=200)
+
+            return self.handle_message(data)
+
+        except KenarError as e:
+            # Kenar failed or its circuit is open, answer now instead of 500
+            logger.warning("reply not sent", extra={"error": str(e)})
+            return HttpResponse(status=503 if isinstance(e, KenarUnavailable) else 502)
+        except json.JSONDecodeError:
+            logger.info("invalid json body")
+            return HttpResponse(status=400)
+        except Exception:
+            logger.exception("message webhook failed")
+            return HttpResponse(status=500)
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncMessageWebhookView(MessageWebhookView):
+    """
+    Async MessageWebhookView for ASGI deployments. Sends through the shared
+    pooled AsyncChatbotClient instead of opening a client per request.
+    """
+
+    async def ahandle_message(self, data):
+        dedup = get_dedup_store()
+        key = message_key(data)
+        with timer("dedup"):
+            duplicate = await dedup.alookup(key)
+        if duplicate is not None:
+            return duplicate
+
+        conversation_id = data["new_chatbot_message"]["conversation"]["id"]
+        text = data["new_chatbot_message"]["text"]
+
+        content = None
+
+        async def play():
+            nonlocal content
+            content = await sync_to_async(self.play_message)(conversation_id, text)
+
+        await aschedule(conversation_key(conversation_id), play, fold_key=key)
+        response = HttpResponse(status=200)
+        if content is None:
+            return response
+
+        with timer("outbound"):
+            await get_async_client().send_raw_message(conversation_id, content)
+        await dedup.aremember(key, response)
+        return response
+
+    async def post(self, request, *args, **kwargs):
+        content_type = request.headers.get("Content-Type", "")
+        if "application/json" not in content_type.lower():
+            return HttpResponse(status=415)
+
+        try:
+            with timer("parse"):
+                data = json.loads(request.body)
+
+            if not self.validate_message_structure(data):
+                return JsonResponse({"error": "Invalid message structure"}, status=400)
+
+            conversation_id = data["new_chatbot_message"]["conversation"]["id"]
+            if get_throttle().acquire(conversation_key(conversation_id), "message") != ALLOWED:
+                return HttpResponse(status=200)
+
+            return await self.ahandle_message(data)
 
+        except KenarError as e:
+            # Kenar failed or its circuit is open, answer now instead of 500
+            logger.warning("reply not sent", extra={"error": str(e)})
+            return HttpResponse(status=503 if isinstance(e, KenarUnavailable) else 502)
         except json.JSONDecodeError:
-            print("dsaads")
             return HttpResponse(status=400)
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception("message webhook failed")
             return HttpResponse(status=500)
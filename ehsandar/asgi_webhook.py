@@ -0,0 +1,19 @@
+"""
+ASGI entry point for webhook-only workers.
+
+Uses ehsandar.settings_webhook and warms the engine tables, geometries and
+TLS context at import, before the server forks its workers. Set
+KENAR_ASYNC_WEBHOOKS to serve the async views.
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ehsandar.settings_webhook')
+
+application = get_asgi_application()
+
+from .warmup import warm  # noqa: E402
+
+warm()
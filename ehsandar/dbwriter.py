@@ -0,0 +1,154 @@
+"""
+Serialized database writer.
+
+SQLite allows one writer at a time, so with several request threads each
+doing its own small write transaction they mostly wait on each other and
+eventually fail with "database is locked". With DB_SERIALIZED_WRITES on,
+write() hands the write to a single writer thread instead. The writer
+drains whatever has queued up (up to DB_WRITE_BATCH_SIZE writes) and runs
+it in one transaction, each write in its own savepoint so one failing write
+doesn't undo the others. Callers block until their write is committed and
+get its return value or exception back. Writes run in a copy of the
+caller's context (contextvars). Each database alias gets its own writer,
+see write_using.
+
+    write(game.save_turn)
+"""
+
+import atexit
+import contextvars
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.dispatch import receiver
+
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+class Writer:
+    def __init__(self, batch_size: int = 64, using: str = DEFAULT_DB_ALIAS):
+        self.batch_size = batch_size
+        self.using = using
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name=f"db-writer-{using}", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        context = contextvars.copy_context()
+        self._queue.put((future, context.run, (fn, *args), kwargs))
+        return future
+
+    def call(self, fn, *args, **kwargs):
+        return self.submit(fn, *args, **kwargs).result()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self._queue.put(None)
+                    break
+                batch.append(job)
+            self._write(batch)
+        connections[self.using].close()
+
+    def _write(self, batch):
+        registry.histogram(
+            "db_write_batch_size", "Writes committed per writer transaction", BATCH_BUCKETS
+        ).observe(len(batch))
+        results = []
+        try:
+            with transaction.atomic(using=self.using):
+                for future, fn, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with transaction.atomic(using=self.using):
+                            results.append((future, fn(*args, **kwargs), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            # The commit failed, none of the batch was written
+            logger.exception(
+                "write batch failed", extra={"writes": len(batch), "database": self.using}
+            )
+            connections[self.using].close()
+            for future, result, error in results:
+                future.set_exception(error or e)
+            return
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+_writers: Dict[str, Writer] = {}
+_writer_lock = threading.Lock()
+
+
+def get_writer(using: str = DEFAULT_DB_ALIAS) -> Optional[Writer]:
+    """Process-wide writer for the using database, None unless DB_SERIALIZED_WRITES is on"""
+    if not getattr(settings, "DB_SERIALIZED_WRITES", False):
+        return None
+    writer = _writers.get(using)
+    if writer is None:
+        with _writer_lock:
+            writer = _writers.get(using)
+            if writer is None:
+                writer = _writers[using] = Writer(
+                    getattr(settings, "DB_WRITE_BATCH_SIZE", 64), using
+                )
+                atexit.register(writer.stop)
+    return writer
+
+
+def write_using(using: str, fn, *args, **kwargs):
+    """
+    Run a write on the using database through its serialized writer, or
+    inline when it's off. Writes made inside a transaction stay inline so
+    they see that transaction's changes.
+    """
+    writer = get_writer(using)
+    if writer is None or connections[using].in_atomic_block:
+        return fn(*args, **kwargs)
+    return writer.call(fn, *args, **kwargs)
+
+
+def write(fn, *args, **kwargs):
+    """write_using on the default database"""
+    return write_using(DEFAULT_DB_ALIAS, fn, *args, **kwargs)
+
+
+@receiver(setting_changed)
+def _reset_writer(setting, **kwargs):
+    if setting in ("DB_SERIALIZED_WRITES", "DB_WRITE_BATCH_SIZE"):
+        with _writer_lock:
+            writers = list(_writers.values())
+            _writers.clear()
+        for writer in writers:
+            writer.stop()
@@ -0,0 +1,117 @@
+"""
+Non-blocking structured logging.
+
+BackgroundHandler puts records on a bounded queue and a QueueListener
+thread formats and writes them, so request threads never block on stdout.
+Records are dropped (and counted) rather than blocking when the queue is
+full. The listener starts on the first record, and again in a forked
+child (e.g. a gunicorn --preload worker), where the parent's thread is
+gone. JsonFormatter writes one JSON object per line including any extra
+fields. log_payload gates on the logger level before doing any work and
+only attaches the payload to a LOG_PAYLOAD_SAMPLE_RATE fraction of records.
+"""
+
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import weakref
+from datetime import datetime, timezone
+from functools import partial
+from logging.handlers import QueueHandler, QueueListener
+
+from django.conf import settings
+
+# Attributes every LogRecord has, anything else came in through extra=
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class BackgroundHandler(QueueHandler):
+    def __init__(self, stream=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.maxsize = maxsize
+        self.target = logging.StreamHandler(stream or sys.stderr)
+        self.listener = None
+        self.closed = False
+        self._start_lock = threading.Lock()
+        self.dropped = 0
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=partial(_after_fork, weakref.ref(self)))
+
+    def _start(self):
+        with self._start_lock:
+            if self.listener is None and not self.closed:
+                self.listener = QueueListener(self.queue, self.target)
+                self.listener.start()
+
+    def _forked(self):
+        # Only the forking thread survives, the listener and any lock it held
+        # stay behind with the parent. Records queued there are the parent's
+        self.queue = queue.Queue(self.maxsize)
+        self.listener = None
+        self._start_lock = threading.Lock()
+
+    def setFormatter(self, fmt):
+        # Formatting happens on the listener thread
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Merge args now since they may change before the listener runs,
+        # leave the rest of the formatting to the listener
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self.listener is None:
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self.closed = True
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            self.target.close()
+        super().close()
+
+
+def _after_fork(handler_ref):
+    handler = handler_ref()
+    if handler is not None:
+        handler._forked()
+
+
+def log_payload(logger, level, message, payload, **fields):
+    """
+    Log message with fields, attaching payload to a sampled fraction of
+    records. Does nothing unless level is enabled for logger.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    rate = getattr(settings, "LOG_PAYLOAD_SAMPLE_RATE", 0.0)
+    if rate >= 1.0 or (rate > 0.0 and random.random() < rate):
+        fields["payload"] = payload
+    logger.log(level, message, extra=fields)
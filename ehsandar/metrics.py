@@ -0,0 +1,238 @@
+"""
+In-process metrics for the webhook hot path.
+
+Counters, gauges and fixed-bucket histograms live in a process-wide registry and
+are exposed in the Prometheus text format by metrics_view. Recording is a
+perf_counter call, a lock and a bisect, cheap enough to leave on.
+
+    with timer("render"):
+        payload = game.render_message()
+
+count_queries counts the DB queries made in its context on every
+connection, whatever the alias or thread: dbwriter and sync_to_async run
+work in a copy of the caller's context, so the writer thread's and the
+async views' queries count for the request that made them.
+
+/metrics (and /xo/stats/) are only served to METRICS_ALLOWED_IPS, or with
+METRICS_TOKEN set to requests with "Authorization: Bearer <token>".
+Behind a reverse proxy or tunnel on the same host (ngrok, a local nginx)
+every request comes from its loopback address, so set METRICS_TOKEN there.
+"""
+
+import contextvars
+import hmac
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+
+# Seconds, from 50us for in-memory stages up to the 30s Kenar timeout
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+QUERY_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Tuple[str, str, Dict[Labels, object]]] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, help_text, labels, factory):
+        key = tuple(sorted(labels.items()))
+        family = self._metrics.get(name)
+        if family is None or key not in family[2]:
+            with self._lock:
+                family = self._metrics.setdefault(name, (kind, help_text, {}))
+                family[2].setdefault(key, factory())
+        return family[2][key]
+
+    def counter(self, name, help_text="", **labels) -> Counter:
+        return self._get("counter", name, help_text, labels, Counter)
+
+    def gauge(self, name, help_text="", **labels) -> Gauge:
+        return self._get("gauge", name, help_text, labels, Gauge)
+
+    def histogram(self, name, help_text="", buckets=DEFAULT_BUCKETS, **labels) -> Histogram:
+        return self._get("histogram", name, help_text, labels, lambda: Histogram(buckets))
+
+    def clear(self):
+        with self._lock:
+            self._metrics.clear()
+
+    def render(self) -> str:
+        """Prometheus text exposition of every metric"""
+        lines = []
+        with self._lock:
+            families = sorted(
+                (name, kind, help_text, dict(series))
+                for name, (kind, help_text, series) in self._metrics.items()
+            )
+        for name, kind, help_text, series in families:
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in sorted(series.items()):
+                if kind in ("counter", "gauge"):
+                    lines.append(f"{name}{_format_labels(labels)} {metric.value}")
+                    continue
+                counts, total, count = metric.snapshot()
+                cumulative = 0
+                for bound, bucket_count in zip((*metric.buckets, "+Inf"), counts):
+                    cumulative += bucket_count
+                    le = bound if bound == "+Inf" else repr(float(bound))
+                    lines.append(
+                        f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}"
+                    )
+                lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+registry = Registry()
+
+
+@contextmanager
+def timer(stage: str):
+    """Record the duration of a hot-path stage in xo_stage_seconds"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.histogram(
+            "xo_stage_seconds", "Duration of webhook hot-path stages", stage=stage
+        ).observe(time.perf_counter() - start)
+
+
+def record_outbound(outcome: str, duration: float):
+    """Record a Kenar API call, outcome is "ok", an HTTP status or an error name"""
+    registry.counter(
+        "kenar_requests_total", "Outbound Kenar API calls by outcome", outcome=outcome
+    ).inc()
+    registry.histogram(
+        "kenar_request_seconds", "Duration of outbound Kenar API calls", outcome=outcome
+    ).observe(duration)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, round(pct / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+# Counters of the count_queries blocks this context is in
+_queries = contextvars.ContextVar("queries", default=())
+
+
+def _count_query(execute, sql, params, many, context):
+    for counter in _queries.get():
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+def instrument(sender=None, connection=None, **kwargs):
+    """Count the queries of a connection in count_queries"""
+    if _count_query not in connection.execute_wrappers:
+        # At the bottom, execute_wrapper() pops the last one when it ends
+        connection.execute_wrappers.insert(0, _count_query)
+
+
+connection_created.connect(instrument)
+
+
+@contextmanager
+def count_queries():
+    """Count the queries made in this context, yields a one-item list"""
+    # Connections of this thread opened before instrument was connected
+    for alias in connections:
+        instrument(connection=connections[alias])
+    counter = [0]
+    token = _queries.set((*_queries.get(), counter))
+    try:
+        yield counter
+    finally:
+        _queries.reset(token)
+
+
+def is_local(request) -> bool:
+    """Whether request may read metrics, see the module docstring"""
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if token:
+        given = request.headers.get("Authorization", "")
+        return hmac.compare_digest(given.encode(), f"Bearer {token}".encode())
+    allowed = getattr(settings, "METRICS_ALLOWED_IPS", ("127.0.0.1", "::1"))
+    return request.META.get("REMOTE_ADDR") in allowed
+
+
+def metrics_view(request):
+    """Plain-text metrics, only served to local clients (is_local)"""
+    if not is_local(request):
+        return HttpResponseForbidden()
+    return HttpResponse(
+        registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -0,0 +1,160 @@
+import logging
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.urls import Resolver404, resolve
+
+from .metrics import QUERY_BUCKETS, count_queries, registry
+from .profiling import (
+    SAMPLED,
+    SLOW,
+    ProfileWriter,
+    RequestProfiler,
+    StackSampler,
+    samples_to_stats,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsMiddleware:
+    """
+    Record request duration per view and status, and DB queries per request
+    on every database, including the writes dbwriter and sync_to_async run
+    on other threads (see count_queries).
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        start = time.perf_counter()
+        with count_queries() as queries:
+            response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, queries[0])
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        with count_queries() as queries:
+            response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, queries[0])
+        return response
+
+    def record(self, request, response, duration, queries):
+        match = request.resolver_match
+        view = match.view_name if match else "unmatched"
+        registry.histogram(
+            "http_request_seconds",
+            "Request duration by view and status",
+            view=view,
+            status=response.status_code,
+        ).observe(duration)
+        registry.histogram(
+            "http_request_queries",
+            "DB queries per request by view",
+            buckets=QUERY_BUCKETS,
+            view=view,
+        ).observe(queries)
+
+
+class ProfilingMiddleware:
+    """
+    Profile sampled and slow webhook requests to PROFILE_DIR, see
+    ehsandar.profiling. Not used unless PROFILE_SAMPLE_RATE or
+    PROFILE_SLOW_AFTER is set.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.rate = getattr(settings, "PROFILE_SAMPLE_RATE", 0.0)
+        slow_after = getattr(settings, "PROFILE_SLOW_AFTER", None)
+        if not self.rate and slow_after is None:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+        self.views = set(
+            getattr(settings, "PROFILE_VIEWS", ("message-webhook", "return-url-webhook"))
+        )
+        self.profiler = RequestProfiler()
+        self.sampler = None
+        if slow_after is not None:
+            self.sampler = StackSampler(slow_after, getattr(settings, "PROFILE_INTERVAL", 0.005))
+        self.writer = ProfileWriter(
+            getattr(settings, "PROFILE_DIR", settings.BASE_DIR / "profiles"),
+            getattr(settings, "PROFILE_KEEP", 200),
+        )
+
+    def view(self, request):
+        """
+        PROFILE_VIEWS name of the view request goes to, None for the rest.
+        Resolved up front, so other requests don't pay for profiling
+        """
+        try:
+            match = resolve(request.path_info, getattr(request, "urlconf", None))
+        except Resolver404:
+            return None
+        return match.url_name if match.url_name in self.views else None
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        view = self.view(request)
+        if view is None:
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        if self.rate and random.random() < self.rate and self.profiler.start():
+            try:
+                response = self.get_response(request)
+            finally:
+                stats = self.profiler.stop()
+            self.save(view, stats, time.perf_counter() - start, SAMPLED)
+            return response
+
+        if self.sampler is None:
+            return self.get_response(request)
+        ident = self.sampler.begin()
+        try:
+            response = self.get_response(request)
+        finally:
+            samples = self.sampler.end(ident)
+        if samples:
+            stats = samples_to_stats(samples, self.sampler.interval)
+            self.save(view, stats, time.perf_counter() - start, SLOW)
+        return response
+
+    async def __acall__(self, request):
+        view = self.view(request)
+        if view is None or not (
+            self.rate and random.random() < self.rate and self.profiler.start()
+        ):
+            return await self.get_response(request)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            stats = self.profiler.stop()
+        self.save(view, stats, time.perf_counter() - start, SAMPLED)
+        return response
+
+    def save(self, view, stats, duration, kind):
+        try:
+            self.writer.write(stats, view, duration, kind)
+        except OSError:
+            logger.exception("profile not written")
@@ -0,0 +1,157 @@
+"""
+Profiles of individual webhook requests.
+
+ProfilingMiddleware only looks at requests to PROFILE_VIEWS, resolved
+before the view runs. It profiles a PROFILE_SAMPLE_RATE fraction of them
+with cProfile, one at a time per process. When PROFILE_SLOW_AFTER is set,
+a background thread also samples the stack of any other one still running
+after that many seconds, every PROFILE_INTERVAL, until it ends. Profiles
+are kept as pstats files (<time>-<view>-<ms>ms-<kind>.prof) in
+PROFILE_DIR, which holds the newest PROFILE_KEEP of them. Read them with
+`python -m pstats`, snakeviz, etc.
+
+Stack samples are counted as calls, with PROFILE_INTERVAL of time per
+sample, and they only cover sync views: the stack of an event loop thread
+isn't one request's. The cProfile samples of async views also count
+whatever else the loop ran meanwhile.
+
+With both settings off the middleware removes itself at startup.
+"""
+
+import cProfile
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Optional
+
+from .metrics import registry
+
+SAMPLED, SLOW = "sampled", "slow"
+
+
+def _stack(frame):
+    """pstats function keys of a frame's stack, outermost first"""
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def samples_to_stats(samples: Counter, interval: float) -> dict:
+    """pstats data (as marshalled by cProfile) from stack sample counts"""
+    stats = {}
+    for stack, n in samples.items():
+        seen = set()
+        for depth, func in enumerate(stack):
+            cc, nc, tt, ct, callers = stats.get(func) or (0, 0, 0.0, 0.0, {})
+            if depth == len(stack) - 1:
+                tt += n * interval
+            if func not in seen:
+                seen.add(func)
+                cc, nc, ct = cc + n, nc + n, ct + n * interval
+            if depth:
+                caller = stack[depth - 1]
+                ccc, cnc, ctt, cct = callers.get(caller, (0, 0, 0.0, 0.0))
+                self_time = n * interval if depth == len(stack) - 1 else 0.0
+                callers[caller] = (ccc + n, cnc + n, ctt + self_time, cct + n * interval)
+            stats[func] = (cc, nc, tt, ct, callers)
+    return stats
+
+
+class StackSampler:
+    """Samples the stacks of requests running for longer than slow_after"""
+
+    def __init__(self, slow_after: float, interval: float = 0.005):
+        self.slow_after = slow_after
+        self.interval = interval
+        # thread id -> (start, sample counts)
+        self._running: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def begin(self) -> int:
+        ident = threading.get_ident()
+        with self._lock:
+            self._running[ident] = (time.perf_counter(), Counter())
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        return ident
+
+    def end(self, ident: int) -> Counter:
+        """The request's samples, empty unless it ran past slow_after"""
+        with self._lock:
+            return self._running.pop(ident)[1]
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            cutoff = time.perf_counter() - self.slow_after
+            with self._lock:
+                slow = [(i, c) for i, (start, c) in self._running.items() if start <= cutoff]
+                if not slow:
+                    continue
+                frames = sys._current_frames()
+                for ident, samples in slow:
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[_stack(frame)] += 1
+
+
+class ProfileWriter:
+    """Writes profiles to directory, keeping the newest keep of them"""
+
+    def __init__(self, directory, keep: int = 200):
+        self.directory = str(directory)
+        self.keep = keep
+        self._lock = threading.Lock()
+
+    def write(self, stats: dict, view: str, duration: float, kind: str) -> str:
+        name = "{}-{}-{}ms-{}.prof".format(
+            datetime.now().strftime("%Y%m%dT%H%M%S%f"),
+            view.replace(":", "_").replace("/", "_"),
+            int(duration * 1000),
+            kind,
+        )
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "wb") as f:
+                marshal.dump(stats, f)
+            # Names start with the time, so they sort oldest first
+            profiles = sorted(p for p in os.listdir(self.directory) if p.endswith(".prof"))
+            for old in profiles[: max(len(profiles) - self.keep, 0)]:
+                os.remove(os.path.join(self.directory, old))
+        registry.counter(
+            "profiles_written_total", "Request profiles written by kind", kind=kind
+        ).inc()
+        return path
+
+
+class RequestProfiler:
+    """cProfile for sampled requests, one at a time since it is process-wide"""
+
+    def __init__(self):
+        self._busy = threading.Lock()
+        self.profile = None
+
+    def start(self) -> bool:
+        if not self._busy.acquire(blocking=False):
+            return False
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return True
+
+    def stop(self) -> dict:
+        profile, self.profile = self.profile, None
+        profile.disable()
+        self._busy.release()
+        profile.create_stats()
+        return profile.stats
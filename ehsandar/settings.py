@@ -45,6 +45,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "ehsandar.middleware.MetricsMiddleware",
+    "ehsandar.middleware.ProfilingMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -82,9 +84,34 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "OPTIONS": {
+            # WAL lets reads run alongside the writer and NORMAL only syncs
+            # at checkpoints, still safe against app crashes
+            "init_command": "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;",
+            # Seconds to wait on a locked database (busy_timeout) before failing
+            "timeout": 20,
+            # Take the write lock when the transaction starts, a deferred
+            # transaction that upgrades later fails immediately when busy
+            "transaction_mode": "IMMEDIATE",
+        },
     }
 }
 
+# Send writes through a single writer thread that commits them in batches
+# (ehsandar.dbwriter), so workers don't fight over SQLite's write lock
+DB_SERIALIZED_WRITES = False
+DB_WRITE_BATCH_SIZE = 64
+
+# Databases holding games, each conversation's game lives on one of them
+# by a hash of its conversation_id (xo.shards). To shard, add an alias per
+# SQLite file to DATABASES and list them here, e.g.
+#   "shard1": {**DATABASES["default"], "NAME": BASE_DIR / "shard1.sqlite3"}
+#   XO_SHARDS = ["default", "shard1"]
+# then `manage.py migrate xo --database shard1` and `manage.py rebalance_games`.
+# Only ever append, buttons refer to shards by position.
+XO_SHARDS = ["default"]
+DATABASE_ROUTERS = ["xo.shards.ShardRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -126,3 +153,151 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+
+# XO bot
+
+# Play style used by Game.bot_move, one of xo.engine.STYLES
+XO_BOT_STYLE = "heuristic"
+
+# Board sizes offered by "/restart <size>", mapped to how many in a row win
+XO_BOARD_SIZES = {3: 3, 4: 4, 5: 4}
+
+# Seconds the bot may search for a move on boards larger than 3x3
+XO_BOT_TIME_BUDGET = 0.2
+
+# Worker processes for those searches, 0 searches in the request thread.
+# Past XO_ENGINE_DEADLINE seconds the bot falls back to the heuristic move.
+XO_ENGINE_WORKERS = 0
+XO_ENGINE_DEADLINE = 0.5
+
+# Serialized board payloads kept by xo.render, enough for every 3x3 board
+XO_RENDER_CACHE_SIZE = 6000
+
+# Last seen board per game, to reject taps on taken cells, finished games
+# and stale boards without loading the game
+XO_STATE_CACHE_SIZE = 50000
+
+# Move finished games out of the game table after a week and games left
+# in progress after 30 days (seconds), into the ArchivedGame table ("table"),
+# a JSON lines file (a path) or nowhere (None). XO_SWEEP_INTERVAL > 0 also
+# sweeps from a background thread in each worker, otherwise run
+# `manage.py sweep_games` periodically.
+XO_SWEEP_FINISHED_AFTER = 7 * 24 * 3600
+XO_SWEEP_ABANDONED_AFTER = 30 * 24 * 3600
+XO_SWEEP_BATCH_SIZE = 500
+XO_SWEEP_PAUSE = 0.05
+XO_SWEEP_INTERVAL = 0
+XO_ARCHIVE = "table"
+
+# Keep active games in memory and write them back behind the requests.
+# Only safe with a single worker or sticky routing per conversation.
+XO_GAME_CACHE = False
+XO_GAME_CACHE_SIZE = 10000
+XO_GAME_CACHE_TTL = 600.0
+# Seconds between batched write-backs, 0 writes once at the end of each turn
+XO_GAME_CACHE_FLUSH_INTERVAL = 0.0
+
+
+# Kenar webhooks
+
+# Kenar open API, overridden by the load test to point at a local stand-in
+KENAR_BASE_URL = "https://open-api.divar.ir"
+
+# Serve async webhook views with a shared pooled client (ASGI deployments)
+KENAR_ASYNC_WEBHOOKS = False
+
+# Outbound Kenar calls share one connection pool per process, HTTP/2 when
+# the h2 package is installed
+KENAR_HTTP2 = True
+KENAR_POOL_SIZE = 100
+KENAR_POOL_KEEPALIVE = 20
+# Seconds to connect, and to wait for each read once connected
+KENAR_CONNECT_TIMEOUT = 2.0
+KENAR_READ_TIMEOUT = 10.0
+# Attempts per inline send, retries are also capped process-wide at
+# KENAR_RETRY_BUDGET of recent sends plus KENAR_RETRY_MIN_PER_SECOND
+KENAR_MAX_ATTEMPTS = 3
+KENAR_RETRY_BUDGET = 0.2
+KENAR_RETRY_MIN_PER_SECOND = 1.0
+# Fail sends fast for KENAR_BREAKER_RESET seconds after this many failures
+# in a row (kenar_circuit_state in /metrics)
+KENAR_BREAKER_THRESHOLD = 5
+KENAR_BREAKER_RESET = 10.0
+
+# Send webhook replies from a background worker pool instead of inline
+KENAR_BACKGROUND_DELIVERY = False
+KENAR_DELIVERY_WORKERS = 4
+KENAR_DELIVERY_MAX_ATTEMPTS = 5
+
+# Answer retried webhooks from the stored response: "memory" (per worker),
+# "database" (shared through chatbot.ProcessedWebhook) or None to disable
+KENAR_DEDUP_BACKEND = "memory"
+KENAR_DEDUP_SIZE = 50000
+KENAR_DEDUP_TTL = 3600.0
+
+
+# Token buckets per game (button taps) and conversation (messages), checked
+# before any DB work: "memory" (per worker), "cache" (shared through the
+# KENAR_THROTTLE_CACHE Django cache) or None to disable
+KENAR_THROTTLE_BACKEND = "memory"
+KENAR_THROTTLE_RATE = 2.0
+KENAR_THROTTLE_BURST = 5
+KENAR_THROTTLE_SIZE = 100000
+KENAR_THROTTLE_CACHE = "default"
+
+# Run each conversation's webhook events one at a time in arrival order,
+# folding retries still queued into the pending event (see chatbot.scheduler)
+KENAR_SCHEDULER = True
+KENAR_SCHEDULER_ALIASES = 100000
+
+
+# Logging
+# Records go through a queue to a background writer as JSON lines
+
+LOG_LEVEL = "INFO"
+
+# Fraction of logged records that include the full request/response payload
+LOG_PAYLOAD_SAMPLE_RATE = 0.01
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "json": {"()": "ehsandar.log.JsonFormatter"},
+    },
+    "handlers": {
+        "background": {
+            "class": "ehsandar.log.BackgroundHandler",
+            "formatter": "json",
+            "stream": "ext://sys.stdout",
+        },
+    },
+    "loggers": {
+        name: {"handlers": ["background"], "level": LOG_LEVEL, "propagate": False}
+        for name in ("chatbot", "xo", "ehsandar")
+    },
+}
+
+
+# Metrics
+
+# Clients allowed to read /metrics and /xo/stats/. Behind a proxy or tunnel
+# on the same host (ngrok, a local nginx) every request comes from
+# 127.0.0.1, so set METRICS_TOKEN instead: only requests with an
+# "Authorization: Bearer <token>" header are served then
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
+METRICS_TOKEN = None
+
+
+# Profiling (see ehsandar.profiling), off unless one of the first two is set
+
+# Fraction of webhook requests run under cProfile
+PROFILE_SAMPLE_RATE = 0.0
+# Stack-sample requests still running after this many seconds, None for off
+PROFILE_SLOW_AFTER = None
+PROFILE_INTERVAL = 0.005
+PROFILE_VIEWS = ["message-webhook", "return-url-webhook"]
+# pstats files are written here, keeping the newest PROFILE_KEEP
+PROFILE_DIR = BASE_DIR / "profiles"
+PROFILE_KEEP = 200
@@ -0,0 +1,27 @@
+"""
+Lean settings for processes that only serve the Kenar webhooks.
+
+Both webhooks are csrf_exempt JSON endpoints, so admin, auth, sessions,
+messages, static files, templates and their middleware are dropped. Run with
+ehsandar.wsgi_webhook or ehsandar.asgi_webhook, which also warm the engine
+before the server forks its workers.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    "chatbot",
+    "xo",
+]
+
+MIDDLEWARE = [
+    "ehsandar.middleware.MetricsMiddleware",
+    "ehsandar.middleware.ProfilingMiddleware",
+]
+
+TEMPLATES = []
+
+WSGI_APPLICATION = "ehsandar.wsgi_webhook.application"
+
+# No translated strings on the webhook path
+USE_I18N = False
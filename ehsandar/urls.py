@@ -16,7 +16,10 @@ Including another URLconf
 """
 from django.urls import path, include
 
+from .metrics import metrics_view
+
 urlpatterns = [
+    path('metrics', metrics_view, name='metrics'),
     path('xo/', include('xo.urls')),
     path('chatbot/', include('chatbot.urls')),
 ]
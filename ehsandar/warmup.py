@@ -0,0 +1,51 @@
+"""
+Pre-fork warm-up for the webhook workers.
+
+Run once in the server's master process after Django is set up (see
+ehsandar.wsgi_webhook), so the forked workers start with the engine tables,
+board geometries, TLS context and view modules already in memory instead of
+each building them on its first request. gc.freeze() then moves everything
+loaded so far out of the garbage collector's reach, so collections in the
+workers don't touch those pages and they stay shared copy-on-write.
+
+Threads, processes and connections don't survive a fork, so warm() starts
+none. The delivery queue, engine pool and async client are created lazily
+in each worker, and the log handler restarts its writer thread in each
+worker (see ehsandar.log).
+"""
+
+import gc
+import time
+from typing import Dict
+
+from django.conf import settings
+from django.urls import get_resolver
+
+
+def warm(freeze: bool = True) -> Dict[str, float]:
+    """Load everything the hot path needs, returns seconds spent per step"""
+    from chatbot.client import ssl_context
+    from xo import engine
+    from xo.bitboard import geometry
+
+    timings = {}
+
+    def step(name, fn):
+        start = time.perf_counter()
+        fn()
+        timings[name] = time.perf_counter() - start
+
+    # Importing the URLconf imports both webhook views and everything they use
+    step("urls", lambda: get_resolver().url_patterns)
+    step("engine_tables", engine.get_tables)
+    step(
+        "geometries",
+        lambda: [
+            geometry(size, win_length)
+            for size, win_length in getattr(settings, "XO_BOARD_SIZES", {3: 3}).items()
+        ],
+    )
+    step("ssl_context", ssl_context)
+    if freeze:
+        step("gc_freeze", lambda: (gc.collect(), gc.freeze()))
+    return timings
@@ -0,0 +1,20 @@
+"""
+WSGI entry point for webhook-only workers.
+
+Uses ehsandar.settings_webhook and warms the engine tables, geometries and
+TLS context at import. Load it in the master process so workers share them:
+
+    gunicorn --preload ehsandar.wsgi_webhook
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ehsandar.settings_webhook')
+
+application = get_wsgi_application()
+
+from .warmup import warm  # noqa: E402
+
+warm()
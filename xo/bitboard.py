@@ -0,0 +1,168 @@
+"""
+Bitboard rules core.
+
+A position is two integers, one per player, where bit i is set when that
+player holds cell i. Wins, draws and legal moves are a few bitwise ops
+against the win masks of the board's Geometry (size x size cells, win_length
+in a row). The board string ("X", "O", "-" per cell) is only used when
+converting to and from the database.
+"""
+
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from .engine import EMPTY
+
+# Boards up to this many cells get a full mask -> won lookup table
+WINNING_TABLE_CELLS = 9
+
+
+class Geometry:
+    __slots__ = ("size", "win_length", "cells", "full_mask", "win_masks", "priority", "winning")
+
+    def __init__(self, size: int, win_length: int):
+        if not 1 <= win_length <= size:
+            raise ValueError("win_length must be between 1 and size")
+        self.size = size
+        self.win_length = win_length
+        self.cells = size * size
+        self.full_mask = (1 << self.cells) - 1
+
+        lines = []
+        for row in range(size):
+            for col in range(size):
+                for d_row, d_col in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                    end_row = row + d_row * (win_length - 1)
+                    end_col = col + d_col * (win_length - 1)
+                    if 0 <= end_row < size and 0 <= end_col < size:
+                        lines.append(
+                            tuple(
+                                (row + d_row * i) * size + col + d_col * i
+                                for i in range(win_length)
+                            )
+                        )
+        self.win_masks: Tuple[int, ...] = tuple(
+            sum(1 << i for i in line) for line in lines
+        )
+
+        # Cells on the most lines first (center, corners, then sides on 3x3)
+        line_counts = [sum(1 for mask in self.win_masks if mask >> i & 1) for i in range(self.cells)]
+        self.priority: Tuple[int, ...] = tuple(
+            sorted(range(self.cells), key=lambda i: (-line_counts[i], i))
+        )
+
+        # winning[mask] is True when mask contains a complete line
+        self.winning = None
+        if self.cells <= WINNING_TABLE_CELLS:
+            self.winning = tuple(
+                any(mask & w == w for w in self.win_masks) for mask in range(1 << self.cells)
+            )
+
+    def __repr__(self):
+        return f"Geometry({self.size}, {self.win_length})"
+
+    def is_won(self, mask: int) -> bool:
+        if self.winning is not None:
+            return self.winning[mask]
+        for w in self.win_masks:
+            if mask & w == w:
+                return True
+        return False
+
+
+@lru_cache(maxsize=None)
+def geometry(size: int = 3, win_length: int = 3) -> Geometry:
+    return Geometry(size, win_length)
+
+
+STANDARD = geometry(3, 3)
+
+# 3x3 shortcuts
+CELLS = STANDARD.cells
+FULL_MASK = STANDARD.full_mask
+WIN_MASKS = STANDARD.win_masks
+WINNING = STANDARD.winning
+
+
+class Position:
+    __slots__ = ("x", "o", "geometry")
+
+    def __init__(self, x: int = 0, o: int = 0, geometry: Geometry = STANDARD):
+        self.x = x
+        self.o = o
+        self.geometry = geometry
+
+    @classmethod
+    def from_string(cls, board: str, geometry: Geometry = STANDARD) -> "Position":
+        x = o = 0
+        for i, cell in enumerate(board):
+            if cell == "X":
+                x |= 1 << i
+            elif cell == "O":
+                o |= 1 << i
+        return cls(x, o, geometry)
+
+    def to_string(self) -> str:
+        return "".join(
+            "X" if self.x >> i & 1 else "O" if self.o >> i & 1 else EMPTY
+            for i in range(self.geometry.cells)
+        )
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Position)
+            and self.x == other.x
+            and self.o == other.o
+            and self.geometry is other.geometry
+        )
+
+    def __hash__(self):
+        return hash((self.x, self.o, self.geometry.size, self.geometry.win_length))
+
+    def __repr__(self):
+        return f"Position({self.to_string()!r}, {self.geometry!r})"
+
+    def mask(self, player: str) -> int:
+        return self.x if player == "X" else self.o
+
+    @property
+    def empty(self) -> int:
+        return self.geometry.full_mask & ~(self.x | self.o)
+
+    def is_empty(self, position: int) -> bool:
+        return not (self.x | self.o) >> position & 1
+
+    def is_full(self) -> bool:
+        return self.x | self.o == self.geometry.full_mask
+
+    def legal_moves(self) -> List[int]:
+        empty = self.empty
+        return [i for i in range(self.geometry.cells) if empty >> i & 1]
+
+    def has_won(self, player: str) -> bool:
+        return self.geometry.is_won(self.mask(player))
+
+    def play(self, position: int, player: str) -> "Position":
+        """Return a new position with player's mark on position"""
+        bit = 1 << position
+        if player == "X":
+            return Position(self.x | bit, self.o, self.geometry)
+        return Position(self.x, self.o | bit, self.geometry)
+
+    def winning_move(self, player: str) -> Optional[int]:
+        """Return the first empty cell that completes a line for player"""
+        mask = self.mask(player)
+        empty = self.empty
+        is_won = self.geometry.is_won
+        for i in range(self.geometry.cells):
+            if empty >> i & 1 and is_won(mask | 1 << i):
+                return i
+        return None
+
+    def strategic_move(self) -> Optional[int]:
+        """Return the free cell that sits on the most lines"""
+        empty = self.empty
+        for i in self.geometry.priority:
+            if empty >> i & 1:
+                return i
+        return None
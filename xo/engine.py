@@ -0,0 +1,161 @@
+"""
+Move tables for the XO bot.
+
+Every board the bot (O) can face is enumerated once and the chosen move for
+each play style is stored in a dict, so answering a turn is a single lookup
+instead of rescanning all eight lines for every empty cell.
+"""
+
+from typing import Dict, Optional
+
+EMPTY = "-"
+
+WIN_LINES = (
+    (0, 1, 2),
+    (3, 4, 5),
+    (6, 7, 8),
+    (0, 3, 6),
+    (1, 4, 7),
+    (2, 5, 8),
+    (0, 4, 8),
+    (2, 4, 6),
+)
+
+# Center, corners, then sides
+PRIORITY_POSITIONS = (4, 0, 2, 6, 8, 1, 3, 5, 7)
+
+# Play styles
+HEURISTIC = "heuristic"  # win, block, then priority position
+PERFECT = "perfect"  # minimax, never loses
+STYLES = (HEURISTIC, PERFECT)
+
+
+def is_winner(board: str, player: str) -> bool:
+    return any(
+        board[a] == board[b] == board[c] == player for a, b, c in WIN_LINES
+    )
+
+
+def winning_move(board: str, player: str) -> Optional[int]:
+    """Return the first empty cell that completes a line for player"""
+    for i in range(9):
+        if board[i] == EMPTY:
+            temp_board = board[:i] + player + board[i + 1 :]
+            if is_winner(temp_board, player):
+                return i
+    return None
+
+
+def strategic_move(board: str) -> Optional[int]:
+    for pos in PRIORITY_POSITIONS:
+        if board[pos] == EMPTY:
+            return pos
+    return None
+
+
+def heuristic_move(board: str) -> Optional[int]:
+    """
+    1. Win if possible
+    2. Block player's winning move
+    3. Make a strategic move
+    """
+    move = winning_move(board, "O")
+    if move is None:
+        move = winning_move(board, "X")
+    if move is None:
+        move = strategic_move(board)
+    return move
+
+
+def _score(board: str, turn: str, memo: Dict[str, int]) -> int:
+    """
+    Minimax value of board from O's point of view, with turn to move.
+    Faster wins and slower losses score higher.
+    """
+    cached = memo.get(board)
+    if cached is not None:
+        return cached
+
+    empties = board.count(EMPTY)
+    if is_winner(board, "O"):
+        value = 1 + empties
+    elif is_winner(board, "X"):
+        value = -1 - empties
+    elif empties == 0:
+        value = 0
+    else:
+        other = "X" if turn == "O" else "O"
+        scores = [
+            _score(board[:i] + turn + board[i + 1 :], other, memo)
+            for i in range(9)
+            if board[i] == EMPTY
+        ]
+        value = max(scores) if turn == "O" else min(scores)
+
+    memo[board] = value
+    return value
+
+
+def perfect_move(board: str, memo: Dict[str, int]) -> Optional[int]:
+    best_move, best_score = None, None
+    # Walk in priority order so ties prefer center and corners
+    for pos in PRIORITY_POSITIONS:
+        if board[pos] != EMPTY:
+            continue
+        score = _score(board[:pos] + "O" + board[pos + 1 :], "X", memo)
+        if best_score is None or score > best_score:
+            best_move, best_score = pos, score
+    return best_move
+
+
+def build_tables() -> Dict[str, Dict[str, int]]:
+    """
+    Enumerate every board reachable with X moving first and compute the
+    bot's move for each style on the boards where O is to move.
+    """
+    tables = {style: {} for style in STYLES}
+    memo: Dict[str, int] = {}
+    seen = set()
+    stack = [EMPTY * 9]
+
+    while stack:
+        board = stack.pop()
+        if board in seen:
+            continue
+        seen.add(board)
+
+        if is_winner(board, "X") or is_winner(board, "O") or EMPTY not in board:
+            continue
+
+        turn = "O" if board.count("X") > board.count("O") else "X"
+        if turn == "O":
+            tables[HEURISTIC][board] = heuristic_move(board)
+            tables[PERFECT][board] = perfect_move(board, memo)
+
+        for i in range(9):
+            if board[i] == EMPTY:
+                stack.append(board[:i] + turn + board[i + 1 :])
+
+    return tables
+
+
+_tables: Optional[Dict[str, Dict[str, int]]] = None
+
+
+def get_tables() -> Dict[str, Dict[str, int]]:
+    """Build the move tables on first use"""
+    global _tables
+    if _tables is None:
+        _tables = build_tables()
+    return _tables
+
+
+def best_move(board: str, style: str = HEURISTIC) -> Optional[int]:
+    """Return the bot's move for board, or None if O has nothing to play"""
+    if style not in STYLES:
+        raise ValueError(f"Unknown play style: {style}")
+    move = get_tables()[style].get(board)
+    if move is None and EMPTY in board:
+        # Not a board reachable by normal play, compute it directly
+        move = heuristic_move(board) if style == HEURISTIC else perfect_move(board, {})
+    return move
@@ -0,0 +1,134 @@
+"""
+Engine executor for bot move searches.
+
+Searches on larger boards are CPU bound, so instead of running them in the
+request thread they go to a warm pool of worker processes. Only the board
+string and geometry cross the process boundary and only a cell index comes
+back. Every call has a deadline: if the worker hasn't answered by then the
+caller gets None and falls back to the cheap heuristic, so a busy pool
+bounds tail latency instead of queueing requests behind each other.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from django.conf import settings
+
+from ehsandar.metrics import registry
+
+from . import search
+
+logger = logging.getLogger(__name__)
+
+
+def _record(outcome: str):
+    registry.counter(
+        "xo_engine_calls_total",
+        "Bot searches sent to the engine pool by outcome",
+        outcome=outcome,
+    ).inc()
+
+
+class EngineExecutor:
+    def __init__(self, workers: int = 2, deadline: float = 0.5, geometries=()):
+        self.workers = workers
+        self.deadline = deadline
+        self.geometries = tuple(geometries)
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        pool = self._pool
+        if pool is None:
+            with self._lock:
+                if self._pool is None:
+                    # forkserver so workers don't inherit the web process's threads
+                    self._pool = ProcessPoolExecutor(
+                        self.workers, mp_context=multiprocessing.get_context("forkserver")
+                    )
+                pool = self._pool
+        return pool
+
+    def warm(self, wait: bool = True, timeout: float = 30.0):
+        """
+        Start the workers and build their searchers ahead of the first move.
+        Returns the worker pids when waiting.
+        """
+        pool = self._get_pool()
+        futures = [pool.submit(search.warm, self.geometries) for _ in range(self.workers)]
+        if wait:
+            return {future.result(timeout) for future in futures}
+
+    def best_move(
+        self,
+        board: str,
+        size: int,
+        win_length: int,
+        player: str = "O",
+        budget: float = 0.2,
+        deadline: Optional[float] = None,
+    ) -> Optional[int]:
+        """Search in a worker, None if it doesn't answer within deadline seconds"""
+        if deadline is None:
+            deadline = self.deadline
+        try:
+            future = self._get_pool().submit(
+                search.search_board, board, size, win_length, player, budget
+            )
+        except (BrokenProcessPool, RuntimeError):
+            self._reset()
+            _record("error")
+            return None
+        try:
+            move = future.result(deadline)
+        except FutureTimeout:
+            # Drop it if it hasn't started, a running search ends at its budget
+            future.cancel()
+            _record("timeout")
+            return None
+        except BrokenProcessPool:
+            logger.warning("engine pool broke, restarting it")
+            self._reset()
+            _record("error")
+            return None
+        _record("ok")
+        return move
+
+    def _reset(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        self._reset()
+
+
+_executor: Optional[EngineExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_engine_executor() -> Optional[EngineExecutor]:
+    """Process-wide executor, None when XO_ENGINE_WORKERS is 0 (search inline)"""
+    global _executor
+    workers = getattr(settings, "XO_ENGINE_WORKERS", 0)
+    if not workers:
+        return None
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                sizes = getattr(settings, "XO_BOARD_SIZES", {3: 3})
+                _executor = EngineExecutor(
+                    workers,
+                    getattr(settings, "XO_ENGINE_DEADLINE", 0.5),
+                    [(size, k) for size, k in sizes.items() if size != 3],
+                )
+                atexit.register(_executor.close)
+                _executor.warm(wait=False)
+    return _executor
@@ -0,0 +1,44 @@
+from django.db import models
+from django.utils.functional import cached_property
+
+
+class CodeField(models.PositiveSmallIntegerField):
+    """
+    A string from a fixed list, stored as its index in codes so the column
+    is a small integer. Reads, writes and lookups all use the strings:
+
+        status = CodeField(codes=("IN_PROGRESS", "X_WON"), default="IN_PROGRESS")
+        Game.objects.filter(status="X_WON")
+
+    Only ever append to codes, existing rows store the positions.
+    """
+
+    def __init__(self, *args, codes=(), **kwargs):
+        self.codes = tuple(codes)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs["codes"] = self.codes
+        return name, path, args, kwargs
+
+    @cached_property
+    def validators(self):
+        # The integer range checks don't apply to the strings
+        return [*self.default_validators, *self._validators]
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else self.codes[value]
+
+    def to_python(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        return self.codes[value]
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, int):
+            return value
+        try:
+            return self.codes.index(value)
+        except ValueError:
+            raise ValueError(f"{value!r} is not one of {self.codes}") from None
@@ -0,0 +1,98 @@
+import random
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from xo.bitboard import Position
+
+
+def legacy_make_move(board, position, player):
+    board_list = list(board)
+    board_list[position] = player
+    return "".join(board_list)
+
+
+def legacy_is_winner(board, player):
+    for i in range(0, 9, 3):
+        if board[i : i + 3] == player * 3:
+            return True
+    for i in range(3):
+        if board[i] == board[i + 3] == board[i + 6] == player:
+            return True
+    if board[0] == board[4] == board[8] == player:
+        return True
+    if board[2] == board[4] == board[6] == player:
+        return True
+    return False
+
+
+def legacy_winning_move(board, player):
+    for i in range(9):
+        if board[i] == "-":
+            if legacy_is_winner(legacy_make_move(board, i, player), player):
+                return i
+    return None
+
+
+def random_boards(count, seed):
+    """Random in-progress boards reached by alternating legal moves"""
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < count:
+        board = "-" * 9
+        for turn in "XOXOXOXO"[: rng.randint(0, 7)]:
+            empties = [i for i in range(9) if board[i] == "-"]
+            board = legacy_make_move(board, rng.choice(empties), turn)
+        if not legacy_is_winner(board, "X") and not legacy_is_winner(board, "O"):
+            boards.append(board)
+    return boards
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark the bitboard rules core against the string-based rules"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--boards", type=int, default=1000)
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        boards = random_boards(options["boards"], options["seed"])
+        positions = [Position.from_string(board) for board in boards]
+
+        def string_turn():
+            for board in boards:
+                move = legacy_winning_move(board, "O")
+                if move is None:
+                    move = board.index("-")
+                after = legacy_make_move(board, move, "O")
+                legacy_is_winner(after, "O")
+                "-" in after
+
+        def bitboard_turn():
+            for position in positions:
+                move = position.winning_move("O")
+                if move is None:
+                    move = position.legal_moves()[0]
+                after = position.play(move, "O")
+                after.has_won("O")
+                after.is_full()
+
+        def bitboard_roundtrip():
+            for board in boards:
+                Position.from_string(board).to_string()
+
+        cases = [
+            ("string rules", string_turn),
+            ("bitboard rules", bitboard_turn),
+            ("bitboard str<->int", bitboard_roundtrip),
+        ]
+        results = {}
+        for name, func in cases:
+            best = min(timeit.repeat(func, number=1, repeat=options["repeat"]))
+            results[name] = best
+            per_turn = best / len(boards) * 1e6
+            self.stdout.write(f"{name:<20} {per_turn:8.3f} us/turn")
+
+        speedup = results["string rules"] / results["bitboard rules"]
+        self.stdout.write(f"bitboard speedup: {speedup:.1f}x")
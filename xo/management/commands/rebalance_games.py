@@ -0,0 +1,86 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from xo.models import Game, MovedGame
+from xo.shards import game_ref, shard_for, shards
+
+# Copied as-is, the target shard gives the game a new pk
+FIELDS = (
+    "conversation_id",
+    "x_cells",
+    "o_cells",
+    "size",
+    "win_length",
+    "current_turn",
+    "status",
+    "version",
+    "created_at",
+    "updated_at",
+)
+
+
+def move_game(game: Game, target: str) -> bool:
+    """
+    Copy game to the target shard, then delete it from its own unless it
+    changed meanwhile. A newer copy already on the target wins. The copy
+    gets a new pk, so a MovedGame left in place of the game forwards the
+    ref on boards already sent. Returns whether the game was moved.
+    """
+    values = {field: getattr(game, field) for field in FIELDS}
+    with transaction.atomic(using=target):
+        games = Game.objects.using(target).filter(conversation_id=game.conversation_id)
+        existing = games.first()
+        if existing is None:
+            # bulk_create skips save(), a moved game isn't a new one for the stats
+            Game.objects.using(target).bulk_create([Game(**values)])
+            # but not auto_now_add and auto_now
+            games.update(created_at=game.created_at, updated_at=game.updated_at)
+        elif existing.updated_at < game.updated_at:
+            games.update(**values)
+        ref = game_ref(target, games.values_list("pk", flat=True).get())
+
+    source = game._state.db
+    with transaction.atomic(using=source):
+        deleted, _ = (
+            Game.objects.using(source).filter(pk=game.pk, version=game.version).delete()
+        )
+        if deleted:
+            MovedGame.objects.using(source).update_or_create(
+                game_id=game.pk, defaults={"ref": ref}
+            )
+    return bool(deleted)
+
+
+class Command(BaseCommand):
+    help = (
+        "Move games to the shard their conversation hashes to, e.g. after "
+        "appending a database to XO_SHARDS"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Games read per query")
+        parser.add_argument("--dry-run", action="store_true", help="Only count misplaced games")
+
+    def handle(self, *args, **options):
+        moved = skipped = 0
+        for source in shards():
+            games = Game.objects.using(source).order_by("pk")
+            last_pk = 0
+            while True:
+                batch = list(games.filter(pk__gt=last_pk)[: options["batch_size"]])
+                if not batch:
+                    break
+                last_pk = batch[-1].pk
+                for game in batch:
+                    target = shard_for(game.conversation_id)
+                    if target == source:
+                        continue
+                    if options["dry_run"] or move_game(game, target):
+                        moved += 1
+                    else:
+                        # Played while being copied, the next run moves it again
+                        skipped += 1
+            self.stdout.write(f"  {source}: done")
+
+        verb = "would move" if options["dry_run"] else "moved"
+        self.stdout.write(f"{verb} {moved} games, {skipped} changed while moving")
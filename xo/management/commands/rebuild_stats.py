@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from xo import stats
+
+
+class Command(BaseCommand):
+    help = "Fill in the hourly game statistics from the game and archived game tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Games read per query")
+
+    def handle(self, *args, **options):
+        def progress(read):
+            self.stdout.write(f"  {read} games read")
+
+        read = stats.rebuild(options["chunk_size"], progress=progress)
+        summary = stats.summary()
+        self.stdout.write(
+            f"rebuilt from {read} games: {summary['active']} active, "
+            f"{summary['x_won']} won, {summary['o_won']} lost, {summary['draw']} drawn"
+        )
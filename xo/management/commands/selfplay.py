@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from xo import engine
+from xo.selfplay import POLICIES, benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Play each bot engine against every possible sequence of player moves "
+        "and report results and move latency, without touching the database"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--engine", action="append", choices=sorted(POLICIES), help="Repeat for several, default all"
+        )
+        parser.add_argument("--size", type=int, default=3)
+        parser.add_argument("--win-length", type=int, default=3)
+        parser.add_argument("--budget", type=float, default=0.2, help="Seconds per search move")
+        parser.add_argument("--style", choices=engine.STYLES, help="XO_BOT_STYLE for the game engine")
+        parser.add_argument(
+            "--max-losses", type=int, help="Fail if any engine loses more games than this"
+        )
+        parser.add_argument(
+            "--min-moves-per-second", type=float, help="Fail if any engine is slower than this"
+        )
+
+    def handle(self, *args, **options):
+        names = options["engine"]
+        if names is None and (options["size"], options["win_length"]) != (3, 3):
+            names = [name for name in POLICIES if name not in engine.STYLES]
+
+        overrides = {"XO_ENGINE_WORKERS": 0, "XO_BOT_TIME_BUDGET": options["budget"]}
+        if options["style"]:
+            overrides["XO_BOT_STYLE"] = options["style"]
+        with override_settings(**overrides):
+            results = benchmark(names, options["size"], options["win_length"], options["budget"])
+
+        self.stdout.write(
+            f"{'engine':<10} {'games':>7} {'won':>7} {'drawn':>7} {'lost':>7} {'illegal':>7} "
+            f"{'moves':>6} {'moves/s':>9} {'p50 us':>8} {'p99 us':>8} {'max us':>8}"
+        )
+        failures = []
+        for result in results:
+            self.stdout.write(
+                f"{result.name:<10} {result.games:>7} {result.wins:>7} {result.draws:>7} "
+                f"{result.losses:>7} {result.illegal:>7} {result.moves:>6} "
+                f"{result.moves_per_second:>9.0f} {result.percentile(50) * 1e6:>8.1f} "
+                f"{result.percentile(99) * 1e6:>8.1f} {result.percentile(100) * 1e6:>8.1f}"
+            )
+            if result.illegal:
+                failures.append(f"{result.name} made {result.illegal} illegal moves")
+            if options["max_losses"] is not None and result.losses > options["max_losses"]:
+                failures.append(f"{result.name} lost {result.losses} games, e.g. {result.lost_boards[0]}")
+            minimum = options["min_moves_per_second"]
+            if minimum is not None and result.moves_per_second < minimum:
+                failures.append(f"{result.name} made {result.moves_per_second:.0f} moves/s")
+        if failures:
+            raise CommandError("; ".join(failures))
@@ -0,0 +1,81 @@
+import copy
+import tempfile
+import time
+from pathlib import Path
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import override_settings
+
+from ehsandar.metrics import percentile
+from xo.management.commands.stress_writes import StressTest
+from xo.models import Game
+
+
+class Command(BaseCommand):
+    help = (
+        "Play concurrent games on one SQLite file and then sharded across "
+        "several, and report lock errors, write throughput and games per shard"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shards", type=int, default=4)
+        parser.add_argument("--threads", type=int, default=16)
+        parser.add_argument("--turns", type=int, default=200, help="Writes per thread")
+        parser.add_argument(
+            "--serialized", action="store_true", help="With DB_SERIALIZED_WRITES, a writer per shard"
+        )
+
+    def handle(self, *args, **options):
+        base = connections["default"].settings_dict
+        if base["ENGINE"] != "django.db.backends.sqlite3":
+            self.stderr.write("stress_shards only makes sense on SQLite")
+            return
+
+        self.stdout.write(
+            f"{'shards':<8}{'writes':>8}{'errors':>8}{'writes/s':>10}{'p50 ms':>9}{'p99 ms':>9}"
+            "  games per shard"
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            for count in sorted({1, options["shards"]}):
+                aliases = [f"stress_{count}_{i}" for i in range(count)]
+                for alias in aliases:
+                    settings_dict = copy.deepcopy(base)
+                    settings_dict["NAME"] = str(Path(directory) / f"{alias}.sqlite3")
+                    connections.settings[alias] = settings_dict
+                try:
+                    stats = self.run_sharded(aliases, options)
+                finally:
+                    for alias in aliases:
+                        connections[alias].close()
+                        del connections[alias]
+                        del connections.settings[alias]
+                self.stdout.write(
+                    f"{count:<8}{stats['writes']:>8}{stats['errors']:>8}"
+                    f"{stats['throughput']:>10.1f}{stats['p50_ms']:>9.1f}{stats['p99_ms']:>9.1f}"
+                    f"  {' '.join(str(games) for games in stats['games'])}"
+                )
+                for error, errors in stats["error_kinds"].items():
+                    self.stdout.write(f"  {errors} x {error}")
+
+    def run_sharded(self, aliases, options):
+        with override_settings(XO_SHARDS=aliases, DB_SERIALIZED_WRITES=options["serialized"]):
+            for alias in aliases:
+                call_command("migrate", "xo", database=alias, verbosity=0)
+            stress = StressTest(options["threads"], options["turns"])
+            start = time.perf_counter()
+            stress.run()
+            elapsed = time.perf_counter() - start
+            games = [Game.objects.using(alias).count() for alias in aliases]
+
+        latencies = sorted(stress.latencies)
+        return {
+            "writes": len(latencies),
+            "errors": sum(stress.errors.values()),
+            "error_kinds": stress.errors,
+            "throughput": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": (percentile(latencies, 50) or 0.0) * 1000,
+            "p99_ms": (percentile(latencies, 99) or 0.0) * 1000,
+            "games": games,
+        }
@@ -0,0 +1,135 @@
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections
+from django.test import override_settings
+from django.test.utils import setup_databases, teardown_databases
+
+from ehsandar.metrics import percentile
+from xo.models import GameConflict
+from xo.store import GameStore
+
+# (name, sqlite OPTIONS, serialized writes); None keeps the configured OPTIONS
+MODES = (
+    ("rollback-journal", {}, False),
+    ("wal", None, False),
+    ("wal+writer", None, True),
+)
+
+
+class StressTest:
+    """Threads each playing their own games as fast as they can"""
+
+    def __init__(self, threads, turns):
+        self.threads = threads
+        self.turns = turns
+        self.store = GameStore()
+        self.latencies = []
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, latency=None, error=None):
+        with self.lock:
+            if error is None:
+                self.latencies.append(latency)
+            else:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def write(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            result = fn(*args)
+        except OperationalError as e:
+            # "database is locked" and friends
+            self.record(error=str(e))
+            return None
+        except GameConflict:
+            self.record(error="conflict")
+            return None
+        self.record(time.perf_counter() - start)
+        return result
+
+    def turn(self, game_id):
+        with self.store.turn(game_id) as game:
+            if game.status == "IN_PROGRESS":
+                game.play_turn(game.position.legal_moves()[0])
+            return game.status
+
+    def worker(self, index):
+        conversation_id = f"stress-{index}"
+        try:
+            game = None
+            for _ in range(self.turns):
+                if game is None:
+                    game = self.write(self.store.restart, conversation_id)
+                    continue
+                status = self.write(self.turn, game.ref)
+                if status != "IN_PROGRESS":
+                    game = None
+        finally:
+            connections.close_all()
+
+    def run(self):
+        with ThreadPoolExecutor(self.threads) as pool:
+            list(pool.map(self.worker, range(self.threads)))
+
+
+class Command(BaseCommand):
+    help = (
+        "Hammer a file-backed SQLite database with concurrent game writes in "
+        "each connection mode and report lock errors and write throughput"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=16)
+        parser.add_argument("--turns", type=int, default=200, help="Writes per thread")
+
+    def handle(self, *args, **options):
+        settings_dict = connections["default"].settings_dict
+        if settings_dict["ENGINE"] != "django.db.backends.sqlite3":
+            self.stderr.write("stress_writes only makes sense on SQLite")
+            return
+        configured = dict(settings_dict.get("OPTIONS", {}))
+
+        self.stdout.write(
+            f"{'mode':<20}{'writes':>8}{'errors':>8}{'writes/s':>10}{'p50 ms':>9}{'p99 ms':>9}"
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            for name, db_options, serialized in MODES:
+                settings_dict["OPTIONS"] = configured if db_options is None else db_options
+                settings_dict["TEST"]["NAME"] = str(Path(directory) / f"{name}.sqlite3")
+                stats = self.run_mode(options, serialized)
+                self.stdout.write(
+                    f"{name:<20}{stats['writes']:>8}{stats['errors']:>8}"
+                    f"{stats['throughput']:>10.1f}{stats['p50_ms']:>9.1f}{stats['p99_ms']:>9.1f}"
+                )
+                for error, count in stats["error_kinds"].items():
+                    self.stdout.write(f"  {count} x {error}")
+        settings_dict["OPTIONS"] = configured
+
+    def run_mode(self, options, serialized):
+        connections.close_all()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(DB_SERIALIZED_WRITES=serialized):
+                stress = StressTest(options["threads"], options["turns"])
+                start = time.perf_counter()
+                stress.run()
+                elapsed = time.perf_counter() - start
+        finally:
+            connections.close_all()
+            teardown_databases(old_config, verbosity=0)
+
+        latencies = sorted(stress.latencies)
+        return {
+            "writes": len(latencies),
+            "errors": sum(stress.errors.values()),
+            "error_kinds": stress.errors,
+            "throughput": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": (percentile(latencies, 50) or 0.0) * 1000,
+            "p99_ms": (percentile(latencies, 99) or 0.0) * 1000,
+        }
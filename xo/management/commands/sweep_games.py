@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from chatbot.dedup import get_dedup_store
+from xo.sweeper import get_sweeper
+
+
+class Command(BaseCommand):
+    help = "Archive and delete expired finished and abandoned games and webhook responses"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="Games moved per transaction")
+        parser.add_argument("--archive", help='"table", a JSON lines file, or "none"')
+
+    def handle(self, *args, **options):
+        sweeper = get_sweeper()
+        if options["batch_size"]:
+            sweeper.batch_size = options["batch_size"]
+        if options["archive"]:
+            sweeper.archive = None if options["archive"] == "none" else options["archive"]
+        swept = sweeper.sweep()
+        for status, count in swept.items():
+            self.stdout.write(f"  {status}: {count}")
+        self.stdout.write(f"swept {sum(swept.values())} games")
+        self.stdout.write(f"purged {get_dedup_store().purge()} webhook responses")
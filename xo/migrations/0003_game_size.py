@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:22
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xo', '0002_game_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='size',
+            field=models.PositiveSmallIntegerField(default=3, validators=[django.core.validators.MinValueValidator(3), django.core.validators.MaxValueValidator(7)]),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='win_length',
+            field=models.PositiveSmallIntegerField(default=3),
+        ),
+        migrations.AlterField(
+            model_name='game',
+            name='board',
+            field=models.CharField(default='---------', max_length=49),
+        ),
+    ]
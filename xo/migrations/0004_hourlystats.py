@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xo', '0003_game_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HourlyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField(unique=True)),
+                ('started', models.PositiveIntegerField(default=0)),
+                ('abandoned', models.PositiveIntegerField(default=0)),
+                ('x_won', models.PositiveIntegerField(default=0)),
+                ('o_won', models.PositiveIntegerField(default=0)),
+                ('draw', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['hour'],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xo', '0004_hourlystats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedGame',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('game_id', models.BigIntegerField()),
+                ('conversation_id', models.CharField(max_length=100)),
+                ('board', models.CharField(max_length=49)),
+                ('size', models.PositiveSmallIntegerField(default=3)),
+                ('win_length', models.PositiveSmallIntegerField(default=3)),
+                ('status', models.CharField(choices=[('IN_PROGRESS', 'In Progress'), ('X_WON', 'X Won'), ('O_WON', 'O Won'), ('DRAW', 'Draw')], max_length=20)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['status', 'updated_at'], name='xo_game_status_updated'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+from django.db import migrations, models
+
+import xo.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xo', '0005_archivedgame_game_status_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='x_cells',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='o_cells',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='status_code',
+            field=xo.fields.CodeField(choices=[('IN_PROGRESS', 'In Progress'), ('X_WON', 'X Won'), ('O_WON', 'O Won'), ('DRAW', 'Draw')], codes=('IN_PROGRESS', 'X_WON', 'O_WON', 'DRAW'), default='IN_PROGRESS'),
+        ),
+        migrations.AddField(
+            model_name='game',
+            name='turn_code',
+            field=xo.fields.CodeField(codes=('X', 'O'), default='X'),
+        ),
+    ]
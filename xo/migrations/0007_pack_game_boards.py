@@ -0,0 +1,66 @@
+"""
+Copy board, status and current_turn into the packed columns added in 0006,
+BATCH_SIZE games per transaction so a big table isn't locked for the
+whole run.
+"""
+
+from django.db import migrations, transaction
+
+BATCH_SIZE = 1000
+
+
+def _batches(Game, alias, fields):
+    last_pk = 0
+    while True:
+        with transaction.atomic(using=alias):
+            games = list(
+                Game.objects.using(alias)
+                .filter(pk__gt=last_pk)
+                .order_by("pk")
+                .only("pk", *fields)[:BATCH_SIZE]
+            )
+            if not games:
+                return
+            yield games
+        last_pk = games[-1].pk
+
+
+def pack(apps, schema_editor):
+    Game = apps.get_model("xo", "Game")
+    alias = schema_editor.connection.alias
+    for games in _batches(Game, alias, ("board", "status", "current_turn")):
+        for game in games:
+            game.x_cells = sum(1 << i for i, cell in enumerate(game.board) if cell == "X")
+            game.o_cells = sum(1 << i for i, cell in enumerate(game.board) if cell == "O")
+            game.status_code = game.status
+            game.turn_code = game.current_turn
+        Game.objects.using(alias).bulk_update(
+            games, ["x_cells", "o_cells", "status_code", "turn_code"]
+        )
+
+
+def unpack(apps, schema_editor):
+    Game = apps.get_model("xo", "Game")
+    alias = schema_editor.connection.alias
+    fields = ("x_cells", "o_cells", "size", "status_code", "turn_code")
+    for games in _batches(Game, alias, fields):
+        for game in games:
+            game.board = "".join(
+                "X" if game.x_cells >> i & 1 else "O" if game.o_cells >> i & 1 else "-"
+                for i in range(game.size * game.size)
+            )
+            game.status = game.status_code
+            game.current_turn = game.turn_code
+        Game.objects.using(alias).bulk_update(games, ["board", "status", "current_turn"])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('xo', '0006_game_packed_fields'),
+    ]
+
+    operations = [
+        migrations.RunPython(pack, unpack),
+    ]
@@ -0,0 +1,41 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xo', '0007_pack_game_boards'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='game',
+            name='xo_game_status_updated',
+        ),
+        migrations.RemoveField(
+            model_name='game',
+            name='board',
+        ),
+        migrations.RemoveField(
+            model_name='game',
+            name='status',
+        ),
+        migrations.RemoveField(
+            model_name='game',
+            name='current_turn',
+        ),
+        migrations.RenameField(
+            model_name='game',
+            old_name='status_code',
+            new_name='status',
+        ),
+        migrations.RenameField(
+            model_name='game',
+            old_name='turn_code',
+            new_name='current_turn',
+        ),
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['status', 'updated_at'], name='xo_game_status_updated'),
+        ),
+    ]
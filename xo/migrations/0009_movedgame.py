@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xo', '0008_drop_game_string_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MovedGame',
+            fields=[
+                ('game_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('ref', models.CharField(max_length=32)),
+                ('moved_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -1,5 +1,83 @@
-from django.db import models
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, models, transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.utils import timezone
+
+from . import engine, render, search
+from .executor import get_engine_executor
+from .bitboard import STANDARD, Geometry, Position, geometry
+from .fields import CodeField
+from .shards import game_ref, shard_for
+
+
+class GameConflict(Exception):
+    """The game changed since it was loaded, e.g. by a double-tapped button"""
+
+
+class InvalidMove(ValueError):
+    """The position is off the board or already taken"""
+
+
+class HourlyStats(models.Model):
+    """
+    Games started, finished and abandoned (restarted before the end) per
+    hour, kept up to date as games change status so dashboards never scan
+    the game table. See xo.stats.
+    """
+
+    FIELDS = ("started", "abandoned", "x_won", "o_won", "draw")
+
+    hour = models.DateTimeField(unique=True)
+    started = models.PositiveIntegerField(default=0)
+    abandoned = models.PositiveIntegerField(default=0)
+    x_won = models.PositiveIntegerField(default=0)
+    o_won = models.PositiveIntegerField(default=0)
+    draw = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ["hour"]
+
+    def __str__(self):
+        return f"Stats {self.hour:%Y-%m-%d %H}:00"
+
+    @staticmethod
+    def hour_of(when=None):
+        when = when or timezone.now()
+        return when.replace(minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def record(cls, *events, when=None, using=None):
+        """
+        Count events (field names, e.g. "started" or "x_won") in the hour of
+        when, on the using database (the game's shard)
+        """
+        counts = {}
+        for event in events:
+            counts[event] = counts.get(event, 0) + 1
+        if counts:
+            cls._add(cls.hour_of(when), counts, using or DEFAULT_DB_ALIAS)
+
+    @classmethod
+    def _add(cls, hour, counts, using):
+        increments = {field: F(field) + n for field, n in counts.items()}
+        rows = cls.objects.using(using)
+        if rows.filter(hour=hour).update(**increments):
+            return
+        try:
+            with transaction.atomic(using=using):
+                rows.create(hour=hour, **counts)
+        except IntegrityError:
+            # Another request created the hour's row first
+            rows.filter(hour=hour).update(**increments)
+
+
+STATUS_EVENTS = {"X_WON": "x_won", "O_WON": "o_won", "DRAW": "draw"}
+
+# Stored as their index, only ever append
+STATUSES = ("IN_PROGRESS", "X_WON", "O_WON", "DRAW")
+TURNS = ("X", "O")
 
 
 class Game(models.Model):
@@ -11,177 +89,298 @@ class Game(models.Model):
     ]
 
     conversation_id = models.CharField(max_length=100, unique=True)
-    board = models.CharField(
-        max_length=9, default="---------"
-    )  # - for empty, X for player, O for bot
-    current_turn = models.CharField(max_length=1, default="X")  # X or O
-    status = models.CharField(
-        max_length=20, choices=GAME_STATUS_CHOICES, default="IN_PROGRESS"
+    # The board as bitmasks, bit i set when the player (X) or the bot (O)
+    # holds cell i, see xo.bitboard. Read and written as a string through
+    # the board property: - for empty, X for player, O for bot
+    x_cells = models.BigIntegerField(default=0)
+    o_cells = models.BigIntegerField(default=0)
+    # size x size board, win_length in a row wins
+    size = models.PositiveSmallIntegerField(
+        default=3, validators=[MinValueValidator(3), MaxValueValidator(7)]
     )
+    win_length = models.PositiveSmallIntegerField(default=3)
+    current_turn = CodeField(codes=TURNS, default="X")
+    status = CodeField(codes=STATUSES, choices=GAME_STATUS_CHOICES, default="IN_PROGRESS")
+    # Bumped on every saved turn and restart, for optimistic concurrency
+    version = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # The sweeper's expiry scan, see xo.sweeper
+            models.Index(fields=["status", "updated_at"], name="xo_game_status_updated"),
+        ]
+
     def __str__(self):
         return f"Game {self.conversation_id} - {self.status}"
 
-    def make_move(self, position):
-        if not (0 <= position <= 8):
-            raise ValueError("Position must be between 0 and 8")
-
-        if self.board[position] != "-":
-            raise ValueError("Position already taken")
-
-        board_list = list(self.board)
-        board_list[position] = self.current_turn
-        self.board = "".join(board_list)
+    def save(self, *args, **kwargs):
+        created = self._state.adding
+        super().save(*args, **kwargs)
+        if created:
+            self._stats_events.append("started")
+        self.record_stats()
+
+    @property
+    def _stats_events(self) -> list:
+        """Status changes not yet counted in HourlyStats"""
+        return self.__dict__.setdefault("_pending_stats", [])
+
+    def take_stats(self) -> list:
+        """Pending status changes, cleared. Dropped if the turn isn't saved"""
+        return self.__dict__.pop("_pending_stats", [])
+
+    def record_stats(self, events=None):
+        """Count the status changes once they are saved"""
+        events = self.take_stats() if events is None else events
+        if events:
+            HourlyStats.record(*events, using=self._state.db)
+
+    @property
+    def ref(self) -> str:
+        """The game id buttons carry, shard-prefixed (see xo.shards)"""
+        return game_ref(self._state.db or shard_for(self.conversation_id), self.pk)
+
+    @classmethod
+    def restart(cls, conversation_id, size=3, win_length=3, after_version=0):
+        """
+        Reset the conversation's game in place on its shard, creating it if
+        needed. The version moves past both the stored one and after_version
+        """
+        using = shard_for(conversation_id)
+        games = cls.objects.using(using).filter(conversation_id=conversation_id)
+        values = dict(
+            x_cells=0,
+            o_cells=0,
+            size=size,
+            win_length=win_length,
+            current_turn="X",
+            status="IN_PROGRESS",
+            version=Greatest(F("version"), Value(after_version)) + 1,
+            updated_at=timezone.now(),
+        )
+        # Restarting a game still in progress abandons it, tell the two apart
+        # with conditional updates rather than reading the status first
+        if games.filter(status="IN_PROGRESS").update(**values):
+            HourlyStats.record("started", "abandoned", using=using)
+            return games.get()
+        if games.update(**values):
+            HourlyStats.record("started", using=using)
+            return games.get()
+        game, created = cls.objects.using(using).get_or_create(
+            conversation_id=conversation_id,
+            defaults={"size": size, "win_length": win_length},
+        )
+        return game
+
+    @property
+    def geometry(self) -> Geometry:
+        return geometry(self.size, self.win_length)
+
+    def _cached_position(self):
+        """(key, Position, board string) for the current cells, built once per change"""
+        key = (self.x_cells, self.o_cells, self.size, self.win_length)
+        cached = self.__dict__.get("_position")
+        if cached is None or cached[0] != key:
+            position = Position(self.x_cells, self.o_cells, self.geometry)
+            cached = self._position = (key, position, position.to_string())
+        return cached
+
+    @property
+    def position(self) -> Position:
+        return self._cached_position()[1]
+
+    @property
+    def board(self) -> str:
+        return self._cached_position()[2]
+
+    @board.setter
+    def board(self, board: str):
+        position = Position.from_string(board)
+        self.x_cells, self.o_cells = position.x, position.o
+
+    def _set_position(self, position: Position):
+        self.x_cells, self.o_cells = position.x, position.o
+
+    def make_move(self, position, save=True):
+        cells = self.size * self.size
+        if not (0 <= position < cells):
+            raise InvalidMove(f"Position must be between 0 and {cells - 1}")
+
+        current = self.position
+        if not current.is_empty(position):
+            raise InvalidMove("Position already taken")
+        previous_status = self.status
+
+        new_position = current.play(position, self.current_turn)
+        self._set_position(new_position)
 
         # Check game status before changing turn
-        if self.is_winner(self.current_turn):
+        if new_position.has_won(self.current_turn):
             self.status = f"{self.current_turn}_WON"
-        elif "-" not in self.board:
+        elif new_position.is_full():
             self.status = "DRAW"
         else:
             self.current_turn = "O" if self.current_turn == "X" else "X"
+        if self.status != previous_status:
+            self._stats_events.append(STATUS_EVENTS[self.status])
 
-        self.save()
+        if save:
+            self.save()
 
     def get_board_state(self):
-        return [list(self.board[i : i + 3]) for i in range(0, 9, 3)]
+        size = self.size
+        return [list(self.board[i : i + size]) for i in range(0, size * size, size)]
 
     def is_winner(self, player):
-        # Check rows
-        for i in range(0, 9, 3):
-            if self.board[i : i + 3] == player * 3:
-                return True
-
-        # Check columns
-        for i in range(3):
-            if self.board[i] == self.board[i + 3] == self.board[i + 6] == player:
-                return True
-
-        # Check diagonals
-        if self.board[0] == self.board[4] == self.board[8] == player:
-            return True
-        if self.board[2] == self.board[4] == self.board[6] == player:
-            return True
-
-        return False
+        return self.position.has_won(player)
 
     def check_game_status(self):
-        if self.is_winner("X"):
+        position = self.position
+        if position.has_won("X"):
             self.status = "X_WON"
-        elif self.is_winner("O"):
+        elif position.has_won("O"):
             self.status = "O_WON"
-        elif "-" not in self.board:
+        elif position.is_full():
             self.status = "DRAW"
         self.save()
 
     def get_winning_move(self, player):
         # Check if there's a winning move for the given player
-        for i in range(9):
-            if self.board[i] == "-":
-                # Try the move
-                board_list = list(self.board)
-                board_list[i] = player
-                temp_board = "".join(board_list)
-
-                # Check rows
-                for j in range(0, 9, 3):
-                    if temp_board[j : j + 3] == player * 3:
-                        return i
-
-                # Check columns
-                for j in range(3):
-                    if (
-                        temp_board[j]
-                        == temp_board[j + 3]
-                        == temp_board[j + 6]
-                        == player
-                    ):
-                        return i
-
-                # Check diagonals
-                if temp_board[0] == temp_board[4] == temp_board[8] == player:
-                    return i
-                if temp_board[2] == temp_board[4] == temp_board[6] == player:
-                    return i
-
-        return None
+        return self.position.winning_move(player)
 
     def get_strategic_move(self):
         # Priority positions (center, corners, then sides)
-        priority_positions = [4, 0, 2, 6, 8, 1, 3, 5, 7]
-
-        for pos in priority_positions:
-            if self.board[pos] == "-":
-                return pos
-        return None
-
-    def bot_move(self):
+        if self.geometry is STANDARD:
+            return engine.strategic_move(self.board)
+        return self.position.strategic_move()
+
+    def get_heuristic_move(self):
+        """Win, else block, else the strategic cell. Cheap on any board size"""
+        move = self.get_winning_move("O")
+        if move is None:
+            move = self.get_winning_move("X")
+        if move is None:
+            move = self.get_strategic_move()
+        return move
+
+    def bot_move(self, save=True):
         """
-        Bot (O) makes a move using the following strategy:
-        1. Win if possible
-        2. Block player's winning move
-        3. Make a strategic move
+        Bot (O) makes a move. On 3x3 it is looked up from the precomputed
+        engine tables in the style from settings.XO_BOT_STYLE:
+        - heuristic: win if possible, block player's winning move,
+          otherwise make a strategic move
+        - perfect: minimax, the bot never loses
+        Larger boards are searched within settings.XO_BOT_TIME_BUDGET seconds,
+        in the engine pool when XO_ENGINE_WORKERS is set. If the pool misses
+        its deadline the bot plays the heuristic move instead.
         """
         if self.current_turn != "O" or self.status != "IN_PROGRESS":
             return False
 
-        # Try to win
-        winning_move = self.get_winning_move("O")
-        if winning_move is not None:
-            self.make_move(winning_move)
-            return True
+        if self.geometry is STANDARD:
+            style = getattr(settings, "XO_BOT_STYLE", engine.HEURISTIC)
+            move = engine.best_move(self.board, style)
+        else:
+            budget = getattr(settings, "XO_BOT_TIME_BUDGET", 0.2)
+            executor = get_engine_executor()
+            if executor is None:
+                move = search.best_move(self.position, "O", budget)
+            else:
+                move = executor.best_move(self.board, self.size, self.win_length, "O", budget)
+                if move is None:
+                    move = self.get_heuristic_move()
+        if move is None:
+            return False
+
+        self.make_move(move, save=save)
+        return True
 
-        # Block player's winning move
-        blocking_move = self.get_winning_move("X")
-        if blocking_move is not None:
-            self.make_move(blocking_move)
-            return True
+    def play_turn(self, position, expected_version=None):
+        """
+        Apply the player's move and the bot's reply in memory, without
+        saving. Returns False if the bot could not reply. Raises
+        GameConflict if expected_version is given and the game has moved on.
+        """
+        if expected_version is not None and expected_version != self.version:
+            raise GameConflict(f"Game {self.pk} is at version {self.version}")
 
-        # Make a strategic move
-        strategic_move = self.get_strategic_move()
-        if strategic_move is not None:
-            self.make_move(strategic_move)
-            return True
+        self.make_move(position, save=False)
+        if self.status == "IN_PROGRESS":
+            return self.bot_move(save=False)
+        return True
 
-        return False
+    def save_turn(self):
+        """
+        Write the turn with a single conditional UPDATE on the loaded
+        version. Raises GameConflict if another request saved first.
+        """
+        games = Game.objects.using(self._state.db)
+        updated = games.filter(pk=self.pk, version=self.version).update(
+            x_cells=self.x_cells,
+            o_cells=self.o_cells,
+            current_turn=self.current_turn,
+            status=self.status,
+            version=self.version + 1,
+            updated_at=timezone.now(),
+        )
+        if not updated:
+            self.take_stats()
+            raise GameConflict(f"Game {self.pk} changed since version {self.version}")
+        self.version += 1
+        self.record_stats()
+
+    def get_status_message(self) -> str:
+        if self.status == "X_WON":
+            return "Game Over - You Won! 🎉"
+        elif self.status == "O_WON":
+            return "Game Over - Bot Won! 🤖"
+        elif self.status == "DRAW":
+            return "Game Over - It's a Draw! 🤝"
+        return "Your turn! Select a position to play: (you can reset with /restart)"
 
     def get_button_grid(self) -> list:
         """
-        Convert the game state into a 3x3 button grid for the chatbot
+        Convert the game state into a size x size button grid for the chatbot
         Returns a list of button rows suitable for the chatbot client
         """
-        button_rows = []
-        symbols = {"X": "❌", "O": "⭕", "-": "➖"}
-
-        # Create 3 rows of buttons
-        for row in range(3):
-            row_buttons = []
-            for col in range(3):
-                position = row * 3 + col
-                symbol = symbols[self.board[position]]
-
-                # Create button data
-                button_data = {
-                    "caption": symbol,
-                    "action": {
-                        "get_dynamic_action": {
-                            "data": {
-                                "game_id": str(self.id),
-                                "position": str(position),
-                                "action": "move",
-                                "disabled": str(self.board[position] != "-"),
-                            }
-                        }
-                    },
-                }
-
-                # If the position is already taken or game is not in progress,
-                # make the button non-interactive
-
-                row_buttons.append(button_data)
-
-            button_rows.append({"buttons": row_buttons})
-
-        return button_rows
+        return render.build_button_grid(self.board, self.ref, self.version)
+
+    def render_message(self, status_message=None) -> bytes:
+        """Serialized message payload for the current board, from the render cache"""
+        if status_message is None:
+            status_message = self.get_status_message()
+        return render.render_message(self.board, self.ref, self.version, status_message)
+
+
+class ArchivedGame(models.Model):
+    """Final state of a game removed from the game table by the sweeper"""
+
+    game_id = models.BigIntegerField()
+    conversation_id = models.CharField(max_length=100)
+    board = models.CharField(max_length=49)
+    size = models.PositiveSmallIntegerField(default=3)
+    win_length = models.PositiveSmallIntegerField(default=3)
+    status = models.CharField(max_length=20, choices=Game.GAME_STATUS_CHOICES)
+    version = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"Archived game {self.conversation_id} - {self.status}"
+
+
+class MovedGame(models.Model):
+    """
+    Where rebalance_games moved a game of this shard, so taps on boards
+    sent before the move still find it (see GameStore.load)
+    """
+
+    game_id = models.BigIntegerField(primary_key=True)
+    # Game ref on the shard it moved to
+    ref = models.CharField(max_length=32)
+    moved_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Game {self.game_id} moved to {self.ref}"
@@ -0,0 +1,103 @@
+"""
+Render cache for board messages.
+
+The button grid for a board only differs between games by game_id and
+version, so the full message payload is serialized once per (board, status
+message) with placeholders in their place. Rendering a turn is then a bytes
+join. The cache is an LRU bounded by settings.XO_RENDER_CACHE_SIZE, sized
+by default to hold every reachable 3x3 board.
+"""
+
+import json
+import math
+from functools import lru_cache
+from typing import Tuple
+
+from django.conf import settings
+
+from chatbot.client import build_message_payload
+
+SYMBOLS = {"X": "❌", "O": "⭕", "-": "➖"}
+
+GAME_ID_PLACEHOLDER = "\x1fgame_id\x1f"
+VERSION_PLACEHOLDER = "\x1fversion\x1f"
+_GAME_ID_BYTES = json.dumps(GAME_ID_PLACEHOLDER)[1:-1].encode()
+_VERSION_BYTES = json.dumps(VERSION_PLACEHOLDER)[1:-1].encode()
+
+
+def build_button_grid(board: str, game_id, version=0) -> list:
+    """Return the button rows for board, one row per board row"""
+    button_rows = []
+    size = math.isqrt(len(board))
+
+    # Create size rows of buttons
+    for row in range(size):
+        row_buttons = []
+        for col in range(size):
+            position = row * size + col
+            symbol = SYMBOLS[board[position]]
+
+            # Create button data
+            button_data = {
+                "caption": symbol,
+                "action": {
+                    "get_dynamic_action": {
+                        "data": {
+                            "game_id": str(game_id),
+                            "version": str(version),
+                            "position": str(position),
+                            "action": "move",
+                            "disabled": str(board[position] != "-"),
+                        }
+                    }
+                },
+            }
+
+            row_buttons.append(button_data)
+
+        button_rows.append({"buttons": row_buttons})
+
+    return button_rows
+
+
+def serialize(payload) -> bytes:
+    """Encode a payload the same way httpx encodes json= bodies"""
+    return json.dumps(
+        payload, ensure_ascii=False, separators=(",", ":"), allow_nan=False
+    ).encode("utf-8")
+
+
+def _build_template(board: str, status_message: str) -> Tuple[Tuple[bytes, ...], ...]:
+    """
+    Serialized payload split on the game_id placeholders, each chunk split
+    again on the version placeholders
+    """
+    payload = build_message_payload(
+        status_message,
+        build_button_grid(board, GAME_ID_PLACEHOLDER, VERSION_PLACEHOLDER),
+    )
+    return tuple(
+        tuple(chunk.split(_VERSION_BYTES))
+        for chunk in serialize(payload).split(_GAME_ID_BYTES)
+    )
+
+
+_template = lru_cache(maxsize=getattr(settings, "XO_RENDER_CACHE_SIZE", 6000))(
+    _build_template
+)
+
+
+def render_message(board: str, game_id, version, status_message: str) -> bytes:
+    """Serialized message payload for board with game_id and version filled in"""
+    version = str(version).encode()
+    return str(game_id).encode().join(
+        [version.join(chunk) for chunk in _template(board, status_message)]
+    )
+
+
+def cache_info():
+    return _template.cache_info()
+
+
+def cache_clear():
+    _template.cache_clear()
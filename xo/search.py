@@ -0,0 +1,258 @@
+"""
+Bot move search for boards larger than 3x3.
+
+Iterative-deepening negamax with alpha-beta pruning over bitboard
+positions. Moves are ordered by the transposition table's best move, then
+immediate wins and blocks, then cells on the most lines. Positions are
+keyed by Zobrist hashes in a bounded transposition table kept per board
+geometry, so work carries over between the bot's turns. The search stops
+at a per-move time budget and plays the best move of the last completed
+depth.
+"""
+
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .bitboard import Geometry, Position, geometry
+
+WIN = 1_000_000
+
+# Transposition table entry flags
+EXACT, LOWER, UPPER = 0, 1, 2
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class SearchResult:
+    __slots__ = ("move", "score", "depth", "nodes", "complete")
+
+    def __init__(self, move, score, depth, nodes, complete):
+        self.move = move
+        self.score = score
+        self.depth = depth
+        self.nodes = nodes
+        self.complete = complete
+
+    def __repr__(self):
+        return (
+            f"SearchResult(move={self.move}, score={self.score}, depth={self.depth}, "
+            f"nodes={self.nodes}, complete={self.complete})"
+        )
+
+
+def _popcount(mask: int) -> int:
+    return bin(mask).count("1")
+
+
+class Searcher:
+    def __init__(self, geometry: Geometry, max_entries: int = 200_000, seed: int = 0):
+        self.geometry = geometry
+        self.max_entries = max_entries
+        rng = random.Random(seed)
+        # zobrist[0] for X, zobrist[1] for O
+        self.zobrist = tuple(
+            tuple(rng.getrandbits(64) for _ in range(geometry.cells)) for _ in range(2)
+        )
+        self.table: Dict[int, Tuple[int, int, int, Optional[int]]] = {}
+        # Line masks through each cell, for evaluation and win checks
+        self.cell_lines = tuple(
+            tuple(mask for mask in geometry.win_masks if mask >> i & 1)
+            for i in range(geometry.cells)
+        )
+        # Weight of n marks in an open line
+        self.weights = tuple(4**n if n else 0 for n in range(geometry.win_length + 1))
+
+        self._deadline = 0.0
+        self._nodes = 0
+
+    def hash(self, position: Position) -> int:
+        h = 0
+        for i in range(self.geometry.cells):
+            if position.x >> i & 1:
+                h ^= self.zobrist[0][i]
+            elif position.o >> i & 1:
+                h ^= self.zobrist[1][i]
+        return h
+
+    def evaluate(self, me: int, opponent: int) -> int:
+        """Static score for the side to move: open lines weighted by their marks"""
+        score = 0
+        weights = self.weights
+        for line in self.geometry.win_masks:
+            mine = me & line
+            theirs = opponent & line
+            if mine and not theirs:
+                score += weights[_popcount(mine)]
+            elif theirs and not mine:
+                score -= weights[_popcount(theirs)]
+        return score
+
+    def _completes(self, mask: int, cell: int) -> bool:
+        mask |= 1 << cell
+        for line in self.cell_lines[cell]:
+            if mask & line == line:
+                return True
+        return False
+
+    def ordered_moves(
+        self, me: int, opponent: int, empty: int, first: Optional[int]
+    ) -> List[int]:
+        wins, blocks, rest = [], [], []
+        for i in self.geometry.priority:
+            if not empty >> i & 1 or i == first:
+                continue
+            if self._completes(me, i):
+                wins.append(i)
+            elif self._completes(opponent, i):
+                blocks.append(i)
+            else:
+                rest.append(i)
+        moves = wins + blocks + rest
+        if first is not None and empty >> first & 1:
+            moves.insert(0, first)
+        return moves
+
+    def _negamax(self, me, opponent, side, h, depth, ply, alpha, beta):
+        self._nodes += 1
+        if self._nodes & 1023 == 0 and time.perf_counter() > self._deadline:
+            raise SearchTimeout
+
+        empty = self.geometry.full_mask & ~(me | opponent)
+        if not empty:
+            return 0
+        if depth == 0:
+            return self.evaluate(me, opponent)
+
+        alpha_orig = alpha
+        entry = self.table.get(h)
+        tt_move = None
+        if entry is not None:
+            entry_depth, score, flag, tt_move = entry
+            if entry_depth >= depth:
+                # Stored win scores are relative to the stored node
+                if score > WIN - 1000:
+                    score -= ply
+                elif score < -WIN + 1000:
+                    score += ply
+                if flag == EXACT:
+                    return score
+                if flag == LOWER:
+                    alpha = max(alpha, score)
+                elif flag == UPPER:
+                    beta = min(beta, score)
+                if alpha >= beta:
+                    return score
+
+        best_score, best_move = -WIN * 2, None
+        zobrist = self.zobrist[side]
+        for move in self.ordered_moves(me, opponent, empty, tt_move):
+            if self._completes(me, move):
+                score = WIN - ply
+            else:
+                score = -self._negamax(
+                    opponent,
+                    me | 1 << move,
+                    1 - side,
+                    h ^ zobrist[move],
+                    depth - 1,
+                    ply + 1,
+                    -beta,
+                    -alpha,
+                )
+            if score > best_score:
+                best_score, best_move = score, move
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+
+        stored = best_score
+        if stored > WIN - 1000:
+            stored += ply
+        elif stored < -WIN + 1000:
+            stored -= ply
+        if best_score <= alpha_orig:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        if len(self.table) >= self.max_entries:
+            self.table.clear()
+        self.table[h] = (depth, stored, flag, best_move)
+        return best_score
+
+    def search(
+        self,
+        position: Position,
+        player: str = "O",
+        budget: float = 0.2,
+        max_depth: Optional[int] = None,
+    ) -> SearchResult:
+        """Search position for player within budget seconds"""
+        side = 0 if player == "X" else 1
+        me, opponent = (position.x, position.o) if side == 0 else (position.o, position.x)
+        empty = self.geometry.full_mask & ~(me | opponent)
+        remaining = _popcount(empty)
+        if not remaining:
+            return SearchResult(None, 0, 0, 0, True)
+        max_depth = min(max_depth or remaining, remaining)
+
+        h = self.hash(position)
+        self._deadline = time.perf_counter() + budget
+        self._nodes = 0
+
+        # Fallback if not even depth 1 completes: ordering puts wins and blocks first
+        result = SearchResult(
+            self.ordered_moves(me, opponent, empty, None)[0], 0, 0, 0, False
+        )
+        for depth in range(1, max_depth + 1):
+            try:
+                score = self._negamax(me, opponent, side, h, depth, 0, -WIN * 2, WIN * 2)
+            except SearchTimeout:
+                break
+            entry = self.table.get(h)
+            move = entry[3] if entry is not None and entry[3] is not None else result.move
+            result = SearchResult(move, score, depth, self._nodes, depth == remaining)
+            if abs(score) > WIN - 1000:
+                # Forced win or loss found, deeper search won't change it
+                result.complete = True
+                break
+        result.nodes = self._nodes
+        return result
+
+
+_local = threading.local()
+
+
+def get_searcher(geometry: Geometry) -> Searcher:
+    """Searcher for geometry, one per thread since a search keeps state"""
+    searchers = getattr(_local, "searchers", None)
+    if searchers is None:
+        searchers = _local.searchers = {}
+    key = (geometry.size, geometry.win_length)
+    searcher = searchers.get(key)
+    if searcher is None:
+        searcher = searchers[key] = Searcher(geometry)
+    return searcher
+
+
+def best_move(position: Position, player: str = "O", budget: float = 0.2) -> Optional[int]:
+    return get_searcher(position.geometry).search(position, player, budget).move
+
+
+def warm(geometries) -> int:
+    """Build searchers for (size, win_length) pairs ahead of the first move"""
+    for size, win_length in geometries:
+        get_searcher(geometry(size, win_length))
+    return os.getpid()
+
+
+def search_board(board: str, size: int, win_length: int, player: str, budget: float):
+    """best_move from a board string, for running in another process"""
+    position = Position.from_string(board, geometry(size, win_length))
+    return best_move(position, player, budget)
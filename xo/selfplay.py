@@ -0,0 +1,175 @@
+"""
+Exhaustive self-play for the bot engines, without the database.
+
+play_all() answers every possible sequence of player (X) moves with a bot
+policy, a function from board string to the bot's move. The game tree is
+walked a ply at a time: the boards the bot faces at each ply are collected
+with the number of move sequences reaching them, so each distinct board is
+asked once per engine however many games pass through it. The result has
+the games won, drawn and lost by the bot (each move sequence is one game),
+moves the policy got wrong, and the latency of every policy call.
+
+POLICIES maps engine names to policy factories. "game" drives
+Game.bot_move itself on an unsaved Game, so the code the webhooks run is
+covered too. See the selfplay management command.
+"""
+
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+from ehsandar.metrics import percentile
+from . import engine, search
+from .bitboard import Position, geometry
+from .models import Game
+
+Policy = Callable[[str], Optional[int]]
+
+
+def table_policy(style: str) -> Callable[..., Policy]:
+    def factory(size=3, win_length=3, budget=0.2):
+        if (size, win_length) != (3, 3):
+            raise ValueError("The move tables only cover 3x3 boards")
+        # Build the tables now rather than in the first timed call
+        engine.get_tables()
+        return lambda board: engine.best_move(board, style)
+
+    return factory
+
+
+def rules_policy(size=3, win_length=3, budget=0.2) -> Policy:
+    """Win, block, then the strategic cell, straight from the bitboard"""
+    shape = geometry(size, win_length)
+
+    def policy(board):
+        position = Position.from_string(board, shape)
+        move = position.winning_move("O")
+        if move is None:
+            move = position.winning_move("X")
+        if move is None:
+            move = position.strategic_move()
+        return move
+
+    return policy
+
+
+def search_policy(size=3, win_length=3, budget=0.2) -> Policy:
+    shape = geometry(size, win_length)
+    return lambda board: search.best_move(Position.from_string(board, shape), "O", budget)
+
+
+def game_policy(size=3, win_length=3, budget=0.2) -> Policy:
+    """Game.bot_move on an unsaved game, with the bot settings in effect"""
+
+    def policy(board):
+        game = Game(board=board, size=size, win_length=win_length, current_turn="O")
+        if not game.bot_move(save=False):
+            return None
+        return next(i for i, (a, b) in enumerate(zip(board, game.board)) if a != b)
+
+    return policy
+
+
+POLICIES: Dict[str, Callable[..., Policy]] = {
+    engine.HEURISTIC: table_policy(engine.HEURISTIC),
+    engine.PERFECT: table_policy(engine.PERFECT),
+    "rules": rules_policy,
+    "search": search_policy,
+    "game": game_policy,
+}
+
+
+class SelfPlayResult:
+    def __init__(self, name: str):
+        self.name = name
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+        self.illegal = 0
+        # Boards the bot lost on, right after the player's winning move
+        self.lost_boards: List[str] = []
+        # Seconds per policy call
+        self.latencies: List[float] = []
+
+    @property
+    def games(self) -> int:
+        return self.wins + self.draws + self.losses + self.illegal
+
+    @property
+    def moves(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def moves_per_second(self) -> float:
+        elapsed = sum(self.latencies)
+        return self.moves / elapsed if elapsed else 0.0
+
+    def percentile(self, pct: float) -> float:
+        """Policy latency percentile, in seconds"""
+        return percentile(sorted(self.latencies), pct) or 0.0
+
+    def __repr__(self):
+        return (
+            f"SelfPlayResult({self.name}, games={self.games}, wins={self.wins}, "
+            f"draws={self.draws}, losses={self.losses}, illegal={self.illegal})"
+        )
+
+
+def _place(board: str, position: int, player: str) -> str:
+    return board[:position] + player + board[position + 1 :]
+
+
+def play_all(
+    policy: Policy, size: int = 3, win_length: int = 3, name: str = "", max_lost_boards: int = 10
+) -> SelfPlayResult:
+    """Play policy as O against every sequence of X moves, X moving first"""
+    shape = geometry(size, win_length)
+    result = SelfPlayResult(name)
+    frontier = {"-" * shape.cells: 1}
+    while frontier:
+        # The player's moves, collecting the boards the bot has to answer
+        to_answer = defaultdict(int)
+        for board, count in frontier.items():
+            for cell, mark in enumerate(board):
+                if mark != "-":
+                    continue
+                after = _place(board, cell, "X")
+                position = Position.from_string(after, shape)
+                if position.has_won("X"):
+                    result.losses += count
+                    if len(result.lost_boards) < max_lost_boards:
+                        result.lost_boards.append(after)
+                elif position.is_full():
+                    result.draws += count
+                else:
+                    to_answer[after] += count
+
+        # One policy call per distinct board
+        frontier = defaultdict(int)
+        for board, count in to_answer.items():
+            start = time.perf_counter()
+            move = policy(board)
+            result.latencies.append(time.perf_counter() - start)
+            if move is None or not (0 <= move < shape.cells) or board[move] != "-":
+                result.illegal += count
+                continue
+            after = _place(board, move, "O")
+            position = Position.from_string(after, shape)
+            if position.has_won("O"):
+                result.wins += count
+            elif position.is_full():
+                result.draws += count
+            else:
+                frontier[after] += count
+    return result
+
+
+def benchmark(
+    names=None, size: int = 3, win_length: int = 3, budget: float = 0.2
+) -> List[SelfPlayResult]:
+    """play_all for each named engine, all of POLICIES by default"""
+    results = []
+    for name in names or POLICIES:
+        policy = POLICIES[name](size=size, win_length=win_length, budget=budget)
+        results.append(play_all(policy, size, win_length, name=name))
+    return results
@@ -0,0 +1,94 @@
+"""
+Placement of games on several databases.
+
+settings.XO_SHARDS lists the database aliases that hold games, each with
+every xo table (migrate them with `manage.py migrate xo --database <alias>`).
+A game lives on the shard picked by a jump consistent hash of its
+conversation_id, so the same conversation always lands on the same
+database, and appending a shard only moves about 1/N of the conversations
+(see the rebalance_games command). Only ever append to XO_SHARDS: button
+payloads refer to shards by position.
+
+Game ids are only unique within a shard, so buttons carry a game ref:
+"<shard index>:<pk>", or the bare pk on the first shard, which keeps the
+ids sent before sharding valid. ShardRouter sends Game saves to the right
+shard. Queries by pk or conversation go through Game.objects.using(alias),
+see xo.store.
+"""
+
+import hashlib
+from typing import Tuple
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+def shards() -> Tuple[str, ...]:
+    return tuple(getattr(settings, "XO_SHARDS", (DEFAULT_DB_ALIAS,)))
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Lamping and Veach's jump consistent hash of a 64-bit key"""
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (1 << 31) / ((key >> 33) + 1))
+    return b
+
+
+def shard_index(conversation_id: str, count: int = None) -> int:
+    """Position in XO_SHARDS (of count shards) of the conversation's shard"""
+    digest = hashlib.blake2b(str(conversation_id).encode(), digest_size=8).digest()
+    return jump_hash(int.from_bytes(digest, "big"), count or len(shards()))
+
+
+def shard_for(conversation_id: str) -> str:
+    """Database alias holding the conversation's game"""
+    return shards()[shard_index(conversation_id)]
+
+
+def game_ref(using: str, pk) -> str:
+    """The id a game's buttons carry"""
+    index = shards().index(using)
+    return str(pk) if index == 0 else f"{index}:{pk}"
+
+
+def parse_ref(ref) -> Tuple[str, int]:
+    """(database alias, pk) of a game ref. Raises ValueError for a bad ref"""
+    index, _, pk = str(ref).rpartition(":")
+    index = int(index) if index else 0
+    aliases = shards()
+    if not 0 <= index < len(aliases):
+        raise ValueError(f"Unknown shard in game ref {ref!r}")
+    return aliases[index], int(pk)
+
+
+class ShardRouter:
+    """
+    Saves of a Game go to the database it was loaded from, or for a new
+    game to its conversation's shard. xo tables are only created on the
+    shards, other apps only on the default database.
+    """
+
+    def _game_db(self, model, instance):
+        if instance is None or model._meta.model_name != "game":
+            return None
+        if instance._state.db:
+            return instance._state.db
+        if instance.conversation_id:
+            return shard_for(instance.conversation_id)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._game_db(model, hints.get("instance"))
+
+    def db_for_write(self, model, **hints):
+        return self._game_db(model, hints.get("instance"))
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == "xo":
+            return db in shards()
+        if db != DEFAULT_DB_ALIAS:
+            return False
+        return None
@@ -0,0 +1,129 @@
+"""
+Game statistics for dashboards, read from HourlyStats instead of the game
+table.
+
+Counters are bumped as games change status: "started" when a game is
+created or restarted, "abandoned" when a game still in progress is
+restarted, and x_won / o_won / draw when a saved turn finishes it. Turns
+that conflict are never counted. Active games are the ones started and
+neither finished nor abandoned, so every read is a sum over one row per
+hour. Every shard (see xo.shards) keeps the counters of its own games and
+reads add them up.
+
+rebuild() recounts the rows from the game and archived game tables in
+chunks (see the rebuild_stats command) and fills in what is missing. A
+game row is reused on restart, so only the latest game of each
+conversation survives there, and abandoned games leave no trace at all:
+the tables only give a lower bound for each hour. A rebuild raises the
+started and finished counters to that bound and never lowers a counter
+or touches abandoned, so the history it can't see is kept.
+"""
+
+from collections import defaultdict
+from datetime import timedelta
+from typing import Dict, List
+
+from django.db import transaction
+from django.db.models import Sum
+
+from .models import STATUS_EVENTS, ArchivedGame, Game, HourlyStats
+from .shards import shards
+
+
+def totals(rows) -> Dict:
+    """Counters summed over rows, with the derived active count and rates"""
+    summary = {field: 0 for field in HourlyStats.FIELDS}
+    for row in rows:
+        for field in HourlyStats.FIELDS:
+            summary[field] += row[field] or 0
+    finished = summary["x_won"] + summary["o_won"] + summary["draw"]
+    summary["finished"] = finished
+    summary["active"] = summary["started"] - finished - summary["abandoned"]
+    for field, rate in (("x_won", "win_rate"), ("o_won", "loss_rate"), ("draw", "draw_rate")):
+        summary[rate] = summary[field] / finished if finished else 0.0
+    return summary
+
+
+def summary() -> Dict:
+    """All-time counters, one aggregate over the hourly rows of each shard"""
+    sums = {field: Sum(field) for field in HourlyStats.FIELDS}
+    return totals([HourlyStats.objects.using(using).aggregate(**sums) for using in shards()])
+
+
+def hourly(hours: int = 24) -> List[Dict]:
+    """Counters for each of the last hours that had any games, oldest first"""
+    since = HourlyStats.hour_of() - timedelta(hours=hours - 1)
+    merged = {}
+    for using in shards():
+        rows = HourlyStats.objects.using(using).filter(hour__gte=since)
+        for row in rows.values("hour", *HourlyStats.FIELDS):
+            current = merged.setdefault(row["hour"], dict.fromkeys(HourlyStats.FIELDS, 0))
+            for field in HourlyStats.FIELDS:
+                current[field] += row[field]
+    return [dict(merged[hour], hour=hour.isoformat()) for hour in sorted(merged)]
+
+
+def rebuild(chunk_size: int = 1000, progress=None) -> int:
+    """rebuild_shard on every shard, returns the number of games read"""
+    return sum(rebuild_shard(using, chunk_size, progress) for using in shards())
+
+
+def _count(counts, rows, chunk_size, progress, read):
+    """Add the started and finished counts of rows (pk, status, created, updated)"""
+    last_pk = 0
+    while True:
+        chunk = list(rows.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            return read
+        for pk, status, created_at, updated_at in chunk:
+            counts[HourlyStats.hour_of(created_at)]["started"] += 1
+            if status in STATUS_EVENTS:
+                counts[HourlyStats.hour_of(updated_at)][STATUS_EVENTS[status]] += 1
+        last_pk = chunk[-1][0]
+        read += len(chunk)
+        if progress is not None:
+            progress(read)
+
+
+def rebuild_shard(using: str, chunk_size: int = 1000, progress=None) -> int:
+    """
+    Recount HourlyStats of the using shard from its game and archived game
+    tables, reading chunk_size rows at a time by primary key, and raise
+    each counter to its recount. The rows are updated in one transaction
+    at the end, turns finished while the games are read may be missed.
+    Returns the number of games read.
+    """
+    counts = defaultdict(lambda: defaultdict(int))
+    fields = ("pk", "status", "created_at", "updated_at")
+    read = _count(
+        counts,
+        Game.objects.using(using).order_by("pk").values_list(*fields),
+        chunk_size,
+        progress,
+        0,
+    )
+    read = _count(
+        counts,
+        ArchivedGame.objects.using(using).order_by("pk").values_list(*fields),
+        chunk_size,
+        progress,
+        read,
+    )
+
+    rows = HourlyStats.objects.using(using)
+    with transaction.atomic(using=using):
+        existing = {row.hour: row for row in rows.filter(hour__in=list(counts))}
+        changed, created = [], []
+        for hour, recount in sorted(counts.items()):
+            row = existing.get(hour)
+            if row is None:
+                created.append(HourlyStats(hour=hour, **recount))
+                continue
+            raised = {f: n for f, n in recount.items() if n > getattr(row, f)}
+            if raised:
+                for field, n in raised.items():
+                    setattr(row, field, n)
+                changed.append(row)
+        rows.bulk_create(created, batch_size=chunk_size)
+        rows.bulk_update(changed, HourlyStats.FIELDS, batch_size=chunk_size)
+    return read
@@ -0,0 +1,332 @@
+"""
+Game state access for the webhook views.
+
+GameStore reads games straight from the database and writes each turn back
+with a single conditional UPDATE on the game's version (see
+Game.save_turn), so concurrent turns on one game raise GameConflict instead
+of overwriting each other. Games live on their conversation's shard and
+turns find them by the game ref their buttons carry (see xo.shards), or
+the MovedGame left behind when rebalance_games moved the game.
+Writes go through ehsandar.dbwriter, which serializes them on one thread
+per database when DB_SERIALIZED_WRITES is on. CachedGameStore keeps active
+games in memory, keyed by game ref and conversation id, serves reads from
+there and writes changed fields back once per turn or, with a flush
+interval, in batches from a background thread. Entries are evicted by LRU
+and idle TTL, and dirty games are flushed before eviction and on shutdown.
+
+The cache is per process, so it is only safe when every request of a
+conversation reaches the same worker (a single worker, or sticky routing).
+"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from ehsandar.dbwriter import write_using
+from ehsandar.metrics import timer
+from .models import Game, MovedGame
+from .shards import parse_ref, shard_for
+from .sweeper import start_background_sweeper
+
+logger = logging.getLogger(__name__)
+
+STATE_FIELDS = ("x_cells", "o_cells", "current_turn", "status")
+
+
+def _state(game: Game):
+    return tuple(getattr(game, field) for field in STATE_FIELDS)
+
+
+class GameStore:
+    """Database-backed store, one query to load and one update per turn"""
+
+    def get_or_create(self, conversation_id: str) -> Game:
+        using = shard_for(conversation_id)
+        games = Game.objects.using(using)
+        with timer("game_load"):
+            game = games.filter(conversation_id=conversation_id).first()
+        if game is None:
+            with timer("game_save"):
+                game, created = write_using(
+                    using, games.get_or_create, conversation_id=conversation_id
+                )
+        return game
+
+    def restart(
+        self, conversation_id: str, size: int = 3, win_length: int = 3, after_version: int = 0
+    ) -> Game:
+        with timer("game_restart"):
+            return write_using(
+                shard_for(conversation_id),
+                Game.restart,
+                conversation_id,
+                size,
+                win_length,
+                after_version,
+            )
+
+    def load(self, game_ref: str) -> Game:
+        """The game of a ref, following it to where rebalance_games moved it"""
+        using, pk = parse_ref(game_ref)
+        with timer("game_load"):
+            try:
+                return Game.objects.using(using).get(pk=pk)
+            except Game.DoesNotExist:
+                moved = MovedGame.objects.using(using).filter(game_id=pk).first()
+                if moved is None:
+                    raise
+        return self.load(moved.ref)
+
+    @contextmanager
+    def turn(self, game_ref: str):
+        """Yield the game for a turn and save it once if it changed"""
+        game = self.load(game_ref)
+        before = _state(game)
+        yield game
+        if _state(game) != before:
+            with timer("game_save"):
+                write_using(game._state.db, game.save_turn)
+
+    def flush(self):
+        pass
+
+
+class _Entry:
+    __slots__ = ("game", "lock", "last_access", "persisted_version")
+
+    def __init__(self, game: Game):
+        self.game = game
+        self.lock = threading.RLock()
+        self.last_access = time.monotonic()
+        self.persisted_version = game.version
+
+
+class CachedGameStore(GameStore):
+    def __init__(
+        self, max_entries: int = 10000, ttl: float = 600.0, flush_interval: float = 0.0
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._by_conversation: Dict[str, str] = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+        # Games dropped because the database moved on underneath the cache
+        self.conflicts = 0
+
+        if flush_interval > 0:
+            self._flusher = threading.Thread(
+                target=self._run_flusher, name="xo-game-flusher", daemon=True
+            )
+            self._flusher.start()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _insert(self, game: Game) -> _Entry:
+        entry = _Entry(game)
+        with self._lock:
+            self._entries[game.ref] = entry
+            self._by_conversation[game.conversation_id] = game.ref
+            evicted = self._evict()
+        self._write(evicted)
+        return entry
+
+    def _evict(self):
+        """Drop expired and least recently used entries, return dirty ones"""
+        evicted = []
+        now = time.monotonic()
+        while self._entries:
+            game_ref, entry = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and now - entry.last_access < self.ttl:
+                break
+            del self._entries[game_ref]
+            if self._by_conversation.get(entry.game.conversation_id) == game_ref:
+                del self._by_conversation[entry.game.conversation_id]
+            if game_ref in self._dirty:
+                self._dirty.discard(game_ref)
+                evicted.append(entry)
+        return evicted
+
+    def _lookup(self, game_ref: str) -> Optional[_Entry]:
+        with self._lock:
+            entry = self._entries.get(game_ref)
+            if entry is None:
+                return None
+            if time.monotonic() - entry.last_access >= self.ttl and game_ref not in self._dirty:
+                del self._entries[game_ref]
+                self._by_conversation.pop(entry.game.conversation_id, None)
+                return None
+            entry.last_access = time.monotonic()
+            self._entries.move_to_end(game_ref)
+            return entry
+
+    def get_or_create(self, conversation_id: str) -> Game:
+        game_ref = self._by_conversation.get(conversation_id)
+        entry = self._lookup(game_ref) if game_ref is not None else None
+        if entry is not None:
+            return entry.game
+        return self._insert(super().get_or_create(conversation_id)).game
+
+    def restart(
+        self, conversation_id: str, size: int = 3, win_length: int = 3, after_version: int = 0
+    ) -> Game:
+        entry, dirty = self._forget(conversation_id)
+        if entry is not None:
+            if dirty:
+                # Write back turns not flushed yet, so a game finished in
+                # memory isn't restarted as abandoned
+                self._write([entry])
+            # Buttons of the new board must not carry a version the old ones did
+            after_version = max(after_version, entry.game.version)
+        return self._insert(
+            super().restart(conversation_id, size, win_length, after_version)
+        ).game
+
+    def _forget(self, conversation_id: str):
+        """Drop the cached game of a conversation, returns (entry, dirty)"""
+        with self._lock:
+            game_ref = self._by_conversation.pop(conversation_id, None)
+            if game_ref is None:
+                return None, False
+            dirty = game_ref in self._dirty
+            self._dirty.discard(game_ref)
+            return self._entries.pop(game_ref, None), dirty
+
+    def discard(self, conversation_id: str):
+        """Forget the cached game of a conversation without writing it back"""
+        self._forget(conversation_id)
+
+    @contextmanager
+    def turn(self, game_ref: str):
+        game_ref = str(game_ref)
+        entry = self._lookup(game_ref)
+        if entry is None:
+            game = self.load(game_ref)
+            # A moved game's old ref loads the entry of its new one
+            entry = self._lookup(game.ref) or self._insert(game)
+
+        with entry.lock:
+            game = entry.game
+            before = _state(game)
+            pending = len(game._stats_events)
+            try:
+                yield game
+            except Exception:
+                # Undo a half-played turn, earlier turns not flushed yet stay dirty
+                if _state(game) != before:
+                    for field, value in zip(STATE_FIELDS, before):
+                        setattr(game, field, value)
+                    del game._stats_events[pending:]
+                raise
+            if _state(game) == before:
+                return
+            if self.flush_interval > 0:
+                # Advance the version now so buttons of this turn carry it
+                game.version += 1
+                with self._lock:
+                    self._dirty.add(game_ref)
+                return
+            try:
+                with timer("game_save"):
+                    write_using(game._state.db, game.save_turn)
+            except Exception:
+                # The database moved on or the write failed, reload it next time.
+                # Nothing is dirty without a flush interval
+                self.discard(game.conversation_id)
+                raise
+            entry.persisted_version = game.version
+
+    def _write(self, entries):
+        """Write entries back, each conditional on its last persisted version"""
+        by_shard = {}
+        for entry in entries:
+            by_shard.setdefault(entry.game._state.db, []).append(entry)
+        for using, shard_entries in by_shard.items():
+            write_using(using, self._write_batch, using, shard_entries)
+
+    def _write_batch(self, using, entries):
+        now = timezone.now()
+        with transaction.atomic(using=using):
+            for entry in entries:
+                with entry.lock:
+                    game = entry.game
+                    values = {field: getattr(game, field) for field in STATE_FIELDS}
+                    expected, version = entry.persisted_version, game.version
+                    events = game.take_stats()
+                updated = Game.objects.using(using).filter(pk=game.pk, version=expected).update(
+                    version=version, updated_at=now, **values
+                )
+                if updated:
+                    entry.persisted_version = version
+                    game.record_stats(events)
+                else:
+                    logger.warning(
+                        "dropping cached game changed in the database",
+                        extra={"game_id": game.ref, "version": expected},
+                    )
+                    self.conflicts += 1
+                    self.discard(game.conversation_id)
+
+    def flush(self):
+        """Write every dirty game back in one transaction"""
+        with self._lock:
+            entries = [self._entries[game_ref] for game_ref in self._dirty]
+            self._dirty.clear()
+        self._write(entries)
+
+    def _run_flusher(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                with self._lock:
+                    evicted = self._evict()
+                self._write(evicted)
+            except Exception:
+                logger.exception("game cache flush failed")
+            finally:
+                close_old_connections()
+
+    def close(self):
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+
+
+_store: Optional[GameStore] = None
+_store_lock = threading.Lock()
+
+
+def get_game_store() -> GameStore:
+    """
+    Return the process-wide game store, a CachedGameStore when
+    settings.XO_GAME_CACHE is enabled and a plain GameStore otherwise
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            if getattr(settings, "XO_GAME_CACHE", False):
+                _store = CachedGameStore(
+                    max_entries=getattr(settings, "XO_GAME_CACHE_SIZE", 10000),
+                    ttl=getattr(settings, "XO_GAME_CACHE_TTL", 600.0),
+                    flush_interval=getattr(settings, "XO_GAME_CACHE_FLUSH_INTERVAL", 0.0),
+                )
+                atexit.register(_store.close)
+            else:
+                _store = GameStore()
+            start_background_sweeper()
+        return _store
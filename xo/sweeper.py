@@ -0,0 +1,200 @@
+"""
+Expiry of old games.
+
+Finished games are kept for XO_SWEEP_FINISHED_AFTER seconds after their
+last turn and games left in progress for XO_SWEEP_ABANDONED_AFTER, then
+the sweeper moves them out of the game table of each shard: into the
+shard's ArchivedGame (XO_ARCHIVE = "table"), as JSON lines appended to a
+file (XO_ARCHIVE = a path), or nowhere (None). Swept in-progress games are
+counted as abandoned in HourlyStats. The MovedGame forwards left by
+rebalance_games go after XO_SWEEP_ABANDONED_AFTER too.
+
+Games are found with the (status, updated_at) index, one status at a
+time, and moved XO_SWEEP_BATCH_SIZE at a time, each batch in its own short
+transaction through ehsandar.dbwriter with a pause between batches, so the
+webhooks never wait long for the write lock. A file archive is appended to
+before the batch commits, so a failed batch may leave duplicate lines.
+
+Run it with `manage.py sweep_games`, or set XO_SWEEP_INTERVAL to sweep
+from a background thread in every process that serves games. Both also
+purge the expired webhook responses of the database dedup store.
+"""
+
+import atexit
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from chatbot.dedup import get_dedup_store
+from ehsandar.dbwriter import write_using
+from ehsandar.metrics import registry
+from .bitboard import Position, geometry
+from .models import ArchivedGame, Game, HourlyStats, MovedGame
+from .shards import shards
+
+logger = logging.getLogger(__name__)
+
+TABLE = "table"
+FINISHED_STATUSES = ("X_WON", "O_WON", "DRAW")
+FIELDS = (
+    "id",
+    "conversation_id",
+    "x_cells",
+    "o_cells",
+    "size",
+    "win_length",
+    "status",
+    "version",
+    "created_at",
+    "updated_at",
+)
+
+
+class Sweeper:
+    def __init__(
+        self,
+        finished_after: float = 7 * 24 * 3600,
+        abandoned_after: float = 30 * 24 * 3600,
+        batch_size: int = 500,
+        pause: float = 0.05,
+        archive: Optional[str] = TABLE,
+    ):
+        self.finished_after = finished_after
+        self.abandoned_after = abandoned_after
+        self.batch_size = batch_size
+        self.pause = pause
+        self.archive = archive
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def cutoffs(self, now=None) -> Dict[str, object]:
+        """Oldest updated_at kept, per status"""
+        now = now or timezone.now()
+        finished = now - timedelta(seconds=self.finished_after)
+        cutoffs = {status: finished for status in FINISHED_STATUSES}
+        cutoffs["IN_PROGRESS"] = now - timedelta(seconds=self.abandoned_after)
+        return cutoffs
+
+    def _archive(self, using, rows):
+        for row in rows:
+            position = Position(
+                row.pop("x_cells"), row.pop("o_cells"), geometry(row["size"], row["win_length"])
+            )
+            row["board"] = position.to_string()
+        if self.archive == TABLE:
+            ArchivedGame.objects.using(using).bulk_create(
+                [ArchivedGame(game_id=row.pop("id"), **row) for row in rows]
+            )
+        elif self.archive:
+            lines = "".join(json.dumps(row, cls=DjangoJSONEncoder) + "\n" for row in rows)
+            # One write per batch, so batches from other processes don't interleave
+            with open(self.archive, "a", encoding="utf-8") as archive:
+                archive.write(lines)
+
+    def _sweep_batch(self, using, status, cutoff) -> int:
+        """Archive and delete up to batch_size expired games, in one transaction"""
+        games = Game.objects.using(using)
+        with transaction.atomic(using=using):
+            rows = list(
+                games.filter(status=status, updated_at__lt=cutoff)
+                .order_by("updated_at")
+                .values(*FIELDS)[: self.batch_size]
+            )
+            if not rows:
+                return 0
+            ids = [row["id"] for row in rows]
+            self._archive(using, rows)
+            games.filter(pk__in=ids).delete()
+            if status == "IN_PROGRESS":
+                HourlyStats.record(*["abandoned"] * len(ids), using=using)
+        return len(ids)
+
+    def sweep(self, now=None) -> Dict[str, int]:
+        """Sweep every expired game, returns the number swept per status"""
+        cutoffs = self.cutoffs(now)
+        swept = dict.fromkeys(cutoffs, 0)
+        for using in shards():
+            for status, cutoff in cutoffs.items():
+                count = 0
+                while not self._stop.is_set():
+                    batch = write_using(using, self._sweep_batch, using, status, cutoff)
+                    count += batch
+                    if batch < self.batch_size:
+                        break
+                    time.sleep(self.pause)
+                if count:
+                    swept[status] += count
+                    registry.counter(
+                        "xo_swept_games_total",
+                        "Expired games removed by the sweeper",
+                        status=status,
+                    ).inc(count)
+            # A game moved before then was swept or played on boards with its new ref
+            write_using(using, self._forget_moves, using, cutoffs["IN_PROGRESS"])
+        return swept
+
+    def _forget_moves(self, using, cutoff):
+        MovedGame.objects.using(using).filter(moved_at__lt=cutoff).delete()
+
+    def start(self, interval: float):
+        """Sweep every interval seconds from a background thread"""
+        self._thread = threading.Thread(
+            target=self._run, args=(interval,), name="xo-sweeper", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                swept = self.sweep()
+                if any(swept.values()):
+                    logger.info("swept expired games", extra=swept)
+                purged = get_dedup_store().purge()
+                if purged:
+                    logger.info("purged webhook responses", extra={"purged": purged})
+            except Exception:
+                logger.exception("game sweep failed")
+            finally:
+                close_old_connections()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def get_sweeper() -> Sweeper:
+    """Sweeper configured from settings"""
+    return Sweeper(
+        finished_after=getattr(settings, "XO_SWEEP_FINISHED_AFTER", 7 * 24 * 3600),
+        abandoned_after=getattr(settings, "XO_SWEEP_ABANDONED_AFTER", 30 * 24 * 3600),
+        batch_size=getattr(settings, "XO_SWEEP_BATCH_SIZE", 500),
+        pause=getattr(settings, "XO_SWEEP_PAUSE", 0.05),
+        archive=getattr(settings, "XO_ARCHIVE", TABLE),
+    )
+
+
+_background: Optional[Sweeper] = None
+_background_lock = threading.Lock()
+
+
+def start_background_sweeper() -> Optional[Sweeper]:
+    """Start this process's background sweeper once, if XO_SWEEP_INTERVAL is set"""
+    global _background
+    interval = getattr(settings, "XO_SWEEP_INTERVAL", 0)
+    if not interval:
+        return None
+    with _background_lock:
+        if _background is None:
+            _background = get_sweeper()
+            _background.start(interval)
+            atexit.register(_background.close)
+        return _background
@@ -1,3 +1,587 @@
-from django.test import TestCase
+import copy
+import io
+import json
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from chatbot.client import build_message_payload
+from . import engine, render, search, selfplay, shards, stats
+from .management.commands.rebalance_games import move_game
+from .bitboard import STANDARD, Position, geometry
+from .executor import EngineExecutor
+from .models import ArchivedGame, Game, GameConflict, HourlyStats, InvalidMove, MovedGame
+from .store import CachedGameStore, GameStore
+from .sweeper import Sweeper
+from .validation import FINISHED, STALE, TAKEN, StateCache
+
+
+class EngineTests(TestCase):
+    def test_tables_cover_reachable_boards(self):
+        tables = engine.get_tables()
+        self.assertLess(len(tables[engine.PERFECT]), 6000)
+        self.assertEqual(tables[engine.HEURISTIC].keys(), tables[engine.PERFECT].keys())
+
+    def test_heuristic_table_matches_scan(self):
+        for board, move in engine.get_tables()[engine.HEURISTIC].items():
+            self.assertEqual(move, engine.heuristic_move(board))
+
+    def test_perfect_play_never_loses(self):
+        def play(board):
+            if engine.is_winner(board, "X"):
+                self.fail(f"bot lost on {board}")
+            if engine.is_winner(board, "O") or engine.EMPTY not in board:
+                return
+            for i in range(9):
+                if board[i] == engine.EMPTY:
+                    after = board[:i] + "X" + board[i + 1 :]
+                    if engine.is_winner(after, "X"):
+                        self.fail(f"bot lost on {after}")
+                    if engine.EMPTY in after:
+                        move = engine.best_move(after, engine.PERFECT)
+                        play(after[:move] + "O" + after[move + 1 :])
+
+        play(engine.EMPTY * 9)
+
+    def test_unknown_style(self):
+        with self.assertRaises(ValueError):
+            engine.best_move("X--------", "random")
+
+
+class BitboardTests(TestCase):
+    def test_matches_string_rules(self):
+        for board in engine.get_tables()[engine.HEURISTIC]:
+            position = Position.from_string(board)
+            self.assertEqual(position.to_string(), board)
+            for player in "XO":
+                self.assertEqual(position.has_won(player), engine.is_winner(board, player))
+                self.assertEqual(
+                    position.winning_move(player), engine.winning_move(board, player)
+                )
+            self.assertEqual(
+                position.legal_moves(), [i for i in range(9) if board[i] == "-"]
+            )
+
+    def test_make_move_updates_board(self):
+        game = Game(conversation_id="c0", board="XX-OO----")
+        game.make_move(2)
+        self.assertEqual(game.board, "XXXOO----")
+        self.assertEqual(game.status, "X_WON")
+        with self.assertRaises(ValueError):
+            game.make_move(0)
+
+
+class SearchTests(TestCase):
+    def test_geometry_lines(self):
+        self.assertEqual(STANDARD.priority, engine.PRIORITY_POSITIONS)
+        self.assertEqual(len(geometry(4, 4).win_masks), 10)
+        self.assertEqual(len(geometry(5, 4).win_masks), 28)
+
+    def test_wins_on_larger_boards(self):
+        board = "X---" "-X--" "--X-" "---X"
+        self.assertTrue(Position.from_string(board, geometry(4, 4)).has_won("X"))
+        board = "X-----X-----X" + "-" * 12
+        self.assertFalse(Position.from_string(board, geometry(5, 4)).has_won("X"))
+        self.assertTrue(Position.from_string(board, geometry(5, 3)).has_won("X"))
+        position = Position.from_string("XXX" + "-" * 22, geometry(5, 4))
+        self.assertEqual(position.winning_move("X"), 3)
+
+    def test_takes_win_before_block(self):
+        position = Position.from_string("XXX-" "OOO-" "X---" "----", geometry(4, 4))
+        self.assertEqual(search.best_move(position, "O", budget=0.5), 7)
+
+    def test_blocks(self):
+        position = Position.from_string("XXX-" "O---" "O---" "----", geometry(4, 4))
+        self.assertEqual(search.best_move(position, "O", budget=0.5), 3)
+
+    def test_respects_budget(self):
+        searcher = search.Searcher(geometry(5, 4))
+        position = Position(geometry=geometry(5, 4)).play(12, "X")
+        result = searcher.search(position, "O", budget=0.05)
+        self.assertFalse(result.complete)
+        self.assertGreaterEqual(result.depth, 1)
+        self.assertIn(result.move, position.legal_moves())
+
+    def test_perfect_on_3x3(self):
+        searcher = search.Searcher(STANDARD)
+        result = searcher.search(Position.from_string("X--------"), "O", budget=5)
+        self.assertTrue(result.complete)
+        self.assertEqual(result.score, 0)
+
+
+class EngineExecutorTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.executor = EngineExecutor(1, deadline=5.0, geometries=[(4, 4)])
+        cls.executor.warm()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.executor.close()
+        super().tearDownClass()
+
+    def test_searches_in_worker(self):
+        board = "XXX-" "O---" "O---" "----"
+        self.assertEqual(self.executor.best_move(board, 4, 4, "O", budget=0.1), 3)
+
+    def test_falls_back_past_deadline(self):
+        game = Game.restart("c-pool", size=5, win_length=4)
+        game.board = "XXX--" + "O" * 2 + "-" * 18
+        game.current_turn = "O"
+        with (
+            mock.patch("xo.models.get_engine_executor", return_value=self.executor),
+            mock.patch.object(self.executor, "deadline", 0.0),
+        ):
+            self.assertIsNone(self.executor.best_move(game.board, 5, 4, budget=0.5))
+            game.bot_move(save=False)
+        # Heuristic fallback blocks the open three
+        self.assertEqual(game.board[3], "O")
+
+
+class GameBotTests(TestCase):
+    def test_bot_blocks(self):
+        game = Game.objects.create(conversation_id="c1", board="XX--O----", current_turn="O")
+        self.assertTrue(game.bot_move())
+        self.assertEqual(game.board, "XXO-O----")
+
+    @override_settings(XO_BOT_STYLE=engine.PERFECT)
+    def test_bot_perfect_style(self):
+        game = Game.objects.create(conversation_id="c2")
+        game.make_move(0)
+        self.assertTrue(game.bot_move())
+        self.assertEqual(game.board, "X---O----")
+
+    @override_settings(XO_BOT_TIME_BUDGET=0.05)
+    def test_bot_on_larger_board(self):
+        game = Game.restart("c-big", size=5, win_length=4)
+        self.assertEqual(game.board, "-" * 25)
+        game.play_turn(12)
+        self.assertEqual(game.board.count("O"), 1)
+        self.assertEqual(len(game.get_button_grid()), 5)
+        self.assertEqual(len(game.get_board_state()[0]), 5)
+        with self.assertRaises(ValueError):
+            game.make_move(25)
+
+
+class RenderCacheTests(TestCase):
+    def test_matches_button_grid(self):
+        game = Game(id=42, conversation_id="c3", board="XO-X-O---")
+        rendered = json.loads(game.render_message())
+        expected = build_message_payload(game.get_status_message(), game.get_button_grid())
+        self.assertEqual(rendered, expected)
+
+    def test_template_shared_between_games(self):
+        render.cache_clear()
+        render.render_message("X--------", 1, 0, "msg")
+        payload = render.render_message("X--------", 2, 5, "msg")
+        self.assertEqual(render.cache_info().hits, 1)
+        self.assertIn(b'"game_id":"2","version":"5"', payload)
+        self.assertNotIn(b'"game_id":"1"', payload)
+
+
+class GameStoreTests(TestCase):
+    def play(self, store, game_id, move):
+        with store.turn(game_id) as game:
+            game.make_move(move, save=False)
+            game.bot_move(save=False)
+
+    def test_turn_saves_once(self):
+        game = Game.objects.create(conversation_id="c4")
+        with self.assertNumQueries(2):
+            self.play(GameStore(), game.id, 0)
+        game.refresh_from_db()
+        self.assertEqual(game.board, "X---O----")
+
+    def test_cached_turn_skips_reads(self):
+        store = CachedGameStore()
+        game = store.get_or_create("c5")
+        with self.assertNumQueries(1):
+            self.play(store, game.id, 0)
+        self.assertIs(store.get_or_create("c5"), game)
+        game.refresh_from_db()
+        self.assertEqual(game.board, "X---O----")
+
+    def test_write_behind_flush(self):
+        store = CachedGameStore(flush_interval=3600)
+        self.addCleanup(store.close)
+        game = store.get_or_create("c6")
+        with self.assertNumQueries(0):
+            self.play(store, game.id, 0)
+        self.assertEqual(Game.objects.get(pk=game.id).board, "---------")
+        store.flush()
+        self.assertEqual(Game.objects.get(pk=game.id).board, "X---O----")
+
+    def test_eviction_writes_dirty_games(self):
+        store = CachedGameStore(max_entries=1, flush_interval=3600)
+        self.addCleanup(store.close)
+        first = store.get_or_create("c7")
+        self.play(store, first.id, 0)
+        store.get_or_create("c8")
+        self.assertEqual(len(store), 1)
+        self.assertEqual(Game.objects.get(pk=first.id).board, "X---O----")
+
+    def test_rejected_turn_keeps_unflushed_turns(self):
+        store = CachedGameStore(flush_interval=3600)
+        self.addCleanup(store.close)
+        game = store.get_or_create("c11")
+        self.play(store, game.id, 0)
+        for move in (0, 1):
+            # A taken cell, then a move whose bot reply fails half way
+            with self.assertRaises(InvalidMove):
+                with store.turn(game.id) as cached:
+                    cached.make_move(move, save=False)
+                    raise InvalidMove("bot failed")
+        self.assertIs(store.get_or_create("c11"), game)
+        self.assertEqual(game.board, "X---O----")
+        store.flush()
+        self.assertEqual(Game.objects.get(pk=game.id).board, "X---O----")
+        self.assertEqual(Game.objects.get(pk=game.id).version, 1)
+
+    def test_restart_replaces_cached_game(self):
+        store = CachedGameStore()
+        game = store.get_or_create("c9")
+        self.play(store, game.id, 0)
+        restarted = store.restart("c9")
+        self.assertEqual(restarted.id, game.id)
+        self.assertEqual(restarted.version, 2)
+        self.assertIsNot(store.get_or_create("c9"), game)
+        self.assertEqual(store.get_or_create("c9").board, "---------")
+
+    @override_settings(
+        KENAR_DEDUP_BACKEND="memory", KENAR_THROTTLE_BACKEND="memory", XO_STATE_CACHE_SIZE=1000
+    )
+    def test_tap_after_restart_of_unflushed_game(self):
+        store = CachedGameStore(flush_interval=3600)
+        self.addCleanup(store.close)
+        game = store.get_or_create("c12")
+
+        def tap(position, version):
+            extra_data = {"game_id": game.ref, "position": str(position), "version": version}
+            with mock.patch("xo.views.get_game_store", return_value=store), mock.patch(
+                "xo.views.send_message"
+            ):
+                self.client.post(
+                    "/xo/webhook/", {"extra_data": extra_data}, content_type="application/json"
+                )
+
+        tap(0, 0)
+        tap(game.board.index("-"), 1)
+        move = game.board.index("-")
+        restarted = store.restart("c12")
+        self.assertEqual(restarted.version, 3)
+        self.assertEqual(HourlyStats.objects.get().abandoned, 1)
+        tap(move, 1)
+        self.assertEqual(restarted.board, "---------")
+        tap(move, restarted.version)
+        self.assertEqual(restarted.board[move], "X")
+
+    def test_batched_write_detects_conflict(self):
+        store = CachedGameStore(flush_interval=3600)
+        self.addCleanup(store.close)
+        game = store.get_or_create("c10")
+        self.play(store, game.id, 0)
+        Game.restart("c10")
+        store.flush()
+        self.assertEqual(store.conflicts, 1)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(Game.objects.get(pk=game.id).board, "---------")
+
+
+class TurnTests(TestCase):
+    def test_play_turn_saves_with_one_update(self):
+        game = Game.objects.create(conversation_id="t1")
+        self.assertTrue(game.play_turn(0))
+        with self.assertNumQueries(1):
+            game.save_turn()
+        game.refresh_from_db()
+        self.assertEqual((game.board, game.version), ("X---O----", 1))
+
+    def test_concurrent_save_conflicts(self):
+        game = Game.objects.create(conversation_id="t2")
+        other = Game.objects.get(pk=game.pk)
+        game.play_turn(0)
+        game.save_turn()
+        other.play_turn(1)
+        with self.assertRaises(GameConflict):
+            other.save_turn()
+        self.assertEqual(Game.objects.get(pk=game.pk).board, "X---O----")
+
+    def test_stale_version_conflicts(self):
+        game = Game.objects.create(conversation_id="t3", version=3)
+        with self.assertRaises(GameConflict):
+            game.play_turn(0, expected_version=2)
+        self.assertEqual(game.board, "---------")
+
+    def test_restart_resets_in_place(self):
+        game = Game.objects.create(conversation_id="t4", board="XO-------", current_turn="X")
+        restarted = Game.restart("t4")
+        self.assertEqual((restarted.id, restarted.board, restarted.version), (game.id, "---------", 1))
+        self.assertEqual(Game.restart("t5").version, 0)
+
+
+class StateCacheTests(TestCase):
+    def test_check_tap(self):
+        cache = StateCache()
+        game = Game(pk=1, board="X---O----", version=1)
+        cache.remember(game)
+        self.assertEqual(cache.check_tap("1", 4, 1), TAKEN)
+        self.assertEqual(cache.check_tap("1", 2, 0), STALE)
+        self.assertEqual(cache.check_tap("1", 2, 0, disabled="True"), TAKEN)
+        self.assertIsNone(cache.check_tap("1", 2, 1))
+        # Unknown games and boards newer than the cache go to the DB
+        self.assertIsNone(cache.check_tap("2", 0, 0))
+        self.assertIsNone(cache.check_tap("1", 4, 2))
+
+    def test_keeps_newest_version(self):
+        cache = StateCache(max_entries=1)
+        cache.remember(Game(pk=1, board="XXXOO----", version=3, status="X_WON"))
+        cache.remember(Game(pk=1, board="X---O----", version=1))
+        self.assertEqual(cache.check_tap("1", 8, 3), FINISHED)
+        cache.remember(Game(pk=2, version=0))
+        self.assertEqual(len(cache), 1)
+        self.assertIsNone(cache.get("1"))
+
+
+class StatsTests(TestCase):
+    def test_counters_follow_status_changes(self):
+        game = Game.objects.create(conversation_id="s1", board="XX-OO----")
+        Game.objects.create(conversation_id="s2")
+        with GameStore().turn(game.pk) as game:
+            game.play_turn(2)
+        Game.restart("s1")
+        Game.restart("s2")
+        summary = stats.summary()
+        self.assertEqual((summary["started"], summary["abandoned"], summary["finished"]), (4, 1, 1))
+        self.assertEqual(summary["active"], 2)
+        self.assertEqual(len(stats.hourly()), 1)
+
+    def test_conflicting_turn_is_not_counted(self):
+        game = Game.objects.create(conversation_id="s3", board="XX-OO----", current_turn="X")
+        stale = Game.objects.get(pk=game.pk)
+        game.play_turn(2)
+        game.save_turn()
+        stale.play_turn(2)
+        with self.assertRaises(GameConflict):
+            stale.save_turn()
+        self.assertEqual(stats.summary()["x_won"], 1)
+
+    def test_rebuild_matches_game_table(self):
+        for i in range(5):
+            Game.objects.create(conversation_id=f"r{i}")
+        Game.objects.filter(conversation_id__in=["r0", "r1"]).update(status="DRAW")
+        HourlyStats.objects.all().delete()
+        self.assertEqual(stats.rebuild(chunk_size=2), 5)
+        summary = stats.summary()
+        self.assertEqual((summary["active"], summary["draw"], summary["draw_rate"]), (3, 2, 1.0))
+
+
+    def test_rebuild_keeps_what_the_tables_cant_show(self):
+        for i in range(3):
+            Game.objects.create(conversation_id=f"k{i}", status="X_WON")
+        old = timezone.now() - timedelta(days=60)
+        Game.objects.filter(conversation_id="k0").update(updated_at=old)
+        Sweeper(finished_after=3600).sweep()
+        hour = HourlyStats.hour_of()
+        # Restarts and abandoned games only ever show in the counters
+        HourlyStats.objects.filter(hour=hour).update(started=10, abandoned=4, x_won=0)
+        stats.rebuild()
+        row = HourlyStats.objects.get(hour=hour)
+        self.assertEqual((row.started, row.abandoned, row.x_won), (10, 4, 2))
+        # The swept game is counted from the archive
+        self.assertEqual(HourlyStats.objects.get(hour=HourlyStats.hour_of(old)).x_won, 1)
+
+class SweeperTests(TestCase):
+    def setUp(self):
+        old = timezone.now() - timedelta(days=60)
+        Game.objects.create(conversation_id="w0")
+        for i, status in enumerate(["X_WON", "DRAW", "DRAW", "IN_PROGRESS"], 1):
+            Game.objects.create(conversation_id=f"w{i}", status=status)
+        Game.objects.exclude(conversation_id="w0").update(updated_at=old)
+
+    def test_sweep_archives_in_batches(self):
+        swept = Sweeper(batch_size=2, pause=0).sweep()
+        self.assertEqual(swept, {"X_WON": 1, "O_WON": 0, "DRAW": 2, "IN_PROGRESS": 1})
+        self.assertEqual(list(Game.objects.values_list("conversation_id", flat=True)), ["w0"])
+        self.assertEqual(ArchivedGame.objects.filter(status="DRAW").count(), 2)
+        self.assertEqual(stats.summary()["abandoned"], 1)
+
+    def test_sweep_to_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "games.jsonl")
+            Sweeper(archive=path).sweep()
+            with open(path) as archive:
+                rows = [json.loads(line) for line in archive]
+        self.assertEqual(sorted(row["conversation_id"] for row in rows), ["w1", "w2", "w3", "w4"])
+        self.assertFalse(ArchivedGame.objects.exists())
+
+    def test_tap_on_swept_game(self):
+        game = Game.objects.get(conversation_id="w4")
+        Sweeper().sweep()
+        response = self.client.post(
+            "/xo/webhook/",
+            {"extra_data": {"game_id": str(game.pk), "position": "0"}},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("game is over", response.json()["text_message"])
+
+
+class SelfPlayTests(TestCase):
+    def test_perfect_bot_never_loses(self):
+        result = selfplay.play_all(selfplay.POLICIES[engine.PERFECT]())
+        self.assertEqual((result.losses, result.illegal), (0, 0))
+        self.assertEqual(result.games, result.wins + result.draws)
+
+    def test_engines_agree(self):
+        heuristic, rules = selfplay.benchmark([engine.HEURISTIC, "rules"])
+        self.assertEqual(
+            (heuristic.wins, heuristic.draws, heuristic.losses),
+            (rules.wins, rules.draws, rules.losses),
+        )
+
+    @override_settings(XO_BOT_STYLE=engine.PERFECT)
+    def test_bot_move_never_loses(self):
+        result = selfplay.play_all(selfplay.POLICIES["game"]())
+        self.assertEqual((result.losses, result.illegal), (0, 0))
+        self.assertGreater(result.moves_per_second, 0)
+
+
+class StorageTests(TestCase):
+    def test_board_status_and_turn_are_packed(self):
+        game = Game.objects.create(conversation_id="p1", board="XX-OO----", current_turn="O", status="DRAW")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT x_cells, o_cells, current_turn, status FROM xo_game WHERE id = %s", [game.pk]
+            )
+            self.assertEqual(cursor.fetchone(), (0b11, 0b11000, 1, 3))
+        game = Game.objects.get(pk=game.pk)
+        self.assertEqual((game.board, game.current_turn, game.status), ("XX-OO----", "O", "DRAW"))
+        self.assertTrue(Game.objects.filter(status__in=["DRAW", "X_WON"]).exists())
+
+    def test_larger_board_round_trip(self):
+        board = "X" + "-" * 23 + "O"
+        Game.objects.create(conversation_id="p2", size=5, win_length=4, board=board)
+        self.assertEqual(Game.objects.get(conversation_id="p2").board, board)
+
+
+class ShardTests(TestCase):
+    def test_appending_a_shard_moves_few_conversations(self):
+        ids = [f"conversation-{i}" for i in range(2000)]
+        before = [shards.shard_index(cid, 4) for cid in ids]
+        after = [shards.shard_index(cid, 5) for cid in ids]
+        moved = [new for old, new in zip(before, after) if old != new]
+        self.assertTrue(set(moved) <= {4})
+        self.assertLess(len(moved), len(ids) * 0.3)
+        self.assertEqual(before, [shards.shard_index(cid, 4) for cid in ids])
+
+    @override_settings(XO_SHARDS=["default", "other"])
+    def test_game_refs(self):
+        self.assertEqual(shards.game_ref("default", 5), "5")
+        self.assertEqual(shards.game_ref("other", 5), "1:5")
+        self.assertEqual(shards.parse_ref("1:5"), ("other", 5))
+        self.assertEqual(shards.parse_ref(5), ("default", 5))
+        with self.assertRaises(ValueError):
+            shards.parse_ref("2:5")
+        router = shards.ShardRouter()
+        self.assertTrue(router.allow_migrate("other", "xo"))
+        self.assertFalse(router.allow_migrate("other", "chatbot"))
+
+
+@override_settings(XO_SHARDS=["default", "rebalance"])
+class RebalanceTests(TestCase):
+    # The shard is only added in setUpClass, after the runner read databases
+    databases = "__all__"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        settings_dict = copy.deepcopy(connections["default"].settings_dict)
+        settings_dict["NAME"] = os.path.join(cls.directory.name, "rebalance.sqlite3")
+        connections.settings["rebalance"] = settings_dict
+        with override_settings(XO_SHARDS=["default", "rebalance"]):
+            call_command("migrate", "xo", database="rebalance", verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections["rebalance"].close()
+        del connections["rebalance"]
+        del connections.settings["rebalance"]
+        cls.directory.cleanup()
+
+    def conversation(self, prefix, shard):
+        conversation_id = prefix
+        while shards.shard_for(conversation_id) != shard:
+            conversation_id += prefix
+        return conversation_id
+
+    def misplaced(self):
+        """An in-progress game on the shard its conversation doesn't hash to"""
+        conversation_id = self.conversation("m", "rebalance")
+        with override_settings(XO_SHARDS=["default"]):
+            game = Game.objects.create(conversation_id=conversation_id)
+        game.play_turn(0)
+        game.save_turn()
+        return game
+
+    def test_moved_game_keeps_its_boards(self):
+        game = self.misplaced()
+        # Take the pk the copy would otherwise keep
+        Game.objects.using("rebalance").create(conversation_id="other", x_cells=1)
+        self.assertTrue(move_game(game, "rebalance"))
+        self.assertFalse(Game.objects.filter(pk=game.pk).exists())
+        moved = Game.objects.using("rebalance").get(conversation_id=game.conversation_id)
+        self.assertEqual((moved.board, moved.version), (game.board, game.version))
+        self.assertEqual(moved.created_at, game.created_at)
+        self.assertEqual(MovedGame.objects.get(game_id=game.pk).ref, moved.ref)
+
+        for store in (GameStore(), CachedGameStore()):
+            with self.subTest(store=type(store).__name__):
+                self.assertEqual(store.load(game.ref).ref, moved.ref)
+        move = game.board.index("-")
+        tap = {"game_id": game.ref, "position": str(move), "version": game.version}
+        with mock.patch("xo.views.send_message"):
+            response = self.client.post(
+                "/xo/webhook/", {"extra_data": tap}, content_type="application/json"
+            )
+        self.assertNotIn("game is over", response.json()["text_message"])
+        moved.refresh_from_db()
+        self.assertEqual(moved.board[move], "X")
+
+    def test_game_changed_while_moving_stays(self):
+        game = self.misplaced()
+        Game.objects.filter(pk=game.pk).update(version=game.version + 1)
+        self.assertFalse(move_game(game, "rebalance"))
+        self.assertTrue(Game.objects.filter(pk=game.pk).exists())
+        self.assertFalse(MovedGame.objects.exists())
+
+    def test_command(self):
+        game = self.misplaced()
+        with override_settings(XO_SHARDS=["default"]):
+            Game.objects.create(conversation_id=self.conversation("s", "default"))
+        out = io.StringIO()
+        call_command("rebalance_games", "--dry-run", stdout=out)
+        self.assertIn("would move 1 games", out.getvalue())
+        self.assertTrue(Game.objects.filter(pk=game.pk).exists())
+
+        call_command("rebalance_games", stdout=out)
+        self.assertIn("moved 1 games, 0 changed", out.getvalue())
+        self.assertEqual(Game.objects.get().conversation_id, self.conversation("s", "default"))
+        self.assertTrue(
+            Game.objects.using("rebalance").filter(conversation_id=game.conversation_id).exists()
+        )
+
+    def test_sweeper_forgets_old_moves(self):
+        MovedGame.objects.create(game_id=1, ref="1:1")
+        MovedGame.objects.create(game_id=2, ref="1:2")
+        MovedGame.objects.filter(game_id=1).update(moved_at=timezone.now() - timedelta(days=60))
+        Sweeper(pause=0).sweep()
+        self.assertEqual(list(MovedGame.objects.values_list("game_id", flat=True)), [2])
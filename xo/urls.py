@@ -1,6 +1,15 @@
+from django.conf import settings
 from django.urls import path
-from .views import ReturnUrlView 
+from .views import AsyncReturnUrlView, ReturnUrlView, stats_view
+
+# Serve the async view when running under ASGI with KENAR_ASYNC_WEBHOOKS
+webhook_view = (
+    AsyncReturnUrlView
+    if getattr(settings, "KENAR_ASYNC_WEBHOOKS", False)
+    else ReturnUrlView
+)
 
 urlpatterns = [
-    path('webhook/', ReturnUrlView.as_view(), name='return-url-webhook'),
+    path('webhook/', webhook_view.as_view(), name='return-url-webhook'),
+    path('stats/', stats_view, name='game-stats'),
 ]
@@ -0,0 +1,104 @@
+"""
+Fast rejection of taps that can't be played.
+
+Every button carries the game ref (see xo.shards), the board version it
+was rendered for, its position and whether it was disabled (already
+taken). check_tap answers from that plus a small per-process cache of the
+last board state seen for each game (version, board, status), without
+loading the game:
+
+- a disabled button is a taken cell on every later board too
+- a version older than the cached one is a stale board
+- on the cached version itself, a finished game or a taken cell
+
+Versions only go up, so a cache that is behind (another worker played the
+last turn) only ever lets taps through to the normal path, it never
+rejects a valid one.
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from ehsandar.metrics import registry
+
+TAKEN, FINISHED, STALE = "taken", "finished", "stale"
+
+# (version, board, status)
+State = Tuple[int, str, str]
+
+
+class StateCache:
+    def __init__(self, max_entries: int = 50000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, State]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, game_ref: str) -> Optional[State]:
+        return self._entries.get(game_ref)
+
+    def remember(self, game):
+        """Record the state of game as just saved or loaded"""
+        state = (game.version, game.board, game.status)
+        key = game.ref
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current[0] > state[0]:
+                return
+            self._entries[key] = state
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def check_tap(
+        self, game_ref: str, position: int, version: Optional[int], disabled=None
+    ) -> Optional[str]:
+        """Reason to reject the tap (TAKEN, FINISHED or STALE), or None to play it"""
+        reason = None
+        if disabled == "True":
+            reason = TAKEN
+        elif version is not None:
+            state = self._entries.get(game_ref)
+            if state is not None:
+                cached_version, board, status = state
+                if version < cached_version:
+                    reason = STALE
+                elif version == cached_version:
+                    if status != "IN_PROGRESS":
+                        reason = FINISHED
+                    elif 0 <= position < len(board) and board[position] != "-":
+                        reason = TAKEN
+        if reason is not None:
+            registry.counter(
+                "xo_fast_rejections_total",
+                "Taps rejected without loading the game",
+                reason=reason,
+            ).inc()
+        return reason
+
+
+_cache: Optional[StateCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_state_cache() -> StateCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = StateCache(getattr(settings, "XO_STATE_CACHE_SIZE", 50000))
+    return _cache
+
+
+@receiver(setting_changed)
+def _reset_cache(setting, **kwargs):
+    global _cache
+    if setting == "XO_STATE_CACHE_SIZE":
+        _cache = None
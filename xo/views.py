@@ -1,15 +1,122 @@
 from django.views import View
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from .models import Game
-from chatbot.client import ChatbotClient
-import os
+from asgiref.sync import sync_to_async
+from . import stats
+from .models import Game, GameConflict, InvalidMove
+from .shards import game_ref, parse_ref
+from .store import get_game_store
+from .validation import FINISHED, STALE, get_state_cache
+from chatbot.client import KenarError, KenarUnavailable, get_async_client
+from chatbot.dedup import get_dedup_store, move_key, snapshot, to_response
+from chatbot.delivery import OutboundMessage, send_message
+from chatbot.scheduler import aschedule, learn, schedule
+from chatbot.throttle import ALLOWED, conversation_key, game_key, get_throttle
+from ehsandar.log import log_payload
+from ehsandar.metrics import is_local, timer
 import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+CONFLICT_MESSAGE = "This board is out of date, please play on the latest one"
+THROTTLED_MESSAGE = "Too many moves, please slow down"
+TAKEN_MESSAGE = "That cell is already taken, pick another one"
+FINISHED_MESSAGE = "This game is over, send /restart to play again"
+REJECTION_MESSAGES = {
+    STALE: CONFLICT_MESSAGE,
+    FINISHED: FINISHED_MESSAGE,
+}
+
+
+def board_key(game_id, version):
+    """Fold key of the taps on one board, None for buttons without a version"""
+    return None if version is None else f"board:{game_id}:{version}"
 
 
 @method_decorator(csrf_exempt, name="dispatch")
 class ReturnUrlView(View):
+    def play_turn(self, game_id, move, expected_version=None):
+        """
+        Apply the player's move and the bot's reply, saved with one
+        conditional update. Returns (conversation_id, status_message,
+        payload), or None if the bot could not move. Raises GameConflict
+        if the board is stale or another request saved the game first.
+        """
+        with get_game_store().turn(game_id) as game:
+            if game.status == "IN_PROGRESS":
+                with timer("turn"):
+                    played = game.play_turn(move, expected_version)
+                if not played:
+                    return None
+
+        get_state_cache().remember(game)
+        learn(game_key(game_id), conversation_key(game.conversation_id))
+
+        # Render after the turn is saved so the buttons carry the new version
+        with timer("render"):
+            status_message = game.get_status_message()
+            content = game.render_message(status_message)
+        return game.conversation_id, status_message, content
+
+    def reject_tap(self, extra_data, game_id, move, version):
+        """Reply for a tap that can't be played, decided without the DB"""
+        reason = get_state_cache().check_tap(
+            game_id, move, version, extra_data.get("disabled")
+        )
+        if reason is None:
+            return None
+        message = REJECTION_MESSAGES.get(reason, TAKEN_MESSAGE)
+        return JsonResponse({"text_message": message}, status=200)
+
+    def play_tap(self, game_id, move, version):
+        """
+        Play a tap, run in the conversation's turn. Returns the reply and
+        the board to send, None if there is nothing to send
+        """
+        turn = self.play_turn(game_id, move, version)
+        if turn is None:
+            reply = JsonResponse({"text_message": "you can not make this move"}, status=200)
+            return snapshot(reply), None
+        conversation_id, status_message, content = turn
+        reply = JsonResponse({"text_message": status_message}, status=200)
+        return snapshot(reply), OutboundMessage(conversation_id, content)
+
+    def handle_tap(self, extra_data, game_id, move, version):
+        """Play a tap in the conversation's turn, then send the new board"""
+        # Answer retried callbacks from the response already sent
+        dedup = get_dedup_store()
+        key = move_key(extra_data)
+        with timer("dedup"):
+            duplicate = dedup.lookup(key)
+        if duplicate is not None:
+            return duplicate
+
+        rejected = self.reject_tap(extra_data, game_id, move, version)
+        if rejected is not None:
+            return rejected
+
+        # Only the turn runs in the mailbox, not the send. Taps folded into
+        # an earlier one on the same board get its reply and send nothing
+        outbound = None
+
+        def play():
+            nonlocal outbound
+            reply, outbound = self.play_tap(game_id, move, version)
+            return reply
+
+        response = to_response(
+            schedule(game_key(game_id), play, fold_key=board_key(game_id, version))
+        )
+        if outbound is None:
+            return response
+
+        # Send the cached board payload, inline or through the delivery queue
+        with timer("outbound"):
+            send_message(outbound.conversation_id, outbound.content)
+        dedup.remember(key, response)
+        return response
 
     def post(self, request, *args, **kwargs):
         # Check Content-Type headerFailed to send message: Server error '500 Internal Server Error' for url 'https://open-api.divar.ir/experimental/open-platform/chat/bot/conversations/92c094e9-c6ec-403f-85bf-4cbae16284e5/messages'
@@ -19,53 +126,124 @@ class ReturnUrlView(View):
 
         try:
             # Parse JSON data from request body
-            data = json.loads(request.body)
-            print(data)
+            with timer("parse"):
+                data = json.loads(request.body)
+            log_payload(logger, logging.DEBUG, "move callback", data)
 
             # Extract relevant information
             extra_data = data["extra_data"]
             move = int(extra_data.get("position"))
-            game_id = int(extra_data.get("game_id"))
+            # Canonical game ref, so throttle and cache keys match
+            game_id = game_ref(*parse_ref(extra_data.get("game_id")))
+            version = extra_data.get("version")
+            version = int(version) if version is not None else None
 
-            game: Game = Game.objects.get(pk=game_id)
+            # Shed tap storms before any DB or network work
+            if get_throttle().acquire(game_key(game_id), "move") != ALLOWED:
+                return JsonResponse({"text_message": THROTTLED_MESSAGE}, status=200)
+
+            return self.handle_tap(extra_data, game_id, move, version)
+
+        except GameConflict:
+            return JsonResponse({"text_message": CONFLICT_MESSAGE}, status=200)
+        except InvalidMove:
+            return JsonResponse({"text_message": TAKEN_MESSAGE}, status=200)
+        except Game.DoesNotExist:
+            # Swept after expiring, see xo.sweeper
+            return JsonResponse({"text_message": FINISHED_MESSAGE}, status=200)
+        except KenarError as e:
+            # Kenar failed or its circuit is open, answer now instead of 500
+            logger.warning("reply not sent", extra={"error": str(e)})
+            return HttpResponse(status=503 if isinstance(e, KenarUnavailable) else 502)
+        except json.JSONDecodeError:
+            return HttpResponse(status=400)
+        except Exception:
+            logger.exception("move webhook failed")
+            return HttpResponse(status=500)
 
-            if game.status == "IN_PROGRESS":
-                game.make_move(move)
-                if game.status == "IN_PROGRESS" and not game.bot_move():
-                    return JsonResponse(
-                        {"text_message": "you can not make this move"}, status=200
-                    )
-
-            # Initialize chatbot client
-            client = ChatbotClient(
-                api_key=os.environ.get("KENAR_API_KEY"),
-            )
-
-            # Get game status message
-            status_message = (
-                "Your turn! Select a position to play: (you can reset with /restart)"
-            )
-            if game.status == "X_WON":
-                status_message = "Game Over - You Won! 🎉"
-            elif game.status == "O_WON":
-                status_message = "Game Over - Bot Won! 🤖"
-            elif game.status == "DRAW":
-                status_message = "Game Over - It's a Draw! 🤝"
-
-            # Get button grid from game and send message
-            try:
-                client.send_message_with_buttons(
-                    conversation_id=game.conversation_id,
-                    message=status_message,
-                    buttons_data=game.get_button_grid(),
-                )
-            finally:
-                client.close()
-
-            return JsonResponse({"text_message": status_message}, status=200)
 
+@method_decorator(csrf_exempt, name="dispatch")
+class AsyncReturnUrlView(ReturnUrlView):
+    """
+    Async ReturnUrlView for ASGI deployments. Game updates run in a worker
+    thread and the reply goes through the shared pooled AsyncChatbotClient.
+    """
+
+    async def ahandle_tap(self, extra_data, game_id, move, version):
+        dedup = get_dedup_store()
+        key = move_key(extra_data)
+        with timer("dedup"):
+            duplicate = await dedup.alookup(key)
+        if duplicate is not None:
+            return duplicate
+
+        rejected = self.reject_tap(extra_data, game_id, move, version)
+        if rejected is not None:
+            return rejected
+
+        outbound = None
+
+        async def play():
+            nonlocal outbound
+            reply, outbound = await sync_to_async(self.play_tap)(game_id, move, version)
+            return reply
+
+        response = to_response(
+            await aschedule(game_key(game_id), play, fold_key=board_key(game_id, version))
+        )
+        if outbound is None:
+            return response
+
+        with timer("outbound"):
+            await get_async_client().send_raw_message(outbound.conversation_id, outbound.content)
+        await dedup.aremember(key, response)
+        return response
+
+    async def post(self, request, *args, **kwargs):
+        content_type = request.headers.get("Content-Type", "")
+        if "application/json" not in content_type.lower():
+            return HttpResponse(status=415)
+
+        try:
+            with timer("parse"):
+                data = json.loads(request.body)
+
+            extra_data = data["extra_data"]
+            move = int(extra_data.get("position"))
+            # Canonical game ref, so throttle and cache keys match
+            game_id = game_ref(*parse_ref(extra_data.get("game_id")))
+            version = extra_data.get("version")
+            version = int(version) if version is not None else None
+
+            if get_throttle().acquire(game_key(game_id), "move") != ALLOWED:
+                return JsonResponse({"text_message": THROTTLED_MESSAGE}, status=200)
+
+            return await self.ahandle_tap(extra_data, game_id, move, version)
+
+        except GameConflict:
+            return JsonResponse({"text_message": CONFLICT_MESSAGE}, status=200)
+        except InvalidMove:
+            return JsonResponse({"text_message": TAKEN_MESSAGE}, status=200)
+        except Game.DoesNotExist:
+            # Swept after expiring, see xo.sweeper
+            return JsonResponse({"text_message": FINISHED_MESSAGE}, status=200)
+        except KenarError as e:
+            # Kenar failed or its circuit is open, answer now instead of 500
+            logger.warning("reply not sent", extra={"error": str(e)})
+            return HttpResponse(status=503 if isinstance(e, KenarUnavailable) else 502)
         except json.JSONDecodeError:
             return HttpResponse(status=400)
-        except Exception as e:
-            print(e)
+        except Exception:
+            logger.exception("move webhook failed")
             return HttpResponse(status=500)
+
+
+def stats_view(request):
+    """Game counters for dashboards, only served where /metrics is"""
+    if not is_local(request):
+        return HttpResponseForbidden()
+    try:
+        hours = min(max(int(request.GET.get("hours", 24)), 1), 24 * 31)
+    except ValueError:
+        return HttpResponse(status=400)
+    return JsonResponse({"summary": stats.summary(), "hourly": stats.hourly(hours)})